@@ -21,24 +21,35 @@ Created on Dec 8, 2017
 '''
 
 import numpy as np
+import tensorflow as tf
 from collections import OrderedDict
 
 from .abstract import AbstractGrammar
 from . import slr
 from .slr import generator as slr_generator 
+from .slr import decoding as slr_decoding
+from .slr import cache as slr_cache
 
 from ..util.loader import vectorize
 
-
 class ShiftReduceGrammar(AbstractGrammar):
 
-    def __init__(self, quiet=False, flatten=True, max_input_length=60):
+    def __init__(self, quiet=False, flatten=True, max_input_length=60, cache_dir=None):
         super().__init__()
         
         self.tokens = ['<pad>', '</s>', '<s>']
         
         self._quiet = quiet
         self._parser = None
+        # if set, the parse tables are saved in (and loaded from) this directory
+        self._cache_dir = cache_dir
+        self.cache_filename = None
+        # the file the parse tables were loaded from, if any
+        self.tables_filename = None
+        # built the first time they are used, see decoding_tables
+        self._decoding_tables = None
+        self._start_symbol = None
+        self._output_terminals = []
 
         self._extensible_terminals = []
         self._extensible_terminal_indices = dict()
@@ -83,14 +94,18 @@ class ShiftReduceGrammar(AbstractGrammar):
             self._copy_terminals = list(copy_terminals.keys())
             self._copy_terminals.sort()
 
-        generator = slr_generator.SLRParserGenerator(grammar, '$input')
-        self._parser = generator.build()
+        # the output shifts, in the same order as the actions
+        output_terminals = self._copy_terminals + self._extensible_terminals
+        self._start_symbol = '$input'
+        self._output_terminals = output_terminals
+        self._decoding_tables = None
+        self._parser = self._load_or_build_parser(grammar, '$input', output_terminals)
         
         if not self._quiet:
             print('num rules', self._parser.num_rules)
             print('num states', self._parser.num_states)
             print('num shifts', len(self._extensible_terminals) + 1)
-            print('num terminals', len(generator.terminals))
+            print('num terminals', len(self._parser.terminals))
 
         self._output_size = OrderedDict()
         self._output_size['actions'] = self.num_control_tokens + self._parser.num_rules + len(self._copy_terminals) + len(self._extensible_terminals)
@@ -107,7 +122,7 @@ class ShiftReduceGrammar(AbstractGrammar):
             else:
                 self._output_size['COPY_' + term] = self._max_input_length
         
-        self.dictionary = generator.dictionary
+        self.dictionary = dict((token, i) for i, token in enumerate(self._parser.terminals))
         # add synonyms that AbstractGrammar likes
         self.dictionary['<s>'] = slr.START_ID
         self.dictionary['</s>'] = slr.EOF_ID
@@ -117,11 +132,93 @@ class ShiftReduceGrammar(AbstractGrammar):
         for i, term in enumerate(self._copy_terminals):
             self._copy_terminal_indices[self.dictionary[term]] = i
         
-        self.tokens = generator.terminals
+        self.tokens = self._parser.terminals
+
+    def _load_or_build_parser(self, grammar, start_symbol, output_terminals):
+        shared_cache_dir = slr_cache.get_shared_cache_dir()
+        if self._cache_dir is None and shared_cache_dir is None:
+            return slr_generator.SLRParserGenerator(grammar, start_symbol).build()
+
+        grammar_hash = slr_cache.hash_grammar(grammar, start_symbol, output_terminals)
+        if self._cache_dir is not None:
+            self.cache_filename = slr_cache.cache_filename(self._cache_dir, grammar_hash)
+        # when serving, the model directory is only read from
+        save_model_copy = self.cache_filename is not None and slr_cache.is_model_cache_writable()
+        # prefer the shared copy, so all processes map the same file
+        shared_filename = None
+        if shared_cache_dir is not None:
+            shared_filename = slr_cache.cache_filename(shared_cache_dir, grammar_hash)
+            parser = slr_cache.load_parser(shared_filename, grammar_hash)
+            if parser is not None:
+                tf.logging.info('Loaded parse tables from %s', shared_filename)
+                self.tables_filename = shared_filename
+                # keep the copy in the model directory, which is exported with the model
+                if save_model_copy and not tf.gfile.Exists(self.cache_filename):
+                    self._save_parser(self.cache_filename, parser, grammar_hash)
+                return parser
+
+        parser = None
+        if self.cache_filename is not None:
+            parser = slr_cache.load_parser(self.cache_filename, grammar_hash)
+        if parser is not None:
+            tf.logging.info('Loaded parse tables from %s', self.cache_filename)
+            self.tables_filename = self.cache_filename
+        else:
+            parser = slr_generator.SLRParserGenerator(grammar, start_symbol).build()
+            if save_model_copy:
+                self._save_parser(self.cache_filename, parser, grammar_hash)
+        if shared_filename is not None and self._save_parser(shared_filename, parser, grammar_hash):
+            shared_parser = slr_cache.load_parser(shared_filename, grammar_hash)
+            if shared_parser is not None:
+                self.tables_filename = shared_filename
+                return shared_parser
+        return parser
+
+    def _save_parser(self, filename, parser, grammar_hash):
+        try:
+            slr_cache.save_parser(filename, parser, grammar_hash)
+            tf.logging.info('Saved parse tables to %s', filename)
+            return True
+        except (IOError, tf.errors.OpError) as e:
+            # the directory might be read-only, this is not fatal
+            tf.logging.warning('Failed to save parse tables to %s: %s', filename, e)
+            return False
     
     @property
     def primary_output(self):
         return 'actions'
+
+    def parse_table_memory(self):
+        '''
+        Return the bytes of the parse tables that are mapped from
+        tables_filename (and shared with other processes that map the
+        same file), and the bytes that are private to this process
+        '''
+        return slr_cache.memory_usage(self._parser, self._decoding_tables or ())
+
+    @property
+    def decoding_tables(self):
+        '''
+        The tables that restrict decoding in the bottomup direction to the
+        action sequences of valid programs, as NumPy arrays
+        (see slr.decoding.build_decoding_tables)
+
+        They are only needed for constrained decoding, so they are built
+        the first time they are used, and they are not cached with the
+        parse tables.
+        '''
+        if self._decoding_tables is None:
+            self._decoding_tables = slr_decoding.build_decoding_tables(self._parser.rules, self._parser.dictionary,
+                                                                       self._start_symbol, self._output_terminals)
+        return self._decoding_tables
+
+    def decoding_tables_as_constants(self):
+        '''
+        The same as decoding_tables, as TF constants in the current graph
+        '''
+        return slr_decoding.DecodingTables(*(tf.constant(table, name='grammar_' + name)
+                                             for name, table in zip(slr_decoding.DecodingTables._fields,
+                                                                    self.decoding_tables)))
     
     def is_copy_type(self, output):
         return output.startswith('COPY_')
@@ -0,0 +1,208 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 27, 2018
+
+@author: gcampagn
+'''
+
+import io
+import os
+import json
+import struct
+import hashlib
+
+import numpy as np
+import tensorflow as tf
+
+from .np_parser import ShiftReduceParser
+from .packed import PackedTable, PackedActionTable
+
+# bump this when the generator or the layout of the tables changes
+CACHE_VERSION = 4
+
+# the file starts with MAGIC and the length of the JSON header, then the
+# header, then the raw data of each array, aligned so it can be mapped
+MAGIC = b'GENIESLR'
+PREAMBLE = struct.Struct('<8sQ')
+ALIGNMENT = 64
+
+# if set, the parse tables of every grammar are also kept in this
+# directory, so that all the processes and models that use the same
+# grammar map the same file, see set_shared_cache_dir
+_shared_cache_dir = None
+
+# if False, the parse tables in the cache_dir of each grammar (the model
+# directory) are loaded but never written, see set_model_cache_writable
+_model_cache_writable = True
+
+
+def set_shared_cache_dir(cache_dir):
+    '''
+    Set the directory of parse tables shared by all grammars in this
+    process (or None to disable it).
+    '''
+    global _shared_cache_dir
+    _shared_cache_dir = cache_dir or None
+
+
+def get_shared_cache_dir():
+    return _shared_cache_dir
+
+
+def set_model_cache_writable(writable):
+    '''
+    Set whether grammars can save the parse tables they build in their
+    own cache_dir. The server disables this, because model directories
+    are often read-only or shared across deployments.
+    '''
+    global _model_cache_writable
+    _model_cache_writable = writable
+
+
+def is_model_cache_writable():
+    return _model_cache_writable
+
+
+def hash_grammar(grammar, start_symbol, output_terminals):
+    '''
+    Compute a hash of everything the generator depends on.
+
+    The hash depends on the order of the rules, because that
+    determines the rule IDs.
+    '''
+    canonical = json.dumps([CACHE_VERSION, start_symbol, list(output_terminals),
+                            [[lhs, [list(rule) for rule in rules]] for lhs, rules in grammar.items()]])
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def cache_filename(cache_dir, grammar_hash):
+    return os.path.join(cache_dir, 'slr-tables-v%d-%s.bin' % (CACHE_VERSION, grammar_hash[:16]))
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_parser(filename, parser, grammar_hash):
+    '''
+    Save the tables of parser to filename, atomically.
+    '''
+    arrays = dict(rule_table=parser.rule_table)
+    arrays.update(parser.action_table.to_arrays('action_'))
+    arrays.update(parser.goto_table.to_arrays('goto_'))
+    # the decoding tables (including the packed legal-action masks) are
+    # not stored: they are built lazily from the rules, and only by the
+    # processes that decode with constraints, see
+    # ShiftReduceGrammar.decoding_tables
+
+    layout = dict()
+    offset = 0
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        arrays[name] = array
+        layout[name] = dict(dtype=array.dtype.str, shape=array.shape, offset=offset)
+        offset = _align(offset + array.nbytes)
+
+    symbols = sorted(parser.dictionary, key=parser.dictionary.get)
+    header = json.dumps(dict(version=CACHE_VERSION,
+                             hash=grammar_hash,
+                             rules=[[lhs, list(rhs)] for lhs, rhs in parser.rules],
+                             terminals=parser.terminals,
+                             symbols=symbols,
+                             start_symbol=symbols[parser.start_symbol],
+                             arrays=layout)).encode('utf-8')
+    data_start = _align(PREAMBLE.size + len(header))
+
+    # write to memory first, because GFile is not seekable
+    buffer = io.BytesIO()
+    buffer.write(PREAMBLE.pack(MAGIC, len(header)))
+    buffer.write(header)
+    for name, info in layout.items():
+        buffer.seek(data_start + info['offset'])
+        buffer.write(arrays[name].tobytes())
+    tmp_filename = filename + '.tmp' + str(os.getpid())
+    with tf.gfile.GFile(tmp_filename, 'wb') as fp:
+        fp.write(buffer.getvalue())
+    tf.gfile.Rename(tmp_filename, filename, overwrite=True)
+
+
+def _is_local(filename):
+    return '://' not in filename
+
+
+def load_parser(filename, grammar_hash):
+    '''
+    Load the parser saved in filename, or return None if the file does not
+    exist or it was saved for a different grammar.
+
+    Local files are mapped read-only, so processes that load the same
+    file share its pages; remote files are read into memory.
+    '''
+    if not tf.gfile.Exists(filename):
+        return None
+
+    try:
+        with tf.gfile.GFile(filename, 'rb') as fp:
+            magic, header_length = PREAMBLE.unpack(fp.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError('not a parse table file')
+            metadata = json.loads(fp.read(header_length).decode('utf-8'))
+            if metadata['version'] != CACHE_VERSION or metadata['hash'] != grammar_hash:
+                return None
+        if _is_local(filename):
+            data = np.memmap(filename, dtype=np.uint8, mode='r')
+        else:
+            with tf.gfile.GFile(filename, 'rb') as fp:
+                data = np.frombuffer(fp.read(), dtype=np.uint8)
+
+        data_start = _align(PREAMBLE.size + header_length)
+        arrays = dict()
+        for name, info in metadata['arrays'].items():
+            dtype = np.dtype(info['dtype'])
+            shape = tuple(info['shape'])
+            start = data_start + info['offset']
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            if start + nbytes > len(data):
+                raise ValueError('truncated parse table file')
+            arrays[name] = data[start:start + nbytes].view(dtype).reshape(shape)
+
+        rules = [(lhs, tuple(rhs)) for lhs, rhs in metadata['rules']]
+        dictionary = dict((symbol, i) for i, symbol in enumerate(metadata['symbols']))
+        return ShiftReduceParser(rules, arrays['rule_table'],
+                                 PackedActionTable.from_arrays(arrays, 'action_'),
+                                 PackedTable.from_arrays(arrays, 'goto_'),
+                                 metadata['terminals'], dictionary, dictionary[metadata['start_symbol']])
+    except (IOError, ValueError, KeyError, struct.error, tf.errors.OpError) as e:
+        tf.logging.warning('Ignoring invalid parser cache %s: %s', filename, e)
+        return None
+
+
+def memory_usage(parser, extra_arrays=()):
+    '''
+    Return the bytes of the arrays of parser (and of extra_arrays) that are
+    mapped from a file (and can be shared with other processes), and the
+    bytes that are private to this process
+    '''
+    arrays = [parser.rule_table]
+    for table in (parser.action_table, parser.goto_table):
+        # the shape is in the header of the file, not in the data
+        arrays += [array for name, array in table.to_arrays('').items() if name != 'shape']
+    arrays += list(extra_arrays)
+    mapped = sum(array.nbytes for array in arrays if isinstance(array, np.memmap))
+    private = sum(array.nbytes for array in arrays if not isinstance(array, np.memmap))
+    return mapped, private
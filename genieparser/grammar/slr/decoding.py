@@ -0,0 +1,207 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 26, 2018
+
+@author: gcampagn
+'''
+
+from collections import defaultdict, deque, namedtuple
+
+import numpy as np
+
+from ..slr import EOF_ID, START_ID
+
+ViablePrefixAutomaton = namedtuple('ViablePrefixAutomaton', ('goto', 'reducible', 'accepting', 'rule_lengths'))
+DecodingTables = namedtuple('DecodingTables', ('goto', 'legal_bits', 'pop', 'push'))
+
+BITS_PER_WORD = 32
+
+
+def pack_bits(mask):
+    '''
+    Pack the last axis of a boolean array into int32 words, where
+    bit i % 32 of word i // 32 is mask[..., i]
+    '''
+    num_words = (mask.shape[-1] + BITS_PER_WORD - 1) // BITS_PER_WORD
+    padded = np.zeros(mask.shape[:-1] + (num_words * BITS_PER_WORD,), dtype=np.uint32)
+    padded[..., :mask.shape[-1]] = mask
+    padded = padded.reshape(mask.shape[:-1] + (num_words, BITS_PER_WORD))
+    words = np.bitwise_or.reduce(padded << np.arange(BITS_PER_WORD, dtype=np.uint32), axis=-1)
+    return words.astype(np.uint32).view(np.int32)
+
+
+def unpack_bits(words, size):
+    '''
+    The inverse of pack_bits: unpack int32 words into a boolean
+    array with size elements on the last axis
+    '''
+    words = np.asarray(words).view(np.uint32)
+    bits = (words[..., np.newaxis] >> np.arange(BITS_PER_WORD, dtype=np.uint32)) & 1
+    return bits.reshape(words.shape[:-1] + (-1,))[..., :size].astype(np.bool_)
+
+
+def build_viable_prefix_automaton(rules, dictionary, start_symbol, visible_terminals):
+    '''
+    Build the LR(0) automaton of the grammar, after removing all terminals
+    except visible_terminals from every rule.
+
+    The bottom-up action sequences generated by ShiftReduceGrammar only
+    include the shifts of extensible and copy terminals, so the parse tables
+    (which need every shift) cannot follow them. The states of this automaton
+    recognize the viable prefixes of the action sequences instead: a decoder
+    that keeps a stack of states can check if an action is legal by looking
+    at the top of the stack only, and it can always complete a legal prefix
+    to a full program.
+
+    The grammar without the omitted terminals can have empty rules and
+    conflicts, which is fine because we never need to choose between
+    actions, only to know which ones are legal.
+
+    Returns a ViablePrefixAutomaton, with:
+        - goto: the next state for each state and symbol (using the IDs in
+          dictionary), of shape (num_states+1, num_symbols); the last state
+          is a dead state, reached after an illegal transition
+        - reducible: whether each rule can be reduced in each state, of
+          shape (num_states+1, num_rules)
+        - accepting: whether the stack holds a complete program in each state,
+          of shape (num_states+1,)
+        - rule_lengths: the number of symbols that each rule pops from the
+          stack, of shape (num_rules,)
+    '''
+
+    num_symbols = max(dictionary.values()) + 1
+    projected = []
+    for lhs, rhs in rules:
+        projected.append(tuple(dictionary[symbol] for symbol in rhs
+                               if symbol[0] == '$' or symbol in visible_terminals))
+    rules_by_lhs = defaultdict(list)
+    for rule_id, (lhs, _) in enumerate(rules):
+        rules_by_lhs[dictionary[lhs]].append(rule_id)
+
+    # the pseudo-rule $ROOT -> start_symbol, which is reduced
+    # when the program is complete
+    root_rule_id = len(projected)
+    projected.append((dictionary[start_symbol],))
+
+    def close(kernel):
+        items = set(kernel)
+        stack = list(kernel)
+        while stack:
+            rule_id, dot = stack.pop()
+            rhs = projected[rule_id]
+            if dot < len(rhs) and rhs[dot] in rules_by_lhs:
+                for new_rule_id in rules_by_lhs[rhs[dot]]:
+                    new_item = (new_rule_id, 0)
+                    if new_item not in items:
+                        items.add(new_item)
+                        stack.append(new_item)
+        return items
+
+    initial_kernel = frozenset([(root_rule_id, 0)])
+    state_ids = { initial_kernel: 0 }
+    transitions = []
+    completed = []
+    queue = deque([initial_kernel])
+    while queue:
+        kernel = queue.popleft()
+        next_kernels = defaultdict(set)
+        my_completed = []
+        for rule_id, dot in close(kernel):
+            rhs = projected[rule_id]
+            if dot == len(rhs):
+                my_completed.append(rule_id)
+            else:
+                next_kernels[rhs[dot]].add((rule_id, dot+1))
+
+        my_transitions = dict()
+        for symbol, next_kernel in next_kernels.items():
+            next_kernel = frozenset(next_kernel)
+            if next_kernel not in state_ids:
+                state_ids[next_kernel] = len(state_ids)
+                queue.append(next_kernel)
+            my_transitions[symbol] = state_ids[next_kernel]
+        transitions.append(my_transitions)
+        completed.append(my_completed)
+
+    num_states = len(transitions)
+    dead_state = num_states
+    goto = np.full((num_states+1, num_symbols), dead_state, dtype=np.int32)
+    reducible = np.zeros((num_states+1, len(rules)), dtype=np.bool_)
+    accepting = np.zeros((num_states+1,), dtype=np.bool_)
+    for state, (my_transitions, my_completed) in enumerate(zip(transitions, completed)):
+        for symbol, next_state in my_transitions.items():
+            goto[state, symbol] = next_state
+        for rule_id in my_completed:
+            if rule_id == root_rule_id:
+                accepting[state] = True
+            else:
+                reducible[state, rule_id] = True
+
+    rule_lengths = np.array([len(rhs) for rhs in projected[:-1]], dtype=np.int32)
+    return ViablePrefixAutomaton(goto, reducible, accepting, rule_lengths)
+
+
+def build_decoding_tables(rules, dictionary, start_symbol, output_terminals):
+    '''
+    Build the tables that restrict decoding to the bottom-up action
+    sequences of valid programs.
+
+    The action space is the one of ShiftReduceGrammar: the control tokens
+    (pad, accept and start), one reduce action for each rule, then one shift
+    action for each of output_terminals (the copy terminals, followed by
+    the extensible terminals).
+
+    The decoder keeps a stack of states, starting from state 0. Each action
+    pops pop[action] states from the stack, then pushes the state in goto
+    for the new top of the stack and the column push[action], unless that
+    is -1. legal_bits[state] is the mask of actions allowed when state is
+    at the top of the stack, packed with pack_bits.
+
+    goto only has a column for each symbol that an action can push (the
+    non-terminals and output_terminals), instead of one for every symbol
+    of the grammar, and push holds the column of the symbol, not its ID.
+    '''
+    automaton = build_viable_prefix_automaton(rules, dictionary, start_symbol, set(output_terminals))
+
+    num_states = len(automaton.goto)
+    dead_state = num_states - 1
+    first_rule = START_ID + 1
+    first_shift = first_rule + len(rules)
+    num_actions = first_shift + len(output_terminals)
+
+    legal = np.zeros((num_states, num_actions), dtype=np.bool_)
+    pop = np.zeros((num_actions,), dtype=np.int32)
+    # pad, accept and start do not change the stack
+    push = np.full((num_actions,), -1, dtype=np.int32)
+
+    legal[:, EOF_ID] = automaton.accepting
+    legal[:, first_rule:first_shift] = automaton.reducible
+    pop[first_rule:first_shift] = automaton.rule_lengths
+    push[first_rule:first_shift] = [dictionary[lhs] for lhs, _ in rules]
+    for i, term in enumerate(output_terminals):
+        term_id = dictionary[term]
+        legal[:, first_shift + i] = automaton.goto[:, term_id] != dead_state
+        push[first_shift + i] = term_id
+
+    # keep only the columns of goto that can be pushed; the other
+    # terminals of the grammar are never looked up by the decoder
+    is_push = push >= 0
+    columns, push[is_push] = np.unique(push[is_push], return_inverse=True)
+    goto = np.ascontiguousarray(automaton.goto[:, columns])
+
+    return DecodingTables(goto, pack_bits(legal), pop, push)
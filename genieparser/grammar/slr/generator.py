@@ -22,36 +22,19 @@ Created on Nov 30, 2017
 
 import itertools
 import sys
+from collections import OrderedDict, deque
+
 import numpy as np
 
 from ..slr import EOF_TOKEN, PAD_TOKEN, START_TOKEN, \
     PAD_ID, EOF_ID, START_ID, \
     ACCEPT_CODE, SHIFT_CODE, REDUCE_CODE, INVALID_CODE
 from .np_parser import ShiftReduceParser
+from .packed import PackedTable, PackedActionTable
 
 
-class ItemSetInfo:
-    def __init__(self):
-        self.id = 0
-        self.intransitions = set()
-        self.outtransitions = set()
-
-
-class ItemSet:
-    def __init__(self, rules):
-        self.rules = list(rules)
-    def __hash__(self):
-        h = 0
-        for el in self.rules:
-            h ^= hash(el)
-        return h
-    def __eq__(self, other):
-        return self.rules == other.rules
-
 DEBUG = False
 
-ITEM_SET_SEP = ''
-
 
 class SLRParserGenerator():
     '''
@@ -71,7 +54,6 @@ class SLRParserGenerator():
         self._build_first_sets()
         self._build_follow_sets()
         self._generate_all_item_sets()
-        self._build_state_transition_matrix()
         self._build_parse_tables()
         
         self._check_first_sets()
@@ -81,7 +63,9 @@ class SLRParserGenerator():
         # the last rule is $ROOT -> $input <<EOF>>
         # which is a pseudo-rule needed for the SLR generator
         # we ignore it here
-        return ShiftReduceParser(self.rules[:-1], self.rule_table, self.action_table, self.goto_table,
+        return ShiftReduceParser(self.rules[:-1], self.rule_table,
+                                 PackedActionTable.from_dense(self.action_table),
+                                 PackedTable.from_dense(self.goto_table, self.goto_table != INVALID_CODE),
                                  self.terminals, self._all_dictionary,
                                  self._all_dictionary[self._start_symbol])
     
@@ -216,96 +200,77 @@ class SLRParserGenerator():
                 if DEBUG:
                     print(rule_id, lhs, '->', rule)
 
-    def _item_set_followers(self, item_set):
-        for rule in item_set.rules:
-            _, rhs = rule
-            for i in range(len(rhs)-1):
-                if rhs[i] == ITEM_SET_SEP and rhs[i+1] != EOF_TOKEN:
-                    yield rhs[i+1]
+    def _index_rules(self):
+        # for each non-terminal, the rules that are added (with the dot
+        # at the beginning) when closing an item with that non-terminal
+        # after the dot, directly or through other non-terminals
+        self._closures = dict()
+        for nonterm in self.grammar:
+            closure = set()
+            stack = [nonterm]
+            visited = { nonterm }
+            while stack:
+                for rule_id in self.grammar[stack.pop()]:
+                    closure.add(rule_id)
+                    _, rhs = self.rules[rule_id]
+                    if rhs and rhs[0][0] == '$' and rhs[0] not in visited:
+                        visited.add(rhs[0])
+                        stack.append(rhs[0])
+            self._closures[nonterm] = frozenset((rule_id, 0) for rule_id in closure)
+
+    def _close(self, kernel):
+        item_set = set(kernel)
+        for rule_id, dot in kernel:
+            _, rhs = self.rules[rule_id]
+            if dot < len(rhs) and rhs[dot][0] == '$':
+                item_set |= self._closures[rhs[dot]]
+        return sorted(item_set)
 
-    def _advance(self, item_set, token):
-        for rule in item_set.rules:
-            rule_id, rhs = rule
-            for i in range(len(rhs)-1):
-                if rhs[i] == ITEM_SET_SEP and rhs[i+1] == token:
-                    yield rule_id, (rhs[:i] + (token, ITEM_SET_SEP) + rhs[i+2:])
-                    break
-        
-    def _make_item_set(self, lhs):
-        for rule_id in self.grammar[lhs]:
-            lhs, rhs = self.rules[rule_id]
-            yield rule_id, (ITEM_SET_SEP,) + rhs
-    
-    def _close(self, items):
-        def _is_nonterminal(symbol):
-            return symbol[0] == '$'
-        
-        item_set = set(items)
-        stack = list(item_set)
-        while len(stack) > 0:
-            item = stack.pop()
-            _, rhs = item
-            for i in range(len(rhs)-1):
-                if rhs[i] == ITEM_SET_SEP and _is_nonterminal(rhs[i+1]):
-                    for new_rule in self._make_item_set(rhs[i+1]):
-                        if new_rule in item_set:
-                            continue
-                        item_set.add(new_rule)
-                        stack.append(new_rule)
-                    break
-        item_set = list(item_set)
-        item_set.sort()
-        return item_set
-    
     def _generate_all_item_sets(self):
-        item_sets = dict()
-        i = 0
-        item_set0 = ItemSet(self._close(self._make_item_set('$ROOT')))
-        item_set0_info = ItemSetInfo()
-        item_sets[item_set0] = item_set0_info
-        i += 1
-        queue = []
-        queue.append(item_set0)
-        while len(queue) > 0:
-            item_set = queue.pop(0)
-            my_info = item_sets[item_set]
-            for next_token in self._item_set_followers(item_set):
-                new_set = ItemSet(self._close(self._advance(item_set, next_token)))
-                if new_set in item_sets:
-                    info = item_sets[new_set]
-                else:
-                    info = ItemSetInfo()
-                    info.id = i
-                    i += 1
-                    item_sets[new_set] = info
-                    queue.append(new_set)
-                info.intransitions.add((my_info.id, next_token))
-                my_info.outtransitions.add((info.id, next_token))
-        
-        for item_set, info in item_sets.items():
-            item_set.info = info
-            if DEBUG:
-                print("Item Set", item_set.info.id, item_set.info.intransitions)
-                for rule in item_set.rules:
-                    rule_id, rhs = rule
-                    lhs, _ = self.rules[rule_id]
-                    print(rule_id, lhs, '->', rhs)
-                print()
-            
-        item_set_list = [None] * len(item_sets.keys())
-        for item_set in item_sets.keys():
-            item_set_list[item_set.info.id] = item_set
-        self._item_sets = item_set_list
+        # items are (rule_id, dot) pairs; states are identified by their
+        # kernel, because the closure of a kernel is unique, and states
+        # are numbered in the order they are discovered
+        self._index_rules()
+
+        root_kernel = frozenset((rule_id, 0) for rule_id in self.grammar['$ROOT'])
+        kernels = { root_kernel: 0 }
+        self._item_sets = []
+        self._state_transition_matrix = []
+        queue = deque([root_kernel])
+        while queue:
+            items = self._close(queue.popleft())
+            self._item_sets.append(items)
+
+            # the kernels of the next states, in the order the symbols
+            # first appear after the dot
+            next_kernels = OrderedDict()
+            for rule_id, dot in items:
+                _, rhs = self.rules[rule_id]
+                if dot < len(rhs) and rhs[dot] != EOF_TOKEN:
+                    if rhs[dot] not in next_kernels:
+                        next_kernels[rhs[dot]] = []
+                    next_kernels[rhs[dot]].append((rule_id, dot+1))
+
+            transitions = dict()
+            for next_token, next_kernel in next_kernels.items():
+                next_kernel = frozenset(next_kernel)
+                if next_kernel not in kernels:
+                    kernels[next_kernel] = len(kernels)
+                    queue.append(next_kernel)
+                transitions[next_token] = kernels[next_kernel]
+            self._state_transition_matrix.append(transitions)
+
         self._n_states = len(self._item_sets)
-    
-    def _build_state_transition_matrix(self):
-        self._state_transition_matrix = [dict() for  _ in range(self._n_states)]
-        
-        for item_set in self._item_sets:
-            for next_id, next_token in item_set.info.outtransitions:
-                if next_token in self._state_transition_matrix[item_set.info.id]:
-                    raise ValueError("Ambiguous transition from", item_set.info.id, "through", next_token, "to", self._state_transition_matrix[item_set.info.id], "and", next_id)
-                self._state_transition_matrix[item_set.info.id][next_token] = next_id
+        if DEBUG:
+            for state_id in range(self._n_states):
+                self._print_item_set(state_id)
+
+    def _print_item_set(self, state_id):
+        print("Item Set", state_id)
+        for rule_id, dot in self._item_sets[state_id]:
+            lhs, rhs = self.rules[rule_id]
+            print(rule_id, lhs, '->', ' '.join(rhs[:dot] + ('.',) + rhs[dot:]))
+        print()
                 
     def _build_first_sets(self):
         def _is_terminal(symbol):
@@ -377,64 +342,98 @@ class SLRParserGenerator():
                 print(nonterm, "->", follow_set)
             
     def _build_parse_tables(self):
+        # the legal-action masks used for constrained decoding are not built
+        # here: they are in the action space of ShiftReduceGrammar, which
+        # depends on its output terminals, and they come from a different
+        # automaton (see slr.decoding.build_decoding_tables)
+        # ShiftReduceGrammar builds them from the rules the first time they
+        # are used, because only constrained decoding needs them; building
+        # them for every grammar, and storing them in every cache file, is
+        # wasted for the processes that only parse
+        num_terminals = len(self.terminals)
         self.goto_table = np.full(fill_value=INVALID_CODE,
                                   shape=(self._n_states, len(self.non_terminals)),
                                   dtype=np.int32)
         self.action_table = np.full(fill_value=INVALID_CODE,
-                                    shape=(self._n_states, len(self.terminals) + len(self.non_terminals), 2),
+                                    shape=(self._n_states, num_terminals + len(self.non_terminals), 2),
                                     dtype=np.int32)
         
         self.rule_table = np.empty(shape=(len(self.rules),2), dtype=np.int32)
-        for rule_id, (lhs, rhs) in enumerate(self.rules):
-            self.rule_table[rule_id, 0] = self._all_dictionary[lhs] - len(self.terminals)
-            self.rule_table[rule_id, 1] = len(rhs)
-        
-        for nonterm_id, nonterm in enumerate(self.non_terminals):
-            for i in range(self._n_states):
-                if nonterm in self._state_transition_matrix[i]:
-                    self.goto_table[i, nonterm_id] = self._state_transition_matrix[i][nonterm]
-        for term in self.terminals:
-            for i in range(self._n_states):
-                if term in self._state_transition_matrix[i]:
-                    term_id = self.dictionary[term]
-                    self.action_table[i, term_id, 0] = SHIFT_CODE
-                    self.action_table[i, term_id, 1] = self._state_transition_matrix[i][term]
-                    
-        for item_set in self._item_sets:
-            for item in item_set.rules:
-                _, rhs = item
-                for i in range(len(rhs)-1):
-                    if rhs[i] == ITEM_SET_SEP and rhs[i+1] == EOF_TOKEN:
-                        self.action_table[item_set.info.id, EOF_ID, 0] = ACCEPT_CODE
-                        self.action_table[item_set.info.id, EOF_ID, 1] = INVALID_CODE
-        
-        for item_set in self._item_sets:
-            for item in item_set.rules:
-                rule_id, rhs = item
-                if rhs[-1] != ITEM_SET_SEP:
-                    continue
-                lhs, _ = self.rules[rule_id]
-                for term_id, term in enumerate(self.terminals):
-                    if term in self._follow_sets.get(lhs, set()):
-                        if self.action_table[item_set.info.id, term_id, 0] != INVALID_CODE \
-                         and not (self.action_table[item_set.info.id, term_id, 0] == REDUCE_CODE and
-                                  self.action_table[item_set.info.id, term_id, 1] == rule_id):
-                            print("Item Set", item_set.info.id, item_set.info.intransitions)
-                            for rule in item_set.rules:
-                                loop_rule_id, rhs = rule
-                                lhs, _ = self.rules[loop_rule_id]
-                                print(loop_rule_id, lhs, '->', rhs)
-                            print()
-                            #if self.action_table[item_set.info.id][term][0] == 'shift':
-                            #    jump_set = self._item_sets[self.action_table[item_set.info.id][term][1]]
-                            #    print("Item Set", jump_set.info.id, jump_set.info.intransitions)
-                            #    for rule in jump_set.rules:
-                            #        loop_rule_id, rhs = rule
-                            #        lhs, _ = self.rules[loop_rule_id]
-                            #        print(loop_rule_id, lhs, '->', rhs)
-                            #    print()
-                            
-                            raise ValueError("Conflict for state", item_set.info.id, "terminal", term, "want", ("reduce", rule_id), "have", self.action_table[item_set.info.id, term_id])
-                        self.action_table[item_set.info.id, term_id, 0] = REDUCE_CODE
-                        self.action_table[item_set.info.id, term_id, 1] = rule_id
+        self.rule_table[:, 0] = [self._all_dictionary[lhs] - num_terminals for lhs, _ in self.rules]
+        self.rule_table[:, 1] = [len(rhs) for _, rhs in self.rules]
+
+        # the transitions, as (state, symbol, next state) lists
+        from_states = []
+        symbols = []
+        to_states = []
+        for state_id, transitions in enumerate(self._state_transition_matrix):
+            for symbol, next_state in transitions.items():
+                from_states.append(state_id)
+                symbols.append(self._all_dictionary[symbol])
+                to_states.append(next_state)
+        from_states = np.array(from_states, dtype=np.int32)
+        symbols = np.array(symbols, dtype=np.int32)
+        to_states = np.array(to_states, dtype=np.int32)
+
+        is_shift = symbols < num_terminals
+        is_goto = ~is_shift
+        self.goto_table[from_states[is_goto], symbols[is_goto] - num_terminals] = to_states[is_goto]
+        self.action_table[from_states[is_shift], symbols[is_shift], 0] = SHIFT_CODE
+        self.action_table[from_states[is_shift], symbols[is_shift], 1] = to_states[is_shift]
+
+        # the terminals in the follow set of each non-terminal, as sorted IDs
+        follow_ids = dict()
+        for lhs, follow_set in self._follow_sets.items():
+            follow_ids[lhs] = np.array(sorted(self.dictionary[term] for term in follow_set
+                                              if term in self.dictionary), dtype=np.int32)
+        no_follow = np.zeros((0,), dtype=np.int32)
+
+        # the completed items, which reduce on every terminal in the follow set of their lhs
+        accept_states = []
+        reduce_states = []
+        reduce_rules = []
+        reduce_terminals = []
+        for state_id, items in enumerate(self._item_sets):
+            for rule_id, dot in items:
+                lhs, rhs = self.rules[rule_id]
+                if dot == len(rhs):
+                    reduce_states.append(state_id)
+                    reduce_rules.append(rule_id)
+                    reduce_terminals.append(follow_ids.get(lhs, no_follow))
+                elif rhs[dot] == EOF_TOKEN:
+                    accept_states.append(state_id)
+        self.action_table[accept_states, EOF_ID, 0] = ACCEPT_CODE
+        self.action_table[accept_states, EOF_ID, 1] = INVALID_CODE
+
+        counts = [len(terminals) for terminals in reduce_terminals]
+        reduce_states = np.repeat(np.array(reduce_states, dtype=np.int32), counts)
+        reduce_rules = np.repeat(np.array(reduce_rules, dtype=np.int32), counts)
+        reduce_terminals = np.concatenate(reduce_terminals) if reduce_terminals else no_follow
+
+        # a reduce conflicts with a shift or accept in the same cell, or with
+        # the reduce of a different rule (each completed item appears once, so
+        # two reduces in the same cell are always for different rules)
+        conflicts = self.action_table[reduce_states, reduce_terminals, 0] != INVALID_CODE
+        _, first_reduces = np.unique(reduce_states.astype(np.int64) * num_terminals + reduce_terminals,
+                                     return_index=True)
+        duplicates = np.ones_like(conflicts)
+        duplicates[first_reduces] = False
+        if np.any(conflicts | duplicates):
+            self._report_conflict(reduce_states, reduce_rules, reduce_terminals, conflicts | duplicates)
+
+        self.action_table[reduce_states, reduce_terminals, 0] = REDUCE_CODE
+        self.action_table[reduce_states, reduce_terminals, 1] = reduce_rules
 
+    def _report_conflict(self, reduce_states, reduce_rules, reduce_terminals, conflicts):
+        # report the first conflict, in the same order as the reduces are added
+        i = np.argmax(conflicts)
+        state_id = reduce_states[i]
+        term_id = reduce_terminals[i]
+        same_cell = (reduce_states[:i] == state_id) & (reduce_terminals[:i] == term_id)
+        if np.any(same_cell):
+            have = np.array([REDUCE_CODE, reduce_rules[:i][same_cell][0]], dtype=np.int32)
+        else:
+            have = self.action_table[state_id, term_id]
+        self._print_item_set(state_id)
+        raise ValueError("Conflict for state", int(state_id), "terminal", self.terminals[term_id],
+                         "want", ("reduce", int(reduce_rules[i])), "have", have)
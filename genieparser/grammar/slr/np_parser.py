@@ -29,6 +29,9 @@ class ShiftReduceParser:
     '''
     A bottom-up parser for a deterministic CFG language, based on shift-reduce
     tables.
+
+    The action table is a PackedActionTable and the goto table is a
+    PackedTable (see slr.packed).
     
     The parser can transform a string in the language to a sequence of
     shifts and reduces, and can transform a valid sequence of reduces to
@@ -54,7 +57,19 @@ class ShiftReduceParser:
     
     @property
     def num_states(self):
-        return len(self._action_table)
+        return self._action_table.shape[0]
+
+    @property
+    def action_table(self):
+        return self._action_table
+
+    @property
+    def goto_table(self):
+        return self._goto_table
+
+    @property
+    def start_symbol(self):
+        return self._start_symbol
     
     def parse_reverse(self, sequence):
         bottom_up_sequence = self.parse(sequence)
@@ -92,14 +107,14 @@ class ShiftReduceParser:
         sequence_iter = iter(sequence)
         terminal_id, token = next(sequence_iter)
         while True:
-            if self._action_table[state, terminal_id, 0] == INVALID_CODE:
-                expected_token_ids,  = self._action_table[state, :, 0].nonzero()
+            action, param = self._action_table.get(state, terminal_id)
+            if action == INVALID_CODE:
+                expected_token_ids = self._action_table.valid_columns(state)
                 expected_tokens = [self.terminals[i] for i in expected_token_ids]
                 
                 raise ValueError(
                     "Parse error: unexpected token " + self.terminals[terminal_id] + " in state " + str(state) + ", expected " + str(
                         expected_tokens))
-            action, param = self._action_table[state, terminal_id]
             if action == ACCEPT_CODE:
                 return result
             #if action == 'shift':
@@ -122,7 +137,7 @@ class ShiftReduceParser:
                 for _ in range(rhssize):
                     stack.pop()
                 state = stack[-1]
-                state = self._goto_table[state, lhs_id]
+                state = self._goto_table.get(state, lhs_id)
                 stack.append(state)
                 
     def reconstruct_reverse(self, sequence):
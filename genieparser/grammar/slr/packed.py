@@ -0,0 +1,275 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 28, 2018
+
+@author: gcampagn
+'''
+
+import numpy as np
+
+from ..slr import INVALID_CODE, REDUCE_CODE
+
+# the number of entries searched at once for a free displacement, and the
+# number of candidate displacements checked at once when packing a row
+SEARCH_BLOCK = 4096
+SEARCH_WINDOW = 64
+
+
+class PackedTable:
+    '''
+    A sparse 2D table, compressed with row displacement (also known as
+    comb-vector packing, as in yacc and bison).
+
+    Rows with the same content are stored once; rows[i] is the ID of the
+    distinct row used by row i. The valid entries of all the distinct
+    rows are stored in a single vector of values, where distinct row r
+    starts at base[r], and the entries of different rows are interleaved
+    so they never collide. check[base[r] + j] == r if and only if entry
+    (r, j) is valid, so lookups take constant time.
+
+    values can have extra dimensions after the first; an invalid entry
+    reads as INVALID_CODE.
+    '''
+
+    def __init__(self, shape, rows, base, check, values):
+        self.shape = tuple(shape)
+        self.rows = rows
+        self.base = base
+        self.check = check
+        self.values = values
+        self._invalid = np.full(values.shape[1:], INVALID_CODE, dtype=values.dtype)
+
+    @staticmethod
+    def from_dense(dense, valid):
+        '''
+        Pack the table dense, where valid is a boolean mask of the same
+        shape as the first two dimensions of dense
+        '''
+        num_rows, num_columns = valid.shape
+        masked = np.where(valid.reshape(valid.shape + (1,) * (dense.ndim - 2)), dense, INVALID_CODE)
+        distinct, rows = _unique_rows(np.concatenate([valid.reshape(num_rows, -1).astype(dense.dtype),
+                                                      masked.reshape(num_rows, -1)], axis=1))
+        num_distinct = len(distinct)
+        distinct_valid = valid[distinct]
+
+        # pack the densest rows first, so the sparse ones can fill the gaps
+        counts = np.sum(distinct_valid, axis=1)
+        order = np.argsort(-counts, kind='stable')
+        # the vector always has room for a full row after the last
+        # used entry, so the search does not need bound checks
+        occupied = np.zeros((int(np.sum(counts)) + 2 * num_columns,), dtype=np.bool_)
+        base = np.zeros((num_distinct,), dtype=np.int32)
+        first_free = 0
+        end = 0
+        for row in order:
+            columns, = np.nonzero(distinct_valid[row])
+            if len(columns) == 0:
+                continue
+            displacement = _find_displacement(occupied, columns, first_free, end)
+            base[row] = displacement
+            occupied[displacement + columns] = True
+            end = max(end, displacement + columns[-1] + 1)
+            if end + 2 * num_columns > len(occupied):
+                occupied = np.concatenate([occupied, np.zeros_like(occupied)])
+            while occupied[first_free]:
+                first_free += 1
+
+        # the vector always has room for a full row after every base,
+        # so lookups do not need bound checks
+        size = (int(np.max(base)) if num_distinct > 0 else 0) + num_columns
+        check = np.full((size,), -1, dtype=np.int32)
+        values = np.full((size,) + dense.shape[2:], INVALID_CODE, dtype=dense.dtype)
+        row_ids, columns = np.nonzero(distinct_valid)
+        check[base[row_ids] + columns] = row_ids
+        values[base[row_ids] + columns] = dense[distinct[row_ids], columns]
+        return PackedTable(dense.shape, rows, base, check, values)
+
+    def get(self, row, column):
+        row = self.rows[row]
+        index = self.base[row] + column
+        if self.check[index] != row:
+            return self._invalid
+        return self.values[index]
+
+    def valid_columns(self, row):
+        '''
+        Return the columns of the valid entries in row, in order
+        '''
+        distinct = self.rows[row]
+        return np.nonzero(self.check[self.base[distinct]:self.base[distinct] + self.shape[1]] == distinct)[0]
+
+    def to_dense(self):
+        dense = np.full(self.shape, INVALID_CODE, dtype=self.values.dtype)
+        for row in range(self.shape[0]):
+            columns = self.valid_columns(row)
+            dense[row, columns] = self.values[self.base[self.rows[row]] + columns]
+        return dense
+
+    def to_arrays(self, prefix):
+        return {
+            prefix + 'shape': np.array(self.shape, dtype=np.int64),
+            prefix + 'rows': self.rows,
+            prefix + 'base': self.base,
+            prefix + 'check': self.check,
+            prefix + 'values': self.values
+        }
+
+    @staticmethod
+    def from_arrays(arrays, prefix):
+        return PackedTable(tuple(int(x) for x in arrays[prefix + 'shape']), arrays[prefix + 'rows'],
+                           arrays[prefix + 'base'], arrays[prefix + 'check'], arrays[prefix + 'values'])
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.base.nbytes + self.check.nbytes + self.values.nbytes
+
+    @property
+    def dense_nbytes(self):
+        return int(np.prod(self.shape)) * self.values.dtype.itemsize
+
+
+class PackedActionTable:
+    '''
+    The action table of a ShiftReduceParser, compressed.
+
+    In an SLR parser, a state with a completed item reduces it on every
+    terminal in the follow set of its lhs, which makes up most of the
+    entries of the table. For each state, the rule with the most reduce
+    entries is stored as default_rules[state] (or -1), and the terminals
+    it reduces on are stored as one of a few distinct masks in
+    reduce_masks. All other entries (shifts, accept, and the reduces of
+    other rules) are stored in a PackedTable.
+
+    Unlike the default reductions of yacc, this does not change which
+    entries are valid, so errors are detected in the same state as
+    with the full table.
+    '''
+
+    def __init__(self, entries, default_rules, default_masks, reduce_masks):
+        self.entries = entries
+        self.default_rules = default_rules
+        self.default_masks = default_masks
+        self.reduce_masks = reduce_masks
+        self.shape = entries.shape
+
+    @staticmethod
+    def from_dense(action_table):
+        codes = action_table[:, :, 0]
+        params = action_table[:, :, 1]
+        is_reduce = codes == REDUCE_CODE
+
+        # most states reduce at most one rule
+        default_rules = np.max(np.where(is_reduce, params, -1), axis=1).astype(np.int32)
+        min_rules = np.min(np.where(is_reduce, params, np.iinfo(np.int32).max), axis=1)
+        for state in np.nonzero((default_rules >= 0) & (min_rules != default_rules))[0]:
+            rules, counts = np.unique(params[state, is_reduce[state]], return_counts=True)
+            default_rules[state] = rules[np.argmax(counts)]
+        is_default = is_reduce & (params == default_rules[:, np.newaxis])
+
+        distinct, default_masks = _unique_rows(is_default)
+        reduce_masks = is_default[distinct]
+        entries = PackedTable.from_dense(action_table, (codes != INVALID_CODE) & ~is_default)
+        return PackedActionTable(entries, default_rules, default_masks, reduce_masks)
+
+    def get(self, state, terminal_id):
+        '''
+        Return the action and the parameter for terminal_id in state,
+        like action_table[state, terminal_id] with the full table
+        '''
+        # this is PackedTable.get, inlined because it is called for every
+        # action of the parser
+        entries = self.entries
+        row = entries.rows[state]
+        index = entries.base[row] + terminal_id
+        if entries.check[index] == row:
+            return entries.values[index]
+        if self.reduce_masks[self.default_masks[state], terminal_id]:
+            return REDUCE_CODE, self.default_rules[state]
+        return INVALID_CODE, INVALID_CODE
+
+    def valid_columns(self, state):
+        columns = np.union1d(self.entries.valid_columns(state),
+                             np.nonzero(self.reduce_masks[self.default_masks[state]])[0])
+        return columns.astype(np.int64)
+
+    def to_dense(self):
+        dense = self.entries.to_dense()
+        states, terminals = np.nonzero(self.reduce_masks[self.default_masks])
+        dense[states, terminals, 0] = REDUCE_CODE
+        dense[states, terminals, 1] = self.default_rules[states]
+        return dense
+
+    def to_arrays(self, prefix):
+        arrays = self.entries.to_arrays(prefix)
+        arrays[prefix + 'default_rules'] = self.default_rules
+        arrays[prefix + 'default_masks'] = self.default_masks
+        arrays[prefix + 'reduce_masks'] = self.reduce_masks
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays, prefix):
+        return PackedActionTable(PackedTable.from_arrays(arrays, prefix), arrays[prefix + 'default_rules'],
+                                 arrays[prefix + 'default_masks'], arrays[prefix + 'reduce_masks'])
+
+    @property
+    def nbytes(self):
+        return self.entries.nbytes + self.default_rules.nbytes + self.default_masks.nbytes + \
+            self.reduce_masks.nbytes
+
+    @property
+    def dense_nbytes(self):
+        return self.entries.dense_nbytes
+
+
+def _unique_rows(matrix):
+    '''
+    Return the index of the first occurrence of each distinct row of matrix,
+    and for each row the index of its distinct row in the first array
+    '''
+    row_ids = dict()
+    first = []
+    inverse = np.empty((len(matrix),), dtype=np.int32)
+    for i, row in enumerate(np.ascontiguousarray(matrix)):
+        key = row.tobytes()
+        if key not in row_ids:
+            row_ids[key] = len(first)
+            first.append(i)
+        inverse[i] = row_ids[key]
+    return np.array(first, dtype=np.int64), inverse
+
+
+def _find_displacement(occupied, columns, first_free, end):
+    '''
+    Find the first displacement where all columns are free, given
+    that everything after end is free
+    '''
+    for start in range(first_free, end, SEARCH_BLOCK):
+        # start from the displacements that put the first column in a free
+        # entry, then discard those where the next columns are not free, one
+        # column at a time, until there are few enough to check all columns
+        # at once
+        candidates = np.nonzero(~occupied[start:min(start + SEARCH_BLOCK, end)])[0] + (start - columns[0])
+        candidates = candidates[candidates >= 0]
+        for column in columns[1:]:
+            if len(candidates) <= SEARCH_WINDOW:
+                break
+            candidates = candidates[~occupied[candidates + column]]
+        fits, = np.nonzero(~np.any(occupied[candidates[:, np.newaxis] + columns], axis=1))
+        if len(fits) > 0:
+            return int(candidates[fits[0]])
+    return max(end - columns[0], 0)
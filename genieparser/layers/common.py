@@ -498,6 +498,112 @@ def apply_attention(cell_dec, enc_hidden_states, enc_final_state, input_length,
     return cell_dec, enc_final_state
 
 
+def adaptive_decode_length(features, decode_length):
+    """Compute the number of decoding steps from the input length.
+
+    If the features include "max_decode_length" (the maximum program length
+    for each sentence, computed by the serving input function), the batch
+    is decoded for at most as many steps as its longest allowed program.
+
+    Args:
+        features: a map of string to model features.
+        decode_length: the maximum number of decoding steps.
+
+    Returns:
+        A pair of the number of decoding steps for the batch (an integer or
+        a scalar `Tensor`), and the maximum number of steps for each sentence
+        (an integer `Tensor` of shape [batch_size], or None)
+    """
+    max_decode_length = features.get("max_decode_length")
+    if max_decode_length is None:
+        return decode_length, None
+    return tf.minimum(tf.reduce_max(max_decode_length), decode_length), max_decode_length
+
+
+def max_decode_length_from_input(string_input, slope, intercept):
+    """Compute the maximum program length for each sentence.
+
+    Args:
+        string_input: a string `Tensor` of shape [batch_size, input_length],
+          padded with empty strings.
+        slope: the number of decoding steps for each input word.
+        intercept: the number of decoding steps for an empty input.
+
+    Returns:
+        An integer `Tensor` of shape [batch_size], the value of the
+        "max_decode_length" feature.
+    """
+    input_length = tf.reduce_sum(tf.to_int32(tf.not_equal(string_input, '')), axis=1)
+    return tf.to_int32(tf.ceil(slope * tf.to_float(input_length) + intercept))
+
+
+class GrammarConstraint(object):
+    """Restrict decoding to the action sequences of valid programs.
+
+    The constraint keeps a stack of states for each sentence (or beam) in the
+    decoding cache, following the tables from
+    ShiftReduceGrammar.decoding_tables_as_constants(), and masks the logits of
+    the actions that are illegal at the top of the stack.
+    """
+
+    def __init__(self, tables):
+        self._goto, self._legal_bits, self._pop, self._push = tables
+
+    def initial_state(self, batch_size, max_depth):
+        # each action pushes at most one state, so max_depth is
+        # one more than the number of decoding steps
+        stack = tf.zeros([batch_size, max_depth], dtype=tf.int32)
+        depth = tf.ones([batch_size], dtype=tf.int32)
+        return stack, depth
+
+    def _top(self, stack, depth):
+        batch_size = tf.shape(stack)[0]
+        return tf.gather_nd(stack, tf.stack([tf.range(batch_size), depth - 1], axis=1))
+
+    def step(self, stack, depth, actions):
+        """Apply the last decoded action of each sentence to its stack."""
+        actions = tf.to_int32(actions)
+        pop = tf.gather(self._pop, actions)
+        push = tf.gather(self._push, actions)
+
+        # never pop the initial state, even after an illegal action
+        # (which is only possible if all actions are illegal, in the dead state)
+        base = tf.maximum(depth - pop, 1)
+        next_state = tf.gather_nd(self._goto, tf.stack([self._top(stack, base), tf.maximum(push, 0)], axis=1))
+
+        is_push = push >= 0
+        max_depth = tf.shape(stack)[1]
+        base = tf.minimum(base, max_depth - 1)
+        write = tf.logical_and(tf.equal(tf.expand_dims(tf.range(max_depth), axis=0), tf.expand_dims(base, axis=1)),
+                               tf.expand_dims(is_push, axis=1))
+        stack = tf.where(write, tf.tile(tf.expand_dims(next_state, axis=1), [1, max_depth]), stack)
+        depth = tf.where(is_push, base + 1, depth)
+        return stack, depth
+
+    def _legal_actions(self, states, num_actions):
+        # unpack the bitmask: bit j of word i is action 32 * i + j
+        words = tf.gather(self._legal_bits, states)
+        bits = tf.bitwise.bitwise_and(tf.bitwise.right_shift(tf.expand_dims(words, axis=2), tf.range(32)), 1)
+        return tf.reshape(tf.not_equal(bits, 0), [tf.shape(states)[0], -1])[:, :num_actions]
+
+    def mask_logits(self, logits, stack, depth):
+        legal = self._legal_actions(self._top(stack, depth), tf.shape(logits)[1])
+        # use a large negative number rather than -inf, so that the
+        # log probabilities stay finite if no action is legal
+        return tf.where(legal, logits, tf.fill(tf.shape(logits), -1e9))
+
+    def wrap(self, symbols_to_logits_fn):
+        def constrained_symbols_to_logits_fn(ids, i, cache):
+            # the first call sees the initial pad id, which does not
+            # change the stack
+            stack, depth = self.step(cache["grammar_stack"], cache["grammar_depth"], ids[:, -1])
+            logits, cache = symbols_to_logits_fn(ids, i, cache)
+            cache["grammar_stack"] = stack
+            cache["grammar_depth"] = depth
+            return self.mask_logits(logits, stack, depth), cache
+        return constrained_symbols_to_logits_fn
+
+
 def fast_decode(symbols_to_logits_fn,
                 hparams,
                 decode_length,
@@ -508,7 +614,9 @@ def fast_decode(symbols_to_logits_fn,
                 eos_id=beam_search.EOS_ID,
                 batch_size=None,
                 force_decode_length=False,
-                cache=None):
+                cache=None,
+                max_decode_lengths=None,
+                constraint=None):
     """Given encoder output and a symbols to logits function, does fast decoding.
 
     Implements both greedy and beam search decoding, uses beam search iff
@@ -531,6 +639,12 @@ def fast_decode(symbols_to_logits_fn,
         batch_size: an integer scalar - must be passed if there is no input
         force_decode_length: bool, whether to force the full decode length, or if
           False, stop when all beams hit eos_id.
+        max_decode_lengths: an optional integer `Tensor` of shape [batch_size],
+          the maximum number of steps for each sentence. Greedy decoding stops
+          when every sentence hit eos_id or its own maximum, and pads the
+          sentences that finished earlier.
+        constraint: an optional `GrammarConstraint`, to only decode
+          valid programs.
 
     Returns:
         A dict of decoding results {
@@ -545,6 +659,10 @@ def fast_decode(symbols_to_logits_fn,
       NotImplementedError: If beam size > 1 with partial targets.
     """
 
+    if constraint is not None:
+        cache["grammar_stack"], cache["grammar_depth"] = constraint.initial_state(batch_size, decode_length + 1)
+        symbols_to_logits_fn = constraint.wrap(symbols_to_logits_fn)
+
     if beam_size > 1:  # Beam Search
         initial_ids = tf.zeros([batch_size], dtype=tf.int32)
         decoded_ids, scores, cache = beam_search.beam_search(
@@ -573,11 +691,19 @@ def fast_decode(symbols_to_logits_fn,
             temperature = (0.0 if hparams.sampling_method == "argmax" else
                            hparams.sampling_temp)
             next_id = common_layers.sample_with_temperature(logits, temperature)
+
+            # sentences that finished in an earlier step (at EOS or at their
+            # own limit) only decode padding, and their score does not change,
+            # so that it does not depend on the other sentences in the batch
+            finished = hit_eos
+            next_id = tf.where(finished, tf.zeros_like(next_id), next_id)
             hit_eos |= tf.equal(next_id, eos_id)
+            if max_decode_lengths is not None:
+                hit_eos |= tf.greater_equal(i + 1, max_decode_lengths)
 
             log_prob_indices = tf.stack(
                 [tf.range(tf.to_int64(batch_size)), next_id], axis=1)
-            log_prob += tf.gather_nd(log_probs, log_prob_indices)
+            log_prob += tf.gather_nd(log_probs, log_prob_indices) * tf.to_float(tf.logical_not(finished))
 
             next_id = tf.expand_dims(next_id, axis=1)
             decoded_ids = tf.concat([decoded_ids, next_id], axis=1)
@@ -609,6 +735,9 @@ def fast_decode(symbols_to_logits_fn,
             ])
         scores = log_prob
 
+    if constraint is not None:
+        del cache["grammar_stack"]
+        del cache["grammar_depth"]
     cache["outputs"] = decoded_ids
     cache["scores"] = scores
 
@@ -30,6 +30,13 @@ def common_genie_extra_hparams(hp):
     hp.add_hparam("use_margin_loss", False)
     hp.add_hparam("train_input_embeddings", False)
     hp.add_hparam("pointer_layer", "attentive")
+    # at serving time, decode at most slope * input length + intercept actions
+    # for each sentence (see scripts/fit_decode_length.py); 0 disables the limit
+    hp.add_hparam("decode_length_slope", 0.0)
+    hp.add_hparam("decode_length_intercept", 0.0)
+    # at inference time, only decode the action sequences of valid programs
+    # (requires the bottomup grammar direction)
+    hp.add_hparam("grammar_constrained_decoding", False)
 
 def transformer_genie_extra_hparams(hp):
     hp.set_hparam("num_hidden_layers", 2)
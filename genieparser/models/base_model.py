@@ -49,6 +49,8 @@ from tensor2tensor.utils.optimize import log_variable_sizes, \
 from tensor2tensor.utils.t2t_model import _remove_summaries, \
     log_info, log_warn, set_custom_getter_compose
 
+from ..layers import common
+
 FLAGS = tf.flags.FLAGS
 
 class LUINetModel(T2TModel):
@@ -59,6 +61,17 @@ class LUINetModel(T2TModel):
     All models in LUINet should inherit from LUINetModel
     '''
     
+    def _grammar_constraint(self):
+        """The GrammarConstraint to use when decoding, or None if
+        grammar_constrained_decoding is off."""
+        hparams = self._hparams
+        if not hparams.grammar_constrained_decoding:
+            return None
+        if hparams.grammar_direction != "bottomup":
+            raise ValueError("Grammar-constrained decoding requires the bottomup grammar direction")
+        grammar = hparams.problem.get_grammar(hparams.data_dir)
+        return common.GrammarConstraint(grammar.decoding_tables_as_constants())
+
     @property
     def _target_modality_is_real(self):
         """Whether the target modality is real-valued."""
@@ -364,6 +364,7 @@ class CopySeq2SeqModel(LUINetModel):
         inputs = features["inputs"]
         s = common_layers.shape_list(inputs)
         batch_size = s[0]
+        decode_length, max_decode_lengths = common.adaptive_decode_length(features, decode_length)
         
         # _shard_features called to ensure that the variable names match
         inputs = self._shard_features({"inputs": inputs})["inputs"]
@@ -486,7 +487,9 @@ class CopySeq2SeqModel(LUINetModel):
             alpha=alpha,
             batch_size=batch_size,
             force_decode_length=self._decode_hparams.force_decode_length,
-            cache=cache)
+            cache=cache,
+            max_decode_lengths=max_decode_lengths,
+            constraint=self._grammar_constraint())
         infer_out.update(ret)
         
         new_outputs = dict()
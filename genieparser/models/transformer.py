@@ -59,7 +59,9 @@ def fast_decode(encoder_output,
                 eos_id=beam_search.EOS_ID,
                 batch_size=None,
                 force_decode_length=False,
-                cache=None):
+                cache=None,
+                max_decode_lengths=None,
+                constraint=None):
     """Given encoder output and a symbols to logits function, does fast decoding.
 
     Implements both greedy and beam search decoding, uses beam search iff
@@ -82,6 +84,10 @@ def fast_decode(encoder_output,
         batch_size: an integer scalar - must be passed if there is no input
         force_decode_length: bool, whether to force the full decode length, or if
           False, stop when all beams hit eos_id.
+        max_decode_lengths: an optional integer `Tensor` of shape [batch_size],
+          the maximum number of steps for each sentence.
+        constraint: an optional `common.GrammarConstraint`, to only decode
+          valid programs.
 
     Returns:
         A dict of decoding results {
@@ -138,7 +144,9 @@ def fast_decode(encoder_output,
     return common.fast_decode(symbols_to_logits_fn, hparams, decode_length,
                               vocab_size, beam_size, top_beams,
                               alpha, eos_id, batch_size,
-                              force_decode_length, cache)
+                              force_decode_length, cache,
+                              max_decode_lengths=max_decode_lengths,
+                              constraint=constraint)
 
 
 @registry.register_model("genie_transformer")
@@ -280,6 +288,7 @@ class Transformer(OriginalTransformer, LUINetModel):
                 decode_length = (
                     common_layers.shape_list(inputs)[1] + features.get(
                         "decode_length", decode_length))
+            decode_length, max_decode_lengths = common.adaptive_decode_length(features, decode_length)
     
             # TODO(llion): Clean up this reshaping logic.
             inputs = tf.expand_dims(inputs, axis=1)
@@ -307,6 +316,7 @@ class Transformer(OriginalTransformer, LUINetModel):
             # The problem has no inputs.
             encoder_output = None
             encoder_decoder_attention_bias = None
+            max_decode_lengths = None
     
             # Prepare partial targets.
             # In either features["inputs"] or features["targets"].
@@ -421,7 +431,9 @@ class Transformer(OriginalTransformer, LUINetModel):
             alpha=alpha,
             batch_size=batch_size,
             force_decode_length=self._decode_hparams.force_decode_length,
-            cache=cache)
+            cache=cache,
+            max_decode_lengths=max_decode_lengths,
+            constraint=self._grammar_constraint())
         infer_out.update(ret)
         if "cache" in ret:
             infer_out.update(ret["cache"])
@@ -21,9 +21,12 @@ Created on Mar 1, 2018
 '''
 
 import tornado.web
+import tornado.gen
 
 import tensorflow as tf
 
+from .metrics import render_snapshots
+
 
 class BaseAdminHandler(tornado.web.RequestHandler):
     def check_authenticated(self):
@@ -36,19 +39,84 @@ class BaseAdminHandler(tornado.web.RequestHandler):
 
 
 class ReloadHandler(BaseAdminHandler):
+    @tornado.gen.coroutine
     def post(self, locale='en-US', model_tag=None, **kw):
         self.check_authenticated()
-        language = self.application.get_language(locale, model_tag)
-        self.application.reload_language(language.language_tag, language.model_tag)
-        self.write(dict(result='ok'))
+        # this does not load the model if it is not loaded yet
+        language_tag, model_tag = self.application.resolve_language(locale, model_tag)
+        self.application.broadcast('reload', language_tag=language_tag, model_tag=model_tag)
+        stats = yield self.application.reload_language(language_tag, model_tag)
+        self.write(dict(result='ok', **stats))
         self.finish()
 
 
 class ExactMatcherReload(BaseAdminHandler):
     def post(self, locale='en-US', model_tag=None, **kw):
         self.check_authenticated()
-        language = self.application.get_language(locale, model_tag)
-        tf.logging.info('Reloading exact matches for %s', language.tag)
-        language.exact.load()
+        language_tag, model_tag = self.application.resolve_language(locale, model_tag)
+        self.application.reload_exact_matches(language_tag, model_tag)
+        self.application.broadcast('exact_reload', language_tag=language_tag, model_tag=model_tag)
         self.write(dict(result='ok'))
-        self.finish()
\ No newline at end of file
+        self.finish()
+
+
+class ReadyHandler(tornado.web.RequestHandler):
+    '''
+    Handle /health/ready, for load balancers
+
+    The server starts listening before it loads the models, and answers
+    503 until they are all loaded and warmed up. With multiple worker
+    processes, each worker only starts listening once its models are
+    loaded, and reports that it is ready to the supervisor instead.
+    '''
+    def get(self):
+        self.set_header("Cache-Control", "no-store,must-revalidate")
+        if not self.application.ready:
+            self.set_status(503)
+            self.write(dict(status='starting'))
+        else:
+            self.write(dict(status='ready', tokenizer=self.application.tokenizer_available))
+        self.finish()
+
+
+class CacheStatsHandler(BaseAdminHandler):
+    '''
+    Handle /admin/cache
+
+    With multiple worker processes, the stats of each worker are returned
+    separately, in the workers list.
+    '''
+    @tornado.gen.coroutine
+    def get(self):
+        self.check_authenticated()
+        if self.application.supervisor is None:
+            self.write(dict(result='ok', **self.application.cache_stats()))
+        else:
+            stats = yield self.application.collect_worker_stats()
+            self.write(dict(result='ok', workers=[dict(worker=worker['worker'], pid=worker['pid'], **worker['cache'])
+                                                  for worker in stats]))
+        self.finish()
+
+
+class MetricsHandler(BaseAdminHandler):
+    '''
+    Handle /metrics
+
+    With multiple worker processes, the worker that receives the request
+    collects the metrics of all the others, and every sample has a worker
+    label.
+    '''
+    @tornado.gen.coroutine
+    def get(self):
+        self.check_authenticated()
+        stats = yield self.application.collect_worker_stats()
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(render_snapshots([(worker['worker'], worker['metrics']) for worker in stats]))
+        self.finish()
+
+
+class MemoryStatsHandler(BaseAdminHandler):
+    def get(self):
+        self.check_authenticated()
+        self.write(dict(result='ok', **self.application.memory_stats()))
+        self.finish()
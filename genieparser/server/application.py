@@ -22,102 +22,534 @@ Created on Jul 1, 2017
 '''
 
 import re
+import sys
+import time
+import resource
 import tornado.web
+import tornado.gen
+import tornado.locks
+import tornado.ioloop
 import sqlalchemy
 import os
 import json
+import itertools
 
 import tensorflow as tf
 
-from .query_handlers import QueryHandler, TokenizeHandler
+from .query_handlers import QueryHandler, BatchQueryHandler, StreamingQueryHandler, TokenizeHandler
 from .learn_handler import LearnHandler
-from .admin_handlers import ReloadHandler, ExactMatcherReload
+from .admin_handlers import ReloadHandler, ExactMatcherReload, CacheStatsHandler, MetricsHandler, ReadyHandler, \
+    MemoryStatsHandler
+from .memory import process_memory_report, grammar_memory_report
 from .exact import ExactMatcher
 from .tokenizer import Tokenizer
-from .predictor import Predictor
+from .predictor import Predictor, GREEDY_SIGNATURE, ENCODER_SIGNATURE
+from .batcher import PredictionBatcher
+from .cache import LRUCache, SingleFlight
+from .log_writer import UtteranceLogWriter
+from .metrics import MetricsRegistry
+from ..grammar.slr import cache as slr_cache
+
+# sentences run through a new model before it starts serving, so the first
+# real queries do not pay for the lazy initialization of the session,
+# unless a warmup file is configured
+PROBE_SENTENCES = (
+    ['hello'],
+    ['get', 'a', 'cat', 'picture'],
+    ['post', 'QUOTED_STRING_0', 'on', 'twitter'],
+    ['when', 'the', 'temperature', 'is', 'above', 'NUMBER_0', 'degrees', 'notify', 'me'],
+)
+
+# how long to wait for in-flight requests to finish before closing an old model
+DRAIN_TIMEOUT = 60
+
+# how long to wait for buffered utterance log rows to be written at shutdown
+LOG_CLOSE_TIMEOUT = 10
+
+# how long to wait for the other worker processes to send their stats
+STATS_TIMEOUT = 2
+
+
+def make_tag(language_tag, model_tag):
+    if model_tag is not None:
+        return '@%s/%s' % (model_tag, language_tag)
+    else:
+        return language_tag
+
+
+def parse_tag(tag):
+    if tag.startswith('@'):
+        model_tag, language_tag = tag.split('/')
+        return language_tag, model_tag[1:]
+    else:
+        return tag, None
+
+
+def load_warmup_sentences(filename):
+    '''
+    Read the tokenized sentences used to warm up new models.
+
+    Each line is either a JSON string, a JSON list of tokens, a JSON object
+    with a "preprocessed" or "q" field (such as a recorded request), or
+    plain space-separated tokens.
+    '''
+    sentences = []
+    with tf.gfile.Open(filename) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] in ('"', '[', '{'):
+                sentence = json.loads(line)
+                if isinstance(sentence, dict):
+                    sentence = sentence.get('preprocessed', None) or sentence.get('q', '')
+            else:
+                sentence = line
+            if isinstance(sentence, str):
+                sentence = sentence.split()
+            if sentence:
+                sentences.append(sentence)
+    return sentences
+
+
+def get_max_rss():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        # Linux reports kilobytes, macOS reports bytes
+        max_rss *= 1024
+    return max_rss
+
+
+def estimate_model_size(model_dir):
+    '''
+    Estimate the memory used by a model, as the size of its checkpoint
+    '''
+    variables_dir = os.path.join(model_dir, tf.saved_model.constants.VARIABLES_DIRECTORY)
+    if not tf.gfile.IsDirectory(variables_dir):
+        return 0
+    return sum(tf.gfile.Stat(os.path.join(variables_dir, filename)).length
+               for filename in tf.gfile.ListDirectory(variables_dir))
 
 
 class LanguageContext(object):
-    def __init__(self, tag, language_tag, model_tag, tokenizer, predictor):
+    # numbers each LanguageContext, see generation
+    _generations = itertools.count()
+
+    def __init__(self, tag, language_tag, model_tag, tokenizer, predictor, batcher, metrics):
+        # identifies this copy of the model, so that query results are never
+        # shared with the copy that it replaces, or that replaces it
+        self.generation = next(LanguageContext._generations)
         self.tag = tag
         self.language_tag = language_tag
         self.model_tag = model_tag
         self.tokenizer = tokenizer
         self.predictor = predictor
+        self.batcher = batcher
+        # set if the model can decode with greedy search before falling
+        # back to beam search, see QueryHandler._do_run_query
+        self.greedy_batcher = None
+        # set if the model can encode sentences for MultipleChoice queries
+        self.encoder_batcher = None
+        self.metrics = metrics
+        self.exact = None
+        # estimated memory usage of the model, in bytes
+        self.estimated_size = 0
+        self.last_used = time.monotonic()
+
+        # the number of requests using this language, see acquire()
+        self._active = 0
+        self._idle = tornado.locks.Condition()
+        # set once this context has been replaced by a reload
+        self.retired = False
+
+    def acquire(self):
+        '''
+        Mark that a request is using this language, so it is not closed
+        under the request if the model is reloaded
+        '''
+        self._active += 1
+
+    @property
+    def in_use(self):
+        return self._active > 0
+
+    def release(self):
+        self._active -= 1
+        if self._active == 0:
+            self._idle.notify_all()
+
+    @tornado.gen.coroutine
+    def drain(self, timeout):
+        '''
+        Wait until no request is using this language, or until
+        timeout seconds have passed; return True if it is idle
+        '''
+        deadline = tornado.ioloop.IOLoop.current().time() + timeout
+        while self._active > 0:
+            if not (yield self._idle.wait(deadline)):
+                return False
+        return True
+
+    def close(self):
+        self.predictor.close()
 
 
 class Application(tornado.web.Application):
-    def __init__(self, config, thread_pool, tokenizer_service):
+    def __init__(self, config, thread_pool, tokenizer_service, metrics=None):
         super().__init__([
             (r"/query", QueryHandler),
+            (r"/query/batch", BatchQueryHandler),
+            (r"/query/stream", StreamingQueryHandler),
             (r"/learn", LearnHandler),
+            (r"/admin/cache", CacheStatsHandler),
+            (r"/admin/memory", MemoryStatsHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/health/ready", ReadyHandler),
             (r"/(?P<locale>[a-zA-Z-]+)/tokenize", TokenizeHandler),
             (r"/(?P<locale>[a-zA-Z-]+)/query", QueryHandler),
+            (r"/(?P<locale>[a-zA-Z-]+)/query/batch", BatchQueryHandler),
+            (r"/(?P<locale>[a-zA-Z-]+)/query/stream", StreamingQueryHandler),
             (r"/(?P<locale>[a-zA-Z-]+)/learn", LearnHandler),
             (r"/(?P<locale>[a-zA-Z-]+)/admin/reload", ReloadHandler),
             (r"/(?P<locale>[a-zA-Z-]+)/admin/exact/reload", ExactMatcherReload),
             (r"/@(?P<model_tag>[a-zA-Z0-9_\.-]+)/(?P<locale>[a-zA-Z-]+)/tokenize", TokenizeHandler),
             (r"/@(?P<model_tag>[a-zA-Z0-9_\.-]+)/(?P<locale>[a-zA-Z-]+)/query", QueryHandler),
+            (r"/@(?P<model_tag>[a-zA-Z0-9_\.-]+)/(?P<locale>[a-zA-Z-]+)/query/batch", BatchQueryHandler),
+            (r"/@(?P<model_tag>[a-zA-Z0-9_\.-]+)/(?P<locale>[a-zA-Z-]+)/query/stream", StreamingQueryHandler),
             (r"/@(?P<model_tag>[a-zA-Z0-9_\.-]+)/(?P<locale>[a-zA-Z-]+)/learn", LearnHandler),
             (r"/@(?P<model_tag>[a-zA-Z0-9_\.-]+)/(?P<locale>[a-zA-Z-]+)/admin/reload", ReloadHandler),
             (r"/@(?P<model_tag>[a-zA-Z0-9_\.-]+)/(?P<locale>[a-zA-Z-]+)/admin/exact/reload", ExactMatcherReload),
         ])
     
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
         if config.db_url:
             self.database = sqlalchemy.create_engine(config.db_url, pool_recycle=600)
+            self.utterance_log = UtteranceLogWriter(self.database,
+                                                    max_queue_size=config.log_queue_size,
+                                                    batch_size=config.log_batch_size,
+                                                    flush_interval=config.log_flush_interval,
+                                                    overflow=config.log_overflow,
+                                                    metrics=self.metrics)
+            self.utterance_log.start()
         else:
             self.database = None
+            self.utterance_log = None
         self.config = config
+        # all the models in the configuration, and the ones that are loaded
+        self._models = set(config.languages)
         self._languages = dict()
+        self._loads = SingleFlight()
+        self._idle_check = None
         self.thread_pool = thread_pool
         self._tokenizer = tokenizer_service
+        self.query_cache = LRUCache(config.query_cache_size, config.query_cache_ttl)
+        self.tokenizer_cache = LRUCache(config.tokenizer_cache_size, config.tokenizer_cache_ttl)
+        self.inflight_queries = SingleFlight()
+        # set by main when running as one of several worker processes
+        self.supervisor = None
+        self.worker_index = None
+        self._reload_locks = dict()
+
+        # all models built from the same grammar map the same parse tables
+        # parse tables that are not shipped with the model are saved in
+        # grammar_cache_dir, or kept in memory if that is not set, but
+        # never written to the model directory
+        slr_cache.set_model_cache_writable(False)
+        if config.grammar_cache_dir:
+            tf.gfile.MakeDirs(config.grammar_cache_dir)
+        slr_cache.set_shared_cache_dir(config.grammar_cache_dir)
+
+        if config.warmup_file:
+            self._warmup_sentences = load_warmup_sentences(config.warmup_file)
+            tf.logging.info('Loaded %d warmup sentences', len(self._warmup_sentences))
+        else:
+            self._warmup_sentences = PROBE_SENTENCES
+        # set once the models are loaded and warmed up, see /health/ready
+        self.ready = False
         
-    def _load_language(self, language_tag, model_tag, model_dir):
+    def _make_batcher(self, predictor, metrics, signature_key=None):
+        return PredictionBatcher(predictor, self.thread_pool,
+                                 max_batch_size=self.config.max_batch_size,
+                                 max_wait_ms=self.config.max_batch_wait_ms,
+                                 max_queue_depth=self.config.max_queue_depth,
+                                 max_concurrent_batches=self.config.max_concurrent_batches,
+                                 metrics=metrics,
+                                 signature_key=signature_key)
+
+    def _create_predictor(self, model_dir, metrics):
         with tf.gfile.Open(os.path.join(model_dir, "model.json")) as fp:
             config = json.load(fp)
+        return Predictor(model_dir, config, metrics=metrics, greedy=self.config.adaptive_decoding)
 
-        tokenizer = Tokenizer(self._tokenizer, language_tag)
-        predictor = Predictor(model_dir, config)
+    def _build_language(self, language_tag, model_tag, model_dir):
+        # this can run on the thread pool, so it must not touch _languages
+        tag = make_tag(language_tag, model_tag)
+        metrics = self.metrics.stages(tag)
 
-        if model_tag is not None:
-            tag = '@%s/%s' % (model_tag, language_tag)
-        else:
-            tag = language_tag
+        tokenizer = Tokenizer(self._tokenizer, language_tag, self.tokenizer_cache)
+        predictor = self._create_predictor(model_dir, metrics)
+        batcher = self._make_batcher(predictor, metrics)
         
-        language = LanguageContext(tag, language_tag, model_tag, tokenizer, predictor)
-        self._languages[tag] = language
-        if self.database:
-            language.exact = ExactMatcher(self.database, language_tag, model_tag)
-            language.exact.load()
-        else:
-            language.exact = None
-        if model_tag is not None:
-            tf.logging.info('Loaded model @%s/%s', model_tag, language_tag)
+        language = LanguageContext(tag, language_tag, model_tag, tokenizer, predictor, batcher, metrics)
+        if GREEDY_SIGNATURE in predictor.signatures:
+            language.greedy_batcher = self._make_batcher(predictor, metrics, signature_key=GREEDY_SIGNATURE)
+        if ENCODER_SIGNATURE in predictor.signatures:
+            language.encoder_batcher = self._make_batcher(predictor, metrics, signature_key=ENCODER_SIGNATURE)
+        language.estimated_size = estimate_model_size(model_dir)
+        try:
+            if self.database:
+                language.exact = ExactMatcher(self.database, language_tag, model_tag)
+                language.exact.load()
+
+            if self._warmup_sentences and self.config.warmup_batch_sizes:
+                start = time.monotonic()
+                predictor.warm_up(self._warmup_sentences, self.config.warmup_batch_sizes)
+                tf.logging.info('Warmed up %s in %.1f seconds', tag, time.monotonic() - start)
+        except:
+            predictor.close()
+            raise
+        return language
+
+    def _install_language(self, language):
+        self._languages[language.tag] = language
+        self.invalidate_query_cache(language.language_tag, language.model_tag)
+        if language.model_tag is not None:
+            tf.logging.info('Loaded model @%s/%s', language.model_tag, language.language_tag)
         else:
-            tf.logging.info('Loaded model @default/%s', language_tag)
-            
+            tf.logging.info('Loaded model @default/%s', language.language_tag)
+
+
+    @property
+    def tokenizer_available(self):
+        return self._tokenizer.available
+
+    def is_pinned(self, tag):
+        '''
+        Check if a model must always be loaded. Only @model_tag models can
+        be loaded on demand and evicted.
+        '''
+        return not self.config.lazy_loading or parse_tag(tag)[1] is None
+
+    @tornado.gen.coroutine
     def load_all_languages(self):
+        '''
+        Load and warm up all the models that are not loaded on demand,
+        one at a time, and then mark the server as ready.
+
+        The models are built on the thread pool, so the IOLoop keeps running
+        and /health/ready reports that the server is starting meanwhile.
+        '''
         for tag in self.config.languages:
-            if tag.startswith('@'):
-                model_tag, language_tag = tag.split('/')
-                model_tag = model_tag[1:]
-            else:
-                language_tag = tag
-                model_tag = None
-            self._load_language(language_tag, model_tag, self.config.get_model_directory(tag))
-    
+            if not self.is_pinned(tag) or tag in self._languages:
+                continue
+            # a query that arrived first might have started this load already
+            yield self._loads.run(tag, self._load_on_demand, tag)
+        self.ready = True
+
+        if self.config.lazy_loading and self.config.model_idle_timeout > 0:
+            self._idle_check = tornado.ioloop.PeriodicCallback(self._evict_idle_languages,
+                                                               min(self.config.model_idle_timeout, 60) * 1000)
+            self._idle_check.start()
+
+    @tornado.gen.coroutine
+    def _load_on_demand(self, tag):
+        language_tag, model_tag = parse_tag(tag)
+        tf.logging.info('Loading model %s', tag)
+        language = yield tornado.ioloop.IOLoop.current().run_in_executor(
+            self.thread_pool, self._build_language, language_tag, model_tag,
+            self.config.get_model_directory(tag))
+        self._install_language(language)
+        self._enforce_memory_budget(language)
+        return language
+
+    def _evict_language(self, language, reason):
+        tf.logging.info('Unloading model %s (%s)', language.tag, reason)
+        del self._languages[language.tag]
+        # predictions that finish from now on must not be cached
+        language.retired = True
+        self.invalidate_query_cache(language.language_tag, language.model_tag)
+        tornado.ioloop.IOLoop.current().spawn_callback(self._retire_language, language)
+
+    def _evict_idle_languages(self):
+        deadline = time.monotonic() - self.config.model_idle_timeout
+        for language in list(self._languages.values()):
+            if not self.is_pinned(language.tag) and not language.in_use and language.last_used < deadline:
+                self._evict_language(language, 'idle')
+
+    def _enforce_memory_budget(self, keep):
+        budget = self.config.model_memory_budget * 1024 * 1024
+        if budget <= 0:
+            return
+        evictable = sorted((language for language in self._languages.values()
+                            if not self.is_pinned(language.tag)), key=lambda language: language.last_used)
+        used = sum(language.estimated_size for language in evictable)
+        for language in evictable:
+            if used <= budget:
+                break
+            # the model that was just loaded, and the ones that are serving
+            # a request, stay loaded even if that exceeds the budget
+            if language is keep or language.in_use:
+                continue
+            self._evict_language(language, 'memory budget')
+            used -= language.estimated_size
+
+    def close(self):
+        '''
+        Flush the rows still buffered for the utterance log, before the
+        process exits
+        '''
+        if self.utterance_log is not None:
+            self.utterance_log.close(LOG_CLOSE_TIMEOUT)
+            if len(self.utterance_log) > 0:
+                tf.logging.warning('Lost %d rows of the utterance log at shutdown', len(self.utterance_log))
+
+    def memory_stats(self):
+        '''
+        Report the memory of this process, and of the parse tables of
+        each loaded model, split in shared and private
+        '''
+        grammars = dict()
+        for tag, language in self._languages.items():
+            grammars[tag] = grammar_memory_report(language.predictor.problem.grammar)
+        return dict(pid=os.getpid(), process=process_memory_report(), grammars=grammars)
+
+    @tornado.gen.coroutine
+    def _retire_language(self, language):
+        # the caller sets language.retired, before invalidating the query cache
+        if not (yield language.drain(DRAIN_TIMEOUT)):
+            tf.logging.warning('Requests for the old %s model did not finish in %d seconds, closing it anyway',
+                               language.tag, DRAIN_TIMEOUT)
+        language.close()
+        tf.logging.info('Closed the old %s model', language.tag)
+
+    @tornado.gen.coroutine
     def reload_language(self, language_tag, model_tag=None):
+        '''
+        Load a new copy of the model from disk, without blocking the IOLoop.
+
+        The new model is built on the thread pool and warmed up with a few
+        probe queries, while the old one keeps serving. The two are swapped
+        atomically, and the old model is closed once the requests that
+        were using it are done.
+
+        Returns the reload duration and peak memory usage.
+        '''
+        tag = make_tag(language_tag, model_tag)
+        if tag not in self._languages and not self.is_pinned(tag):
+            # it will be loaded from disk the next time it is used
+            return dict(duration=0, max_rss=get_max_rss())
         if model_tag is not None:
-            tag = '@%s/%s' % (model_tag, language_tag)
             tf.logging.info('Reloading model @%s/%s', model_tag, language_tag)
         else:
-            tag = language_tag
-            tf.logging.info('Reloading model @default/%s', language_tag) 
-        self._load_language(language_tag, model_tag, self.config.get_model_directory(tag))
+            tf.logging.info('Reloading model @default/%s', language_tag)
+
+        # concurrent reloads of the same model are serialized
+        lock = self._reload_locks.get(tag, None)
+        if lock is None:
+            lock = self._reload_locks[tag] = tornado.locks.Lock()
+        with (yield lock.acquire()):
+            start = time.monotonic()
+            language = yield tornado.ioloop.IOLoop.current().run_in_executor(
+                self.thread_pool, self._build_language, language_tag, model_tag,
+                self.config.get_model_directory(tag))
+
+            old_language = self._languages.get(tag, None)
+            if old_language is not None:
+                # this must happen before the query cache is invalidated,
+                # or a prediction of the old model that finishes in between
+                # would be cached
+                old_language.retired = True
+            self._install_language(language)
+            duration = time.monotonic() - start
+
+        if old_language is not None:
+            tornado.ioloop.IOLoop.current().spawn_callback(self._retire_language, old_language)
+
+        max_rss = get_max_rss()
+        tf.logging.info('Reloaded %s in %.1f seconds, peak RSS %d MB', tag, duration, max_rss // (1024 * 1024))
+        return dict(duration=duration, max_rss=max_rss)
     
-    def get_language(self, locale, model_tag=None):
+    def reload_exact_matches(self, language_tag, model_tag=None):
+        language = self._languages.get(make_tag(language_tag, model_tag), None)
+        if language is None or language.exact is None:
+            return
+        tf.logging.info('Reloading exact matches for %s', language.tag)
+        language.exact.load()
+        self.invalidate_query_cache(language_tag, model_tag)
+
+    def add_exact_match(self, language_tag, model_tag, preprocessed, target_code):
+        language = self._languages.get(make_tag(language_tag, model_tag), None)
+        if language is None or language.exact is None:
+            # if the model is not loaded, the exact matches will be read
+            # from the database when it is
+            return
+        language.exact.add(preprocessed, target_code)
+        # the new exact match can change the results of cached queries
+        self.invalidate_query_cache(language_tag, model_tag)
+
+    def cache_stats(self):
+        return dict(query_cache=self.query_cache.stats,
+                    tokenizer_cache=self.tokenizer_cache.stats,
+                    coalesced_queries=self.inflight_queries.coalesced,
+                    utterance_log=(self.utterance_log.stats if self.utterance_log else None))
+
+    def worker_stats(self):
+        '''
+        The metrics and cache stats of this process, in a form that
+        can be sent to other worker processes
+        '''
+        return dict(worker=self.worker_index, pid=os.getpid(),
+                    metrics=self.metrics.snapshot(), cache=self.cache_stats())
+
+    @tornado.gen.coroutine
+    def collect_worker_stats(self):
         '''
-        Convert a locale tag into a preloaded language
+        Return the worker_stats() of all worker processes, sorted by
+        worker index; workers that do not reply in time are omitted
+        '''
+        own = self.worker_stats()
+        if self.supervisor is None:
+            return [own]
+        replies = yield self.supervisor.request(dict(op='stats'), self.config.workers - 1, STATS_TIMEOUT)
+        stats = [own] + [reply['stats'] for reply in replies]
+        stats.sort(key=lambda worker: worker['worker'])
+        return stats
+
+    def broadcast(self, op, **kw):
+        '''
+        Tell the other worker processes (if any) to apply a change that
+        was just made in this process
+        '''
+        if self.supervisor is not None:
+            self.supervisor.send(dict(op=op, **kw))
+
+    def handle_message(self, message):
+        '''
+        Apply a change that was broadcast by another worker process
+        '''
+        op = message['op']
+        if op == 'reload':
+            tornado.ioloop.IOLoop.current().spawn_callback(self.reload_language,
+                                                           message['language_tag'], message['model_tag'])
+        elif op == 'exact_reload':
+            self.reload_exact_matches(message['language_tag'], message['model_tag'])
+        elif op == 'exact_add':
+            self.add_exact_match(message['language_tag'], message['model_tag'],
+                                 message['preprocessed'], message['target_code'])
+        elif op == 'stats':
+            self.supervisor.reply(message, dict(op='stats', stats=self.worker_stats()))
+        else:
+            tf.logging.warning('Ignored unknown message %s', op)
+
+    def invalidate_query_cache(self, language_tag, model_tag=None):
+        '''
+        Drop all cached query results for the given model
+        '''
+        self.query_cache.invalidate(lambda key: key[0] == language_tag and key[1] == model_tag)
+    
+    def _resolve_tag(self, locale, model_tag=None):
+        '''
+        Convert a locale tag into the tag of a configured model
         '''
 
         if model_tag == 'default':
@@ -126,29 +558,46 @@ class Application(tornado.web.Application):
         split_tag = re.split("[_\\.\\-]", locale)
         
         # try with language and country
-        language = None
         if len(split_tag) >= 2:
             key = split_tag[0] + "-" + split_tag[1]
             if model_tag is not None:
                 key = '@' + model_tag + '/' + key
-            language = self._languages.get(key, None)
-        if language is None and len(split_tag) >= 1:
+            if key in self._models:
+                return key
+        if len(split_tag) >= 1:
             key = split_tag[0]
             if model_tag is not None:
                 key = '@' + model_tag + '/' + key
-            language = self._languages.get(key, None)
+            if key in self._models:
+                return key
 
         # fallback to english if the language is not recognized or
         # locale was not specified
-        if language:
-            return language
-        else:
-            if model_tag is not None:
-                key = '@' + model_tag + '/' + self.config.default_language
-                language = self._languages.get(key, None)
-                if language is not None:
-                    return language
-                else:
-                    tf.logging.warning("Ignored model tag " + model_tag)
-            
-            return self._languages[self.config.default_language]
+        if model_tag is not None:
+            key = '@' + model_tag + '/' + self.config.default_language
+            if key in self._models:
+                return key
+            else:
+                tf.logging.warning("Ignored model tag " + model_tag)
+        
+        return self.config.default_language
+
+    def resolve_language(self, locale, model_tag=None):
+        '''
+        Convert a locale tag into the language and model tag of
+        a configured model, without loading it
+        '''
+        return parse_tag(self._resolve_tag(locale, model_tag))
+
+    @tornado.gen.coroutine
+    def get_language(self, locale, model_tag=None):
+        '''
+        Convert a locale tag into a language, loading the model if needed
+        '''
+        tag = self._resolve_tag(locale, model_tag)
+        language = self._languages.get(tag, None)
+        if language is None:
+            # concurrent requests for the same model wait for the same load
+            language = yield self._loads.run(tag, self._load_on_demand, tag)
+        language.last_used = time.monotonic()
+        return language
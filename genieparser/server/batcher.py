@@ -0,0 +1,271 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 12, 2018
+
+@author: gcampagn
+'''
+
+import time
+from collections import deque
+
+import tensorflow as tf
+import tornado.gen
+import tornado.web
+import tornado.ioloop
+import tornado.concurrent
+from tornado.concurrent import Future
+
+from .predictor import pad_to_batch
+
+
+class OverloadedError(tornado.web.HTTPError):
+    '''
+    The model cannot serve the request in time. The client should retry later,
+    possibly on a different server.
+    '''
+
+    def __init__(self, reason):
+        super().__init__(503, reason=reason)
+
+
+class ModelTimeoutError(OverloadedError):
+    '''
+    The model was interrupted because it did not finish before the deadline.
+    A cheaper model (such as greedy decoding) might still answer in time.
+    '''
+
+
+# scheduling priorities, from highest to lowest
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+LANES = (INTERACTIVE, BULK)
+
+
+class PredictionBatcher(object):
+    '''
+    Collect concurrent prediction requests for one LanguageContext and
+    run them through the Predictor as a single padded batch.
+
+    A batch is sent to the thread pool as soon as it reaches max_batch_size,
+    or max_wait_ms after the first request in the batch arrived, whichever
+    comes first.
+
+    At most max_concurrent_batches batches are on the thread pool at the same
+    time; the other requests wait in a queue of at most max_queue_depth
+    sentences. Requests are rejected immediately when the queue is full, and
+    removed from the queue when their deadline expires before they are sent
+    to the model, so that an overloaded server fails fast instead of making
+    everyone wait.
+
+    Requests are in one of two lanes, each with its own queue. Interactive
+    requests always go first, and bulk requests fill the rest of interactive
+    batches. Batches of only bulk requests are sent when no interactive
+    request is waiting, and never take the last free slot on the thread pool,
+    so bulk work only uses spare capacity.
+
+    Each batch runs with the latest deadline of its requests, and fails
+    with ModelTimeoutError if the model does not finish by then.
+
+    signature_key selects the signature of the predictor to run (by default,
+    the default serving signature).
+    '''
+
+    def __init__(self, predictor, executor, max_batch_size=32, max_wait_ms=5,
+                 max_queue_depth=1000, max_concurrent_batches=4, metrics=None,
+                 signature_key=None):
+        self._predictor = predictor
+        self._signature_key = signature_key
+        self._metrics = metrics
+        self.executor = executor
+        self._max_batch_size = max(1, max_batch_size)
+        self._max_wait = max(0, max_wait_ms) / 1000
+        self._max_queue_depth = max_queue_depth
+        self._max_concurrent_batches = max(1, max_concurrent_batches)
+        self._max_bulk_batches = max(1, self._max_concurrent_batches - 1)
+
+        # for each lane, (tokens, future, enqueued time, deadline)
+        self._queues = dict((lane, deque()) for lane in LANES)
+        # the earliest deadline in the queues
+        self._next_deadline = None
+        self._running = 0
+        self._timeout = None
+        self._timeout_when = None
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def predict(self, tokens, deadline=None, lane=INTERACTIVE):
+        '''
+        Schedule a prediction for one (clean) tokenized sentence.
+
+        deadline is the time.monotonic() value after which the prediction
+        is no longer useful, or None to wait indefinitely.
+
+        Returns a Future that resolves to the predictions for this
+        sentence only, with the batch dimension removed, or fails with
+        OverloadedError if the sentence cannot be predicted in time.
+        '''
+        return self.predict_many([tokens], deadline, lane)[0]
+
+    def predict_many(self, sentences, deadline=None, lane=INTERACTIVE):
+        '''
+        Schedule predictions for several sentences that are only useful
+        together, such as the input and the choices of a MultipleChoice query.
+
+        Either all the sentences are queued, or none is and OverloadedError
+        is raised. Returns a list of Futures, one for each sentence, like
+        predict().
+        '''
+        queue = self._queues[lane]
+        if self._max_queue_depth > 0 and len(queue) + len(sentences) > self._max_queue_depth:
+            self._shed(lane, 'queue_full')
+            raise OverloadedError('Too many queries waiting for the model')
+
+        now = time.monotonic()
+        futures = []
+        for tokens in sentences:
+            future = Future()
+            queue.append((tokens, future, now, deadline))
+            futures.append(future)
+        if deadline is not None and (self._next_deadline is None or deadline < self._next_deadline):
+            self._next_deadline = deadline
+        self._schedule()
+        return futures
+
+    def _shed(self, lane, reason):
+        if self._metrics is not None:
+            self._metrics.shed(lane, reason)
+
+    def _update_next_deadline(self):
+        deadlines = [item[3] for queue in self._queues.values() for item in queue if item[3] is not None]
+        self._next_deadline = min(deadlines) if deadlines else None
+
+    def _expire(self, now):
+        for lane in LANES:
+            alive = deque()
+            for item in self._queues[lane]:
+                deadline = item[3]
+                if deadline is not None and deadline <= now:
+                    self._shed(lane, 'deadline')
+                    item[1].set_exception(OverloadedError('Query deadline expired while waiting for the model'))
+                else:
+                    alive.append(item)
+            self._queues[lane] = alive
+        self._update_next_deadline()
+
+    def _is_ready(self, queue, now):
+        return queue and (len(queue) >= self._max_batch_size or now - queue[0][2] >= self._max_wait)
+
+    def _take(self, lane, count, batch):
+        # batch items are (tokens, future, enqueued time, deadline, lane)
+        queue = self._queues[lane]
+        for _ in range(min(count, len(queue))):
+            batch.append(queue.popleft() + (lane,))
+
+    def _next_batch(self, now):
+        interactive = self._queues[INTERACTIVE]
+        batch = []
+        if self._running < self._max_concurrent_batches and self._is_ready(interactive, now):
+            self._take(INTERACTIVE, self._max_batch_size, batch)
+            self._take(BULK, self._max_batch_size - len(batch), batch)
+        elif not interactive and self._running < self._max_bulk_batches and \
+                self._is_ready(self._queues[BULK], now):
+            self._take(BULK, self._max_batch_size, batch)
+        return batch
+
+    def _schedule(self):
+        now = time.monotonic()
+        if self._next_deadline is not None and self._next_deadline <= now:
+            self._expire(now)
+
+        sent = False
+        while True:
+            batch = self._next_batch(now)
+            if not batch:
+                break
+            self._running += 1
+            sent = True
+            tornado.ioloop.IOLoop.current().spawn_callback(self._run_batch, batch)
+        if sent:
+            self._update_next_deadline()
+
+        if self._metrics is not None:
+            for lane in LANES:
+                self._metrics.set_queue_depth(lane, len(self._queues[lane]))
+
+        # wake up when the oldest request of a lane has waited long enough
+        # to send a partial batch, or when the first deadline expires
+        when = self._next_deadline
+        interactive = self._queues[INTERACTIVE]
+        bulk = self._queues[BULK]
+        if interactive and self._running < self._max_concurrent_batches:
+            batch_ready = interactive[0][2] + self._max_wait
+            when = batch_ready if when is None else min(when, batch_ready)
+        elif bulk and not interactive and self._running < self._max_bulk_batches:
+            batch_ready = bulk[0][2] + self._max_wait
+            when = batch_ready if when is None else min(when, batch_ready)
+        if when != self._timeout_when:
+            io_loop = tornado.ioloop.IOLoop.current()
+            if self._timeout is not None:
+                io_loop.remove_timeout(self._timeout)
+                self._timeout = None
+            if when is not None:
+                self._timeout = io_loop.call_later(max(0, when - now), self._on_timeout)
+            self._timeout_when = when
+
+    def _on_timeout(self):
+        self._timeout = None
+        self._timeout_when = None
+        self._schedule()
+
+    @tornado.concurrent.run_on_executor
+    def _do_predict(self, batch, enqueued, deadline):
+        if self._metrics is not None:
+            # time spent waiting for the batch to fill and for a free thread
+            now = time.monotonic()
+            for start, lane in enqueued:
+                self._metrics.observe('queue', now - start)
+                self._metrics.observe_lane(lane, 'queue', now - start)
+        return self._predictor.predict({
+            "inputs/string": pad_to_batch(batch)
+        }, signature_key=self._signature_key, deadline=deadline)
+
+    @tornado.gen.coroutine
+    def _run_batch(self, batch):
+        # the batch is useful as long as any of its requests is
+        deadlines = [item[3] for item in batch]
+        deadline = None if None in deadlines else max(deadlines)
+        try:
+            predicted = yield self._do_predict([item[0] for item in batch],
+                                               [(item[2], item[4]) for item in batch],
+                                               deadline)
+        except tf.errors.DeadlineExceededError:
+            for item in batch:
+                self._shed(item[4], 'timeout')
+                item[1].set_exception(ModelTimeoutError('Query deadline expired while running the model'))
+            return
+        except Exception as e:
+            for item in batch:
+                item[1].set_exception(e)
+            return
+        finally:
+            self._running -= 1
+            self._schedule()
+
+        for i, item in enumerate(batch):
+            item[1].set_result({key: value[i] for key, value in predicted.items()})
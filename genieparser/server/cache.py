@@ -0,0 +1,146 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 13, 2018
+
+@author: gcampagn
+'''
+
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    A bounded mapping with least-recently-used eviction and an optional
+    time-to-live for each entry.
+
+    The cache is not thread-safe, it should only be accessed from
+    the IOLoop thread.
+    '''
+
+    def __init__(self, max_size, ttl=0):
+        self._data = OrderedDict()
+        self._max_size = max_size
+        # ttl is in seconds, 0 means entries never expire
+        self._ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def enabled(self):
+        return self._max_size > 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self._max_size <= 0:
+            return
+
+        expires = time.monotonic() + self._ttl if self._ttl > 0 else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, predicate=None):
+        '''
+        Remove all entries whose key matches predicate, or all entries
+        if predicate is None.
+        '''
+        if predicate is None:
+            self._data.clear()
+            return
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    @property
+    def stats(self):
+        return dict(size=len(self._data),
+                    max_size=self._max_size,
+                    hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=self.hit_rate,
+                    evictions=self.evictions,
+                    expirations=self.expirations)
+
+
+class SingleFlight(object):
+    '''
+    Coalesce concurrent computations of the same value.
+
+    While a computation for a key is in progress, further requests for the
+    same key receive the Future of the computation that is already running,
+    instead of starting a new one.
+
+    Like LRUCache, this class should only be used from the IOLoop thread.
+    '''
+
+    def __init__(self):
+        self._inflight = dict()
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def run(self, key, fn, *args):
+        '''
+        Return the Future for key, calling fn(*args) to create it if no
+        computation is in progress.
+        '''
+        future = self._inflight.get(key, None)
+        if future is not None:
+            self.coalesced += 1
+            return future
+
+        future = fn(*args)
+        if future.done():
+            return future
+        self._inflight[key] = future
+
+        def done(_):
+            if self._inflight.get(key, None) is future:
+                del self._inflight[key]
+        future.add_done_callback(done)
+        return future
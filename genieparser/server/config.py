@@ -31,11 +31,26 @@ class ServerConfig():
             'port': '8400',
             'user': '',
             'default_language': 'en',
-            'admin_token': ''
+            'admin_token': '',
+            'workers': '1',
+            'lazy_loading': 'no',
+            'model_idle_timeout': '3600',
+            'model_memory_budget': '0'
         }
         
         self._config['db'] = {
             'url': '',
+            'log_queue_size': '10000',
+            'log_batch_size': '100',
+            'log_flush_interval': '1',
+            'log_overflow': 'drop_new'
+        }
+
+        self._config['tokenizer'] = {
+            'host': '127.0.0.1',
+            'port': '8888',
+            'connections': '4',
+            'timeout': '10'
         }
 
         self._config['ssl'] = {
@@ -43,6 +58,35 @@ class ServerConfig():
             'key': ''
         }
         
+        self._config['batching'] = {
+            'max_batch_size': '32',
+            'max_wait_ms': '5',
+            'max_queries_per_request': '1000',
+            'max_inflight_per_stream': '256',
+            'max_queue_depth': '1000',
+            'max_concurrent_batches': '4',
+            'query_deadline_ms': '0',
+            'retry_after': '1'
+        }
+
+        self._config['decoding'] = {
+            'adaptive': 'no',
+            'greedy_min_score': '-0.5'
+        }
+
+        self._config['warmup'] = {
+            'file': '',
+            'batch_sizes': '1,8,32'
+        }
+
+        self._config['cache'] = {
+            'query_cache_size': '10000',
+            'query_cache_ttl': '3600',
+            'tokenizer_cache_size': '10000',
+            'tokenizer_cache_ttl': '3600',
+            'grammar_cache_dir': ''
+        }
+
         self._config['models'] = {
             'en': './en/model'
         }
@@ -59,6 +103,22 @@ class ServerConfig():
     def default_language(self):
         return self._config['server']['default_language']
     
+    @property
+    def workers(self):
+        return int(self._config['server']['workers'])
+
+    @property
+    def lazy_loading(self):
+        return self._config['server'].getboolean('lazy_loading')
+
+    @property
+    def model_idle_timeout(self):
+        return float(self._config['server']['model_idle_timeout'])
+
+    @property
+    def model_memory_budget(self):
+        return int(self._config['server']['model_memory_budget'])
+
     @property
     def admin_token(self):
         return self._config['server']['admin_token']
@@ -67,6 +127,38 @@ class ServerConfig():
     def db_url(self):
         return self._config['db']['url']
 
+    @property
+    def log_queue_size(self):
+        return int(self._config['db']['log_queue_size'])
+
+    @property
+    def log_batch_size(self):
+        return int(self._config['db']['log_batch_size'])
+
+    @property
+    def log_flush_interval(self):
+        return float(self._config['db']['log_flush_interval'])
+
+    @property
+    def log_overflow(self):
+        return self._config['db']['log_overflow']
+
+    @property
+    def tokenizer_host(self):
+        return self._config['tokenizer']['host']
+
+    @property
+    def tokenizer_port(self):
+        return int(self._config['tokenizer']['port'])
+
+    @property
+    def tokenizer_connections(self):
+        return int(self._config['tokenizer']['connections'])
+
+    @property
+    def tokenizer_timeout(self):
+        return float(self._config['tokenizer']['timeout'])
+
     @property
     def ssl_chain(self):
         return self._config['ssl']['chain']
@@ -75,6 +167,74 @@ class ServerConfig():
     def ssl_key(self):
         return self._config['ssl']['key']
 
+    @property
+    def max_batch_size(self):
+        return int(self._config['batching']['max_batch_size'])
+
+    @property
+    def max_batch_wait_ms(self):
+        return float(self._config['batching']['max_wait_ms'])
+
+    @property
+    def max_queries_per_request(self):
+        return int(self._config['batching']['max_queries_per_request'])
+
+    @property
+    def max_inflight_per_stream(self):
+        return int(self._config['batching']['max_inflight_per_stream'])
+
+    @property
+    def max_queue_depth(self):
+        return int(self._config['batching']['max_queue_depth'])
+
+    @property
+    def max_concurrent_batches(self):
+        return int(self._config['batching']['max_concurrent_batches'])
+
+    @property
+    def query_deadline_ms(self):
+        return float(self._config['batching']['query_deadline_ms'])
+
+    @property
+    def retry_after(self):
+        return int(self._config['batching']['retry_after'])
+
+    @property
+    def adaptive_decoding(self):
+        return self._config['decoding'].getboolean('adaptive')
+
+    @property
+    def greedy_min_score(self):
+        return float(self._config['decoding']['greedy_min_score'])
+
+    @property
+    def warmup_file(self):
+        return self._config['warmup']['file']
+
+    @property
+    def warmup_batch_sizes(self):
+        return [int(x) for x in self._config['warmup']['batch_sizes'].split(',') if x.strip()]
+
+    @property
+    def query_cache_size(self):
+        return int(self._config['cache']['query_cache_size'])
+
+    @property
+    def query_cache_ttl(self):
+        return float(self._config['cache']['query_cache_ttl'])
+
+    @property
+    def tokenizer_cache_size(self):
+        return int(self._config['cache']['tokenizer_cache_size'])
+
+    @property
+    def tokenizer_cache_ttl(self):
+        return float(self._config['cache']['tokenizer_cache_ttl'])
+
+    @property
+    def grammar_cache_dir(self):
+        return self._config['cache']['grammar_cache_dir']
+
     @property
     def languages(self):
         return self._config['models'].keys()
@@ -22,6 +22,7 @@ Created on Aug 2, 2017
 
 import tornado.web
 import re
+import time
 
 from .constants import LATEST_THINGTALK_VERSION, DEFAULT_THINGTALK_VERSION
 
@@ -83,7 +84,7 @@ class LearnHandler(tornado.web.RequestHandler):
         self.set_header('Access-Control-Allow-Origin', '*')
 
         query = self.get_argument("q")
-        language = self.application.get_language(locale, model_tag)
+        language = yield self.application.get_language(locale, model_tag)
         target_code = self.get_argument("target")
         store = self.get_argument("store", "automatic")
         owner = self.get_argument("owner", None) or None
@@ -134,9 +135,15 @@ class LearnHandler(tornado.web.RequestHandler):
         if not self.application.database:
             raise tornado.web.HTTPError(500, "Server not configured for online learning")
         
+        start = time.monotonic()
         example_id = yield self._save_to_db(language.tag, query, preprocessed, target_code, store, owner)
+        language.metrics.observe_since('learn_db', start)
 
         if language.exact and training_flag:
-            language.exact.add(preprocessed, target_code)
+            self.application.add_exact_match(language.language_tag, language.model_tag,
+                                             preprocessed, target_code)
+            self.application.broadcast('exact_add', language_tag=language.language_tag, model_tag=language.model_tag,
+                                       preprocessed=preprocessed, target_code=target_code)
         self.write(dict(result="Learnt successfully", example_id=example_id))
         self.finish()
+        language.metrics.observe('learn', self.request.request_time())
@@ -0,0 +1,189 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 14, 2018
+
+@author: gcampagn
+'''
+
+import time
+import threading
+from collections import deque
+
+import sqlalchemy
+from sqlalchemy.exc import SQLAlchemyError
+import tensorflow as tf
+
+metadata = sqlalchemy.MetaData()
+utterance_log = sqlalchemy.Table('utterance_log', metadata,
+                                 sqlalchemy.Column('language', sqlalchemy.String(16)),
+                                 sqlalchemy.Column('preprocessed', sqlalchemy.Text),
+                                 sqlalchemy.Column('target_code', sqlalchemy.Text))
+
+OVERFLOW_POLICIES = ('drop_new', 'drop_old', 'block')
+
+MAX_RETRY_DELAY = 60
+
+
+class UtteranceLogWriter(object):
+    '''
+    Write rows to the utterance_log table from a background thread.
+
+    Rows are buffered in a bounded queue and flushed with a single multi-row
+    insert when batch_size rows are available, or every flush_interval seconds.
+    If the database is slow or down, the buffer fills up, and new rows are
+    handled according to the overflow policy:
+        - drop_new: discard the new row
+        - drop_old: discard the oldest buffered row
+        - block: wait up to block_timeout seconds for space, then discard
+          the new row
+    '''
+
+    def __init__(self, database, max_queue_size=10000, batch_size=100,
+                 flush_interval=1.0, overflow='drop_new', block_timeout=0.1, metrics=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Invalid overflow policy ' + overflow)
+        self._database = database
+        self._max_queue_size = max_queue_size
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._overflow = overflow
+        self._block_timeout = block_timeout
+        if metrics is not None:
+            self._insert_histogram = metrics.histogram('genie_utterance_log_insert_seconds',
+                                                       'Time to write one batch of rows to the utterance log')
+        else:
+            self._insert_histogram = None
+
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._closed = False
+        self._thread = None
+
+        self.written = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._queue)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='utterance-log-writer', daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=None):
+        '''
+        Stop the writer thread, after flushing all buffered rows
+        (or until timeout expires).
+        '''
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify()
+            self._not_full.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def log(self, language, preprocessed, target_code):
+        '''
+        Add a row to the log. This method never blocks for longer
+        than block_timeout.
+        '''
+        row = dict(language=language, preprocessed=preprocessed, target_code=target_code)
+        with self._lock:
+            if self._closed:
+                self.dropped += 1
+                return
+            if len(self._queue) >= self._max_queue_size:
+                if self._overflow == 'drop_old':
+                    self._queue.popleft()
+                    self.dropped += 1
+                elif self._overflow == 'block':
+                    self._not_full.wait_for(lambda: len(self._queue) < self._max_queue_size or self._closed,
+                                            self._block_timeout)
+                    if len(self._queue) >= self._max_queue_size or self._closed:
+                        self.dropped += 1
+                        return
+                else:
+                    self.dropped += 1
+                    return
+            self._queue.append(row)
+            if len(self._queue) >= self._batch_size:
+                self._not_empty.notify()
+
+    def _take_batch(self):
+        with self._lock:
+            deadline = time.monotonic() + self._flush_interval
+            while len(self._queue) < self._batch_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._not_empty.wait(remaining)
+
+            batch = []
+            while self._queue and len(batch) < self._batch_size:
+                batch.append(self._queue.popleft())
+            self._not_full.notify_all()
+            return batch
+
+    def _requeue(self, batch):
+        # put the rows back at the front of the queue, in the same order,
+        # dropping the oldest ones if new rows filled the queue in the meantime
+        with self._lock:
+            room = self._max_queue_size - len(self._queue)
+            if room < len(batch):
+                self.dropped += len(batch) - max(room, 0)
+                batch = batch[len(batch) - max(room, 0):]
+            self._queue.extendleft(reversed(batch))
+
+    def _run(self):
+        retry_delay = 0
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                if self._closed:
+                    return
+                continue
+
+            try:
+                start = time.monotonic()
+                self._database.execute(utterance_log.insert().values(batch))
+                if self._insert_histogram is not None:
+                    self._insert_histogram.observe(time.monotonic() - start)
+                self.written += len(batch)
+                retry_delay = 0
+            except SQLAlchemyError as e:
+                self.failed_flushes += 1
+                if self._closed:
+                    tf.logging.error('Failed to write %d rows to the utterance log: %s', len(batch), e)
+                    self.dropped += len(batch)
+                    continue
+                retry_delay = min(max(2 * retry_delay, self._flush_interval), MAX_RETRY_DELAY)
+                tf.logging.warning('Failed to write to the utterance log, retrying in %d seconds: %s',
+                                   retry_delay, e)
+                self._requeue(batch)
+                with self._lock:
+                    self._not_full.wait_for(lambda: self._closed, retry_delay)
+
+    @property
+    def stats(self):
+        return dict(queued=len(self),
+                    written=self.written,
+                    dropped=self.dropped,
+                    failed_flushes=self.failed_flushes)
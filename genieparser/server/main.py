@@ -24,9 +24,12 @@ Created on Jul 15, 2017
 
 import os
 import sys
+import signal
 import tensorflow as tf
 import numpy as np
+import tornado.gen
 import tornado.ioloop
+from tornado.httpserver import HTTPServer
 
 import ssl
 import pwd, grp
@@ -40,39 +43,101 @@ from concurrent.futures import ThreadPoolExecutor
 from .application import Application
 from .tokenizer import TokenizerService
 from .config import ServerConfig
+from .metrics import MetricsRegistry
+from .supervisor import Supervisor, SupervisorConnection, bind_port, listen_sockets
 
 FLAGS = tf.flags.FLAGS
 tf.flags.DEFINE_string("config_file", "/var/lib/genie-parser/server.conf", "Configuration file to use")
 
-def main(argv):
-    tf.logging.set_verbosity(tf.logging.INFO)
-    np.random.seed(42)
-
-    config = ServerConfig.load((FLAGS.config_file,))
-    
+def run_server(config, supervisor_sock=None, worker_index=None):
     if sys.version_info[2] >= 6:
         thread_pool = ThreadPoolExecutor(thread_name_prefix='query-thread-')
     else:
         thread_pool = ThreadPoolExecutor(max_workers=32)
-    tokenizer_service = TokenizerService()
-    app = Application(config, thread_pool, tokenizer_service)
+    metrics = MetricsRegistry()
+    tokenizer_service = TokenizerService(config.tokenizer_host, config.tokenizer_port,
+                                         num_connections=config.tokenizer_connections,
+                                         timeout=config.tokenizer_timeout,
+                                         metrics=metrics)
+    app = Application(config, thread_pool, tokenizer_service, metrics)
+    if supervisor_sock is not None:
+        app.supervisor = SupervisorConnection(supervisor_sock, worker_index)
+        app.worker_index = worker_index
+        app.supervisor.start(app.handle_message)
 
     if config.ssl_key:
         ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         ssl_ctx.load_cert_chain(config.ssl_chain, config.ssl_key)
-        app.listen(config.port, ssl_options=ssl_ctx)
     else:
-        app.listen(config.port)
+        ssl_ctx = None
+    # with multiple workers, each process opens its own socket, and the
+    # kernel balances connections between them
+    # the port is bound before dropping privileges
+    sockets = bind_port(config.port, reuse_port=supervisor_sock is not None)
+    server = HTTPServer(app, ssl_options=ssl_ctx)
+    if supervisor_sock is None:
+        # answer /health/ready while the models are loading
+        listen_sockets(server, sockets)
     
     if config.user:
         os.setgid(grp.getgrnam(config.user)[2])
         os.setuid(pwd.getpwnam(config.user)[2])
 
-    if sd:
-        sd.notify('READY=1')
+    # on SIGTERM (from systemd or the supervisor) stop serving, and flush
+    # the utterance log before exiting
+    io_loop = tornado.ioloop.IOLoop.current()
+    def on_signal(signum, frame):
+        io_loop.add_callback_from_signal(io_loop.stop)
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    # load and warm up all models before telling systemd we are ready,
+    # while the IOLoop answers /health/ready with 503
+    @tornado.gen.coroutine
+    def start():
+        tokenizer_service.run()
+        yield app.load_all_languages()
+
+        if supervisor_sock is not None:
+            # workers, including the ones that replace a crashed worker,
+            # only join the SO_REUSEPORT group once they can serve, or
+            # the kernel would queue connections to them while they load
+            listen_sockets(server, sockets)
+            # the supervisor notifies systemd when all workers are ready
+            app.supervisor.send(dict(op='ready'))
+        elif sd:
+            sd.notify('READY=1')
+
+    def on_started(future):
+        if future.exception() is not None:
+            # a model failed to load, exit with its error
+            io_loop.stop()
 
-    tokenizer_service.run()
-    app.load_all_languages()
+    started = start()
+    io_loop.add_future(started, on_started)
 
     sys.stdout.flush()
-    tornado.ioloop.IOLoop.current().start()
+    try:
+        io_loop.start()
+    finally:
+        server.stop()
+        app.close()
+    if started.done():
+        started.result()
+
+def main(argv):
+    tf.logging.set_verbosity(tf.logging.INFO)
+    np.random.seed(42)
+
+    config = ServerConfig.load((FLAGS.config_file,))
+    
+    if config.workers > 1:
+        def notify_ready():
+            if sd:
+                sd.notify('READY=1')
+        supervisor = Supervisor(config.workers,
+                                lambda index, sock: run_server(config, sock, index),
+                                on_ready=notify_ready)
+        supervisor.run()
+    else:
+        run_server(config)
@@ -0,0 +1,106 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 29, 2018
+
+@author: gcampagn
+'''
+
+import os
+from collections import OrderedDict
+
+SMAPS_FILE = '/proc/self/smaps'
+
+# the fields of smaps that are summed in the report, and their names in it
+SMAPS_FIELDS = OrderedDict([
+    ('Rss', 'rss'),
+    ('Pss', 'pss'),
+    ('Shared_Clean', 'shared'),
+    ('Shared_Dirty', 'shared'),
+    ('Private_Clean', 'private'),
+    ('Private_Dirty', 'private')
+])
+
+
+def parse_smaps(lines):
+    '''
+    Parse the content of /proc/<pid>/smaps, and return a list of
+    (path, sizes) for each mapping, where sizes are in bytes and path
+    is empty for anonymous memory
+    '''
+    mappings = []
+    for line in lines:
+        parts = line.split()
+        if not parts:
+            continue
+        if not parts[0].endswith(':'):
+            # the first line of a mapping: address perms offset dev inode [path]
+            path = parts[5] if len(parts) > 5 else ''
+            mappings.append((path, dict()))
+        elif mappings and len(parts) == 3 and parts[2] == 'kB':
+            mappings[-1][1][parts[0][:-1]] = int(parts[1]) * 1024
+    return mappings
+
+
+def _empty_totals():
+    return OrderedDict((name, 0) for name in ('rss', 'pss', 'shared', 'private'))
+
+
+def summarize_mappings(mappings, is_grammar):
+    '''
+    Sum the memory of all mappings, and the memory of the mappings
+    whose path matches is_grammar
+    '''
+    total = _empty_totals()
+    grammar = _empty_totals()
+    for path, sizes in mappings:
+        for field, name in SMAPS_FIELDS.items():
+            size = sizes.get(field, 0)
+            total[name] += size
+            if path and is_grammar(path):
+                grammar[name] += size
+    return dict(total=total, grammar_tables=grammar)
+
+
+def is_parse_table_file(path):
+    return os.path.basename(path).startswith('slr-tables-')
+
+
+def process_memory_report(smaps_file=SMAPS_FILE):
+    '''
+    Report the resident memory of this process, and of the parse table
+    files mapped in it, split in shared and private.
+
+    Returns None if smaps is not available (i.e. not on Linux).
+    '''
+    try:
+        with open(smaps_file) as fp:
+            mappings = parse_smaps(fp)
+    except IOError:
+        return None
+    return summarize_mappings(mappings, is_parse_table_file)
+
+
+def grammar_memory_report(grammar):
+    '''
+    Report the memory used by the parse tables of grammar, split in
+    mapped (shareable with other processes) and private bytes
+    '''
+    if grammar is None or not hasattr(grammar, 'parse_table_memory'):
+        return None
+    mapped, private = grammar.parse_table_memory()
+    return dict(mapped=mapped, private=private, file=grammar.tables_filename)
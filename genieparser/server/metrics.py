@@ -0,0 +1,318 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 19, 2018
+
+@author: gcampagn
+'''
+
+import time
+import bisect
+import threading
+from collections import OrderedDict
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGE_METRIC = 'genie_stage_duration_seconds'
+STAGE_METRIC_HELP = 'Time spent in each stage of handling a request'
+LANE_METRIC = 'genie_lane_duration_seconds'
+LANE_METRIC_HELP = 'Time spent in each stage of handling a request, by priority lane'
+DECODE_METRIC = 'genie_decoded_sentences_total'
+DECODE_METRIC_HELP = 'Sentences decoded with greedy search, beam search, greedy then beam search, or greedy search after beam search timed out'
+QUEUE_DEPTH_METRIC = 'genie_queue_depth'
+QUEUE_DEPTH_METRIC_HELP = 'Sentences waiting to be sent to the model'
+SHED_METRIC = 'genie_shed_requests_total'
+SHED_METRIC_HELP = 'Sentences rejected because the model was overloaded'
+
+
+class Histogram(object):
+    '''
+    A latency histogram with fixed buckets, like a Prometheus histogram.
+
+    observe() can be called from any thread.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+        # the last count is the +Inf bucket
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        '''
+        Return the cumulative count of each bucket (including +Inf),
+        and the sum of all observations
+        '''
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total
+
+    def export(self):
+        cumulative, total = self.snapshot()
+        return [list(self._buckets), cumulative, total]
+
+    @staticmethod
+    def render(name, labels, value):
+        buckets, cumulative, total = value
+        lines = []
+        for bound, count in zip(list(buckets) + ['+Inf'], cumulative):
+            bucket_labels = (labels + ',' if labels else '') + 'le="%s"' % bound
+            lines.append('%s_bucket{%s} %d' % (name, bucket_labels, count))
+        suffix = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %r' % (name, suffix, total))
+        lines.append('%s_count%s %d' % (name, suffix, cumulative[-1]))
+        return lines
+
+
+class Counter(object):
+    '''
+    A monotonically increasing count, such as the number of shed requests.
+    '''
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def export(self):
+        return self._value
+
+    @staticmethod
+    def render(name, labels, value):
+        return ['%s%s %d' % (name, '{%s}' % labels if labels else '', value)]
+
+
+class Gauge(object):
+    '''
+    A value that can go up and down, such as the length of a queue.
+    '''
+
+    def __init__(self):
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        return self._value
+
+    def export(self):
+        return self._value
+
+    @staticmethod
+    def render(name, labels, value):
+        return ['%s%s %r' % (name, '{%s}' % labels if labels else '', value)]
+
+
+class MetricFamily(object):
+    '''
+    A set of metrics of the same type with the same name, one for each
+    combination of label values.
+    '''
+
+    def __init__(self, name, help, metric_type, label_names, factory):
+        self.name = name
+        self.help = help
+        self.metric_type = metric_type
+        self.label_names = tuple(label_names)
+        self._factory = factory
+        self._children = OrderedDict()
+        self._lock = threading.Lock()
+
+    def labels(self, *label_values):
+        child = self._children.get(label_values, None)
+        if child is None:
+            with self._lock:
+                child = self._children.get(label_values, None)
+                if child is None:
+                    child = self._factory()
+                    self._children[label_values] = child
+        return child
+
+    def observe(self, value, *label_values):
+        self.labels(*label_values).observe(value)
+
+    def snapshot(self):
+        '''
+        Return the current value of all the metrics of this family, in
+        a form that can be serialized to JSON and passed to render_snapshots
+        '''
+        with self._lock:
+            children = list(self._children.items())
+        return dict(name=self.name, help=self.help, type=self.metric_type,
+                    label_names=list(self.label_names),
+                    samples=[[list(label_values), child.export()] for label_values, child in children])
+
+
+RENDERERS = {
+    'histogram': Histogram.render,
+    'counter': Counter.render,
+    'gauge': Gauge.render,
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_snapshots(snapshots):
+    '''
+    Format the metrics of one or more processes in the Prometheus text
+    exposition format.
+
+    snapshots is a list of (worker, snapshot) pairs, where snapshot comes
+    from MetricsRegistry.snapshot(). If worker is not None, every sample
+    of that process gets a worker label, so that counters and histograms
+    of different processes are never mixed.
+    '''
+    families = OrderedDict()
+    for worker, snapshot in snapshots:
+        for family in snapshot:
+            families.setdefault(family['name'], []).append((worker, family))
+
+    output = []
+    for name, instances in families.items():
+        first = instances[0][1]
+        lines = ['# HELP %s %s' % (name, first['help']),
+                 '# TYPE %s %s' % (name, first['type'])]
+        render = RENDERERS[first['type']]
+        for worker, family in instances:
+            for label_values, value in family['samples']:
+                labels = ['%s="%s"' % (label, _escape(label_value))
+                          for label, label_value in zip(family['label_names'], label_values)]
+                if worker is not None:
+                    labels.insert(0, 'worker="%s"' % worker)
+                lines += render(name, ','.join(labels), value)
+        output.append('\n'.join(lines) + '\n')
+    return ''.join(output)
+
+
+class MetricsRegistry(object):
+    '''
+    All the metrics of one server process.
+    '''
+
+    def __init__(self):
+        self._families = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _family(self, name, help, metric_type, label_names, factory):
+        with self._lock:
+            family = self._families.get(name, None)
+            if family is None:
+                family = MetricFamily(name, help, metric_type, label_names, factory)
+                self._families[name] = family
+            return family
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        '''
+        Return the histogram family with the given name, creating it
+        if necessary
+        '''
+        return self._family(name, help, 'histogram', label_names, lambda: Histogram(buckets))
+
+    def counter(self, name, help, label_names=()):
+        return self._family(name, help, 'counter', label_names, Counter)
+
+    def gauge(self, name, help, label_names=()):
+        return self._family(name, help, 'gauge', label_names, Gauge)
+
+    def stages(self, tag):
+        return StageMetrics(self, tag)
+
+    def snapshot(self):
+        with self._lock:
+            families = list(self._families.values())
+        return [family.snapshot() for family in families]
+
+    def render(self):
+        '''
+        Format all metrics in the Prometheus text exposition format
+        '''
+        return render_snapshots([(None, self.snapshot())])
+
+
+class StageMetrics(object):
+    '''
+    The per-stage latency histograms and the queueing metrics of one
+    language and model tag.
+    '''
+
+    def __init__(self, registry, tag):
+        self._registry = registry
+        self._family = registry.histogram(STAGE_METRIC, STAGE_METRIC_HELP, ('tag', 'stage'))
+        self._tag = tag
+        self._stages = dict()
+        self._lanes = dict()
+        self._queue_depths = dict()
+
+    def observe(self, stage, seconds):
+        histogram = self._stages.get(stage, None)
+        if histogram is None:
+            histogram = self._family.labels(self._tag, stage)
+            self._stages[stage] = histogram
+        histogram.observe(seconds)
+
+    def observe_since(self, stage, start):
+        self.observe(stage, time.monotonic() - start)
+
+    def observe_lane(self, lane, stage, seconds):
+        histogram = self._lanes.get((lane, stage), None)
+        if histogram is None:
+            histogram = self._registry.histogram(LANE_METRIC, LANE_METRIC_HELP,
+                                                 ('tag', 'lane', 'stage')).labels(self._tag, lane, stage)
+            self._lanes[(lane, stage)] = histogram
+        histogram.observe(seconds)
+
+    def set_queue_depth(self, lane, depth):
+        gauge = self._queue_depths.get(lane, None)
+        if gauge is None:
+            gauge = self._registry.gauge(QUEUE_DEPTH_METRIC, QUEUE_DEPTH_METRIC_HELP,
+                                         ('tag', 'lane')).labels(self._tag, lane)
+            self._queue_depths[lane] = gauge
+        gauge.set(depth)
+
+    def count_decode(self, strategy):
+        self._registry.counter(DECODE_METRIC, DECODE_METRIC_HELP,
+                               ('tag', 'strategy')).labels(self._tag, strategy).inc()
+
+    def shed(self, lane, reason):
+        self._registry.counter(SHED_METRIC, SHED_METRIC_HELP,
+                               ('tag', 'lane', 'reason')).labels(self._tag, lane, reason).inc()
@@ -21,7 +21,9 @@ Created on Aug 9, 2018
 '''
 
 import os
+import time
 
+import numpy as np
 import tensorflow as tf
 
 from tensor2tensor.utils import flags
@@ -29,6 +31,66 @@ from tensor2tensor.utils import trainer_lib
 from tensor2tensor.utils import decoding
 from tensor2tensor.utils import t2t_model
 
+# the signature that decodes with greedy search, in addition to the default
+# signature that uses the decode_hparams of the model
+GREEDY_SIGNATURE = 'greedy'
+
+# the signature that returns the encoding of each sentence, used to
+# answer MultipleChoice queries
+ENCODER_SIGNATURE = 'encoded_inputs'
+
+def pad_to_batch(batch):
+    '''
+    Pack a list of tokenized sentences of different length into
+    a single string matrix, suitable for "inputs/string"
+    '''
+    max_len = max(len(tokens) for tokens in batch)
+    batch_size = len(batch)
+
+    matrix = np.empty((batch_size, max_len), dtype=np.object)
+    for i in range(batch_size):
+        item_len = len(batch[i])
+        matrix[i, :item_len] = batch[i]
+        matrix[i, item_len:] = np.zeros((max_len - item_len,),
+                                        dtype=np.str)
+    return matrix
+
+
+def decode_candidates(predicted, limit):
+    '''
+    Convert the predictions of a decoding signature for one sentence into
+    a list of candidates (dicts with code and score), best first.
+
+    Candidates that could not be reconstructed into a valid program
+    (empty output) or that contain unknown tokens are skipped.
+    '''
+    outputs = predicted["outputs"]
+    
+    if len(outputs.shape) == 1:
+        # add beam dimension if we're using greedy decoding
+        outputs = np.expand_dims(outputs, axis=0)
+        if "scores" in predicted:
+            scores = [predicted["scores"]]
+        else:
+            scores = [1]
+    else:
+        scores = predicted["scores"]
+    
+    results = []
+    for decoded, score in zip(outputs, scores):
+        decoded = [x.decode('utf-8') for x in decoded if x != b'']
+        if len(decoded) == 0:
+            # grammar error, skip
+            continue
+        if any(x == '<unk>' for x in decoded):
+            continue
+        json_rep = dict(code=decoded, score=float(score))
+        results.append(json_rep)
+        if limit >= 0 and len(results) >= limit:
+            break
+    return results
+
+
 class Signature(object):
     def __init__(self, name, placeholders, predictions):
         self._name = name
@@ -39,14 +101,29 @@ class Signature(object):
     def name(self):
         return self._name
 
-    def __call__(self, session, inputs):
+    def __call__(self, session, inputs, timeout=None):
+        if timeout is not None:
+            # Tensorflow cancels the step and raises DeadlineExceededError
+            # when it takes longer than timeout_in_ms
+            options = tf.RunOptions(timeout_in_ms=max(1, int(timeout * 1000)))
+        else:
+            options = None
         return session.run(self._predictions, feed_dict={
             self._placeholders[k]: v for k, v in inputs.items()
-        })
+        }, options=options)
 
 class Predictor(object):
-    def __init__(self, model_dir, config):
+    '''
+    Load a model checkpoint and run its prediction signatures.
+
+    If greedy is True and the model uses beam search, the graph also
+    contains a GREEDY_SIGNATURE that decodes with the same weights
+    using greedy search.
+    '''
+
+    def __init__(self, model_dir, config, metrics=None, greedy=False):
         self._signatures = dict()
+        self._metrics = metrics
         
         self._graph = tf.Graph()
         with self._graph.as_default():
@@ -65,38 +142,78 @@ class Predictor(object):
                                                        model_dir=model_dir,
                                                        schedule="decode")
             
-            model_fn = t2t_model.T2TModel.make_estimator_model_fn(
-                config['model'], self._hparams, decode_hparams=decode_hp)
-            
             # create the orediction signatures (input/output ops)
             serving_receiver = problem.direct_serving_input_fn(self._hparams)
+            self._add_signatures(config, decode_hp, serving_receiver, run_config)
+            
+            if greedy and decode_hp.beam_size > 1:
+                # build the decoder a second time, sharing the variables
+                greedy_hp = decoding.decode_hparams(config.get('decode_hparams', ''))
+                greedy_hp.set_hparam('beam_size', 1)
+                greedy_hp.set_hparam('return_beams', False)
+                self._add_signatures(config, greedy_hp, serving_receiver, run_config,
+                                     only_key=tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY,
+                                     rename_to=GREEDY_SIGNATURE)
+            
+            # load the model & init the session
+            self._session = self._create_session(model_dir, run_config)
+
+    def _create_session(self, model_dir, run_config):
+        scaffold = tf.train.Scaffold()
+        checkpoint_filename = os.path.join(model_dir,
+                                           tf.saved_model.constants.VARIABLES_DIRECTORY,
+                                           tf.saved_model.constants.VARIABLES_FILENAME)
+        session_creator = tf.train.ChiefSessionCreator(scaffold,
+                                                       config=run_config.session_config,
+                                                       checkpoint_filename_with_path=checkpoint_filename)
+        return tf.train.MonitoredSession(session_creator=session_creator)
+
+    def _add_signatures(self, config, decode_hp, serving_receiver, run_config,
+                        only_key=None, rename_to=None):
+        model_fn = t2t_model.T2TModel.make_estimator_model_fn(
+            config['model'], self._hparams, decode_hparams=decode_hp)
+        
+        with tf.variable_scope(tf.get_variable_scope(), reuse=tf.AUTO_REUSE):
             estimator_spec = model_fn(serving_receiver.features, None,
                                       mode=tf.estimator.ModeKeys.PREDICT,
                                       params=None,
                                       config=run_config)
+        
+        for key, sig_spec in estimator_spec.export_outputs.items():
+            if only_key is not None and key != only_key:
+                continue
+            # only PredictOutputs are supported, ClassificationOutput
+            # and RegressionOutputs are weird artifacts of Google shipping
+            # almost unmodified Tensorflow graphs through their Cloud ML
+            # platform
+            assert isinstance(sig_spec, tf.estimator.export.PredictOutput)
             
-            for key, sig_spec in estimator_spec.export_outputs.items():
-                # only PredictOutputs are supported, ClassificationOutput
-                # and RegressionOutputs are weird artifacts of Google shipping
-                # almost unmodified Tensorflow graphs through their Cloud ML
-                # platform
-                assert isinstance(sig_spec, tf.estimator.export.PredictOutput)
-                
-                sig = Signature(key,
-                                serving_receiver.receiver_tensors,
-                                sig_spec.outputs)
-                self._signatures[key] = sig
-            
-            # load the model & init the session
-            
-            scaffold = tf.train.Scaffold()
-            checkpoint_filename = os.path.join(model_dir,
-                                               tf.saved_model.constants.VARIABLES_DIRECTORY,
-                                               tf.saved_model.constants.VARIABLES_FILENAME)
-            session_creator = tf.train.ChiefSessionCreator(scaffold,
-                                                           config=run_config.session_config,
-                                                           checkpoint_filename_with_path=checkpoint_filename)
-            self._session = tf.train.MonitoredSession(session_creator=session_creator)
+            key = rename_to or key
+            sig = Signature(key,
+                            serving_receiver.receiver_tensors,
+                            sig_spec.outputs)
+            self._signatures[key] = sig
+
+    def close(self):
+        self._session.close()
+
+    def warm_up(self, sentences, batch_sizes):
+        '''
+        Run the given tokenized sentences through the model at each
+        batch size, so the lazy initialization of the session happens
+        before the first real query.
+
+        Warmup runs are not recorded in the metrics.
+        '''
+        for key in (tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY, GREEDY_SIGNATURE):
+            signature = self._signatures.get(key, None)
+            if signature is None:
+                continue
+            for batch_size in batch_sizes:
+                batch = [sentences[i % len(sentences)] for i in range(batch_size)]
+                signature(self._session, {
+                    "inputs/string": pad_to_batch(batch)
+                })
 
     @property
     def problem(self):
@@ -106,8 +223,26 @@ class Predictor(object):
     def signatures(self):
         return self._signatures.keys()
          
-    def predict(self, inputs, signature_key=None):
+    def predict(self, inputs, signature_key=None, deadline=None):
+        '''
+        Run the inputs through the given signature.
+
+        deadline is the time.monotonic() value at which the computation
+        is abandoned with tf.errors.DeadlineExceededError, or None to
+        never time out.
+        '''
         if signature_key is None:
             signature_key = tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY
         
-        return self._signatures[signature_key](self._session, inputs)
+        signature = self._signatures[signature_key]
+        start = time.monotonic()
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - start
+            if timeout <= 0:
+                raise tf.errors.DeadlineExceededError(None, None, 'Deadline expired before running the model')
+        result = signature(self._session, inputs, timeout)
+        if self._metrics is not None:
+            self._metrics.observe_since('greedy_session_run' if signature_key == GREEDY_SIGNATURE
+                                        else 'session_run', start)
+        return result
@@ -24,12 +24,19 @@ import numpy as np
 import tornado.web
 import tornado.gen
 import tornado.concurrent
+import tornado.locks
+from tornado.iostream import StreamClosedError
 import sys
+import json
+import time
 import datetime
 import semver
+from collections import deque
 
 from .constants import LATEST_THINGTALK_VERSION, DEFAULT_THINGTALK_VERSION
 from .tokenizer import TokenizerResult
+from .predictor import decode_candidates, ENCODER_SIGNATURE
+from .batcher import OverloadedError, ModelTimeoutError, INTERACTIVE, BULK, LANES
 
 class TokenizeHandler(tornado.web.RequestHandler):
     '''
@@ -41,7 +48,7 @@ class TokenizeHandler(tornado.web.RequestHandler):
         self.set_header('Access-Control-Allow-Origin', '*')
 
         query = self.get_query_argument("q")
-        language = self.application.get_language(locale, model_tag)
+        language = yield self.application.get_language(locale, model_tag)
         
         #print('GET /%s/tokenize' % locale, query)
         tokenized = yield language.tokenizer.tokenize(query)
@@ -65,72 +72,125 @@ def clean_tokens(tokens):
             yield t
 
 
-def _pad_to_batch(batch):
-    max_len = max(len(tokens) for tokens in batch)
-    batch_size = len(batch)
-
-    matrix = np.empty((batch_size, max_len), dtype=np.object)
-    for i in range(batch_size):
-        item_len = len(batch[i])
-        matrix[i, :item_len] = batch[i]
-        matrix[i, item_len:] = np.zeros((max_len - item_len,),
-                                        dtype=np.str)
-    return matrix
+def is_valid_query(query, is_tokenized):
+    if isinstance(query, list):
+        return is_tokenized and all(isinstance(token, str) and token for token in query)
+    return isinstance(query, str)
 
 
 class QueryHandler(tornado.web.RequestHandler):
     '''
     Handle /query
+
+    The priority argument (interactive or bulk) selects the lane of the
+    prediction queue; interactive queries are scheduled ahead of bulk ones.
     '''
     def __init__(self, app, request):
         super().__init__(app, request)
         
         self.executor = app.thread_pool
+        self._acquired_language = None
+        self._priority = INTERACTIVE
+
+    @tornado.gen.coroutine
+    def _get_language(self, locale, model_tag):
+        language = yield self.application.get_language(locale, model_tag)
+        # keep the model open until this request is done, even if it is reloaded
+        language.acquire()
+        self._acquired_language = language
+        return language
+
+    def _release_language(self):
+        if self._acquired_language is not None:
+            self._acquired_language.release()
+            self._acquired_language = None
+
+    def on_finish(self):
+        self._release_language()
+
+    def write_error(self, status_code, **kwargs):
+        exc_info = kwargs.get('exc_info', None)
+        if exc_info is not None and isinstance(exc_info[1], OverloadedError):
+            self.set_header('Retry-After', str(self.application.config.retry_after))
+        super().write_error(status_code, **kwargs)
+
+    def _parse_priority(self, default):
+        priority = self.get_query_argument('priority', default=default)
+        if priority not in LANES:
+            raise tornado.web.HTTPError(400, reason='Invalid priority argument')
+        self._priority = priority
+
+    def _query_deadline(self):
+        deadline_ms = self.application.config.query_deadline_ms
+        if deadline_ms <= 0:
+            return None
+        return time.monotonic() + deadline_ms / 1000
     
-    @tornado.concurrent.run_on_executor
-    def _do_run_query(self, language, tokenized, limit):
+    @tornado.gen.coroutine
+    def _run_greedy(self, language, tokens, limit, deadline):
+        predicted = yield language.greedy_batcher.predict(tokens, deadline, self._priority)
+        start = time.monotonic()
+        results = decode_candidates(predicted, limit)
+        language.metrics.observe_since('decode', start)
+        return results
+
+    @tornado.gen.coroutine
+    def _do_run_query(self, language, tokenized, limit, deadline):
+        '''
+        Predict the candidates for one sentence.
+
+        Returns the candidates, and whether they are the complete result
+        (as opposed to the greedy result returned when beam search timed
+        out), which is the only one that can be cached.
+        '''
         tokens = list(clean_tokens(tokenized.tokens))
         
         # ignore the constituency parse
         # parse = tokenized.constituency_parse
 
-        predicted = language.predictor.predict({
-            # wrap into a batch of 1
-            "inputs/string": [tokens]
-        })
-        outputs = predicted["outputs"][0]
-        
-        if len(outputs.shape) == 1:
-            # add beam dimension if we're using greedy decoding
-            outputs = np.expand_dims(outputs, axis=0)
-            scores = [1]
+        # the batcher will merge this sentence with other concurrent
+        # requests for the same model, and give us back our own row
+        greedy_results = None
+        if language.greedy_batcher is not None and 0 <= limit <= 1:
+            # try greedy search first, it is much cheaper than beam search
+            # and it is usually good enough when only the best result is needed
+            greedy_results = yield self._run_greedy(language, tokens, limit, deadline)
+            if len(greedy_results) > 0 and greedy_results[0]['score'] >= self.application.config.greedy_min_score:
+                language.metrics.count_decode('greedy')
+                return greedy_results, True
+            language.metrics.count_decode('beam_fallback')
         else:
-            scores = predicted["scores"][0]
-        
-        results = []
-        for decoded, score in zip(outputs, scores):
-            decoded = [x.decode('utf-8') for x in decoded if x != b'']
-            if len(decoded) == 0:
-                # grammar error, skip
-                continue
-            if any(x == '<unk>' for x in decoded):
-                continue
-            json_rep = dict(code=decoded, score=float(score))
-            results.append(json_rep)
-            if limit >= 0 and len(results) >= limit:
-                break
-        return results
+            language.metrics.count_decode('beam')
+
+        try:
+            predicted = yield language.batcher.predict(tokens, deadline, self._priority)
+        except ModelTimeoutError:
+            if language.greedy_batcher is None:
+                raise
+            # degrade to greedy search, which has a new deadline of its own
+            # because the original one has expired already
+            language.metrics.count_decode('greedy_after_timeout')
+            if greedy_results is None:
+                greedy_results = yield self._run_greedy(language, tokens, limit, self._query_deadline())
+            return greedy_results, False
+        start = time.monotonic()
+        results = decode_candidates(predicted, limit)
+        language.metrics.observe_since('decode', start)
+        return results, True
     
-    @tornado.concurrent.run_on_executor
-    def _run_retrieval_query(self, language, tokens, choices, limit):
+    @tornado.gen.coroutine
+    def _run_retrieval_query(self, language, tokens, choices, limit, deadline):
+        if language.encoder_batcher is None:
+            raise tornado.web.HTTPError(400, reason='MultipleChoice is not supported by this model')
         choice_list = list(choices.keys())
         
-        predicted = language.predictor.predict({
-            # wrap into a single batch both input and choices
-            "inputs/string": _pad_to_batch([tokens] +
-                                           [choices[c_id].tokens for c_id in choice_list])
-        }, signature_key="encoded_inputs")
-        encoded = predicted["encoded_inputs"]
+        # the input and the choices go through the same queue as all other
+        # queries, so they are subject to the same limits and deadline
+        # they are queued all together, or not at all if the queue is full
+        futures = language.encoder_batcher.predict_many([tokens] + [choices[c_id].tokens for c_id in choice_list],
+                                                        deadline, self._priority)
+        predicted = yield tornado.gen.multi(futures, quiet_exceptions=OverloadedError)
+        encoded = [row[ENCODER_SIGNATURE] for row in predicted]
 
         input_encoded = encoded[0]
         input_norm = np.linalg.norm(input_encoded, ord=2)
@@ -151,6 +211,51 @@ class QueryHandler(tornado.web.RequestHandler):
         results = results[:limit]
         return results
 
+    @tornado.gen.coroutine
+    def _compute_query(self, language, tokenized, limit, cache_key, deadline):
+        if language.exact:
+            start = time.monotonic()
+            exact = language.exact.get(' '.join(tokenized.tokens))
+            language.metrics.observe_since('exact_match', start)
+        else:
+            exact = None
+        try:
+            result, complete = yield self._do_run_query(language, tokenized, limit, deadline)
+        except OverloadedError:
+            if not exact:
+                raise
+            # the exact matches are still a good answer, but they must
+            # not be cached in place of the full result
+            return exact, []
+        if complete and not language.retired:
+            self.application.query_cache.put(cache_key, (exact, result))
+        return exact, result
+
+    @tornado.gen.coroutine
+    def _run_cached_query(self, language, tokenized, limit, expect, deadline):
+        cache = self.application.query_cache
+        # the generation is part of the key, so a query that arrives after a
+        # reload never gets (or caches) a result of the old model
+        cache_key = (language.language_tag, language.model_tag, language.generation,
+                     tuple(tokenized.tokens), limit, expect)
+        
+        cached = cache.get(cache_key)
+        if cached is None:
+            # if an identical query is already being predicted, wait for
+            # that instead of sending another one to the model
+            # the lane is part of the key, so a bulk query never makes an
+            # interactive one wait in the bulk lane
+            cached = yield self.application.inflight_queries.run(cache_key + (self._priority,), self._compute_query,
+                                                                 language, tokenized, limit, cache_key, deadline)
+        
+        # _apply_compatibility modifies the candidates in place, so we
+        # must never hand out the lists stored in the cache
+        exact, result = cached
+        if exact is not None:
+            exact = [list(code) for code in exact]
+        result = [dict(candidate, code=list(candidate['code'])) for candidate in result]
+        return exact, result
+
     def _apply_compatibility(self, results, thingtalk_version):
         if semver.match(thingtalk_version, "<1.3.0"):
             # convert stream-join "=>" to "join" 
@@ -183,13 +288,9 @@ class QueryHandler(tornado.web.RequestHandler):
                         code[i] = 'join'
 
     @tornado.gen.coroutine
-    def get(self, model_tag=None, **kw):
-        self.set_header('Access-Control-Allow-Origin', '*')
-
-        query = self.get_query_argument("q")
+    def _parse_arguments(self, model_tag, kw):
         locale = kw.get('locale', None) or self.get_query_argument("locale", default="en-US")
         store = self.get_query_argument("store", "yes")
-        language = self.application.get_language(locale, model_tag)
         thingtalk_version = self.get_argument("thingtalk_version",
                                               DEFAULT_THINGTALK_VERSION)
         try:
@@ -200,16 +301,26 @@ class QueryHandler(tornado.web.RequestHandler):
             raise tornado.web.HTTPError(400, reason='Invalid store argument')
         expect = self.get_query_argument('expect', default=None)
         is_tokenized = bool(self.get_query_argument("tokenized", None))
-        #print('GET /%s/query' % locale, query)
+        language = yield self._get_language(locale, model_tag)
+        return language, store, thingtalk_version, limit, expect, is_tokenized
 
+    def _tokenize(self, language, query, expect, is_tokenized):
         if is_tokenized:
-            tokenized = TokenizerResult(tokens=query.split(' '), values=dict(),
-                                        constituency_parse=None, raw_tokens=query.split(' '),
+            tokens = query if isinstance(query, list) else query.split(' ')
+            tokenized = TokenizerResult(tokens=tokens, values=dict(),
+                                        constituency_parse=None, raw_tokens=tokens,
                                         sentiment='neutral', pos_tags=[])
+            future = tornado.concurrent.Future()
+            future.set_result(tokenized)
+            return future
         else:
-            tokenized = yield language.tokenizer.tokenize(query, expect)
-        #print("Tokenized", tokenized.tokens, tokenized.values)
-        
+            start = time.monotonic()
+            future = language.tokenizer.tokenize(query, expect)
+            future.add_done_callback(lambda _: language.metrics.observe_since('tokenize', start))
+            return future
+
+    @tornado.gen.coroutine
+    def _run_query(self, language, tokenized, limit, expect, store, thingtalk_version, choices=None, deadline=None):
         result = None
         exact = None
         tokens = tokenized.tokens
@@ -219,6 +330,59 @@ class QueryHandler(tornado.web.RequestHandler):
             # if the whole input is just an entity, return that as an answer
             result = [dict(code=['bookkeeping', 'answer', tokens[0]], score='Infinity')]
         elif expect == 'MultipleChoice':
+            result = yield self._run_retrieval_query(language, tokens, choices, limit, deadline)
+        else:
+            exact, result = yield self._run_cached_query(language, tokenized, limit, expect, deadline)
+        
+        if self.application.utterance_log and store != 'no' and expect != 'MultipleChoice' and len(tokens) > 0:
+            # this is buffered and written to the database in the background
+            self.application.utterance_log.log(language=language.tag,
+                                               preprocessed=' '.join(tokens),
+                                               target_code=' '.join(result[0]['code'] if len(result) > 0 else []))
+
+        if exact is not None:
+            result = [dict(code=x, score='Infinity') for x in exact] + result
+        
+        self._apply_compatibility(result, thingtalk_version)
+        return result
+
+    @tornado.gen.coroutine
+    def _run_sentence(self, language, query, limit, expect, store, thingtalk_version, is_tokenized, deadline):
+        '''
+        Parse one sentence of a batch or streaming request into a /query-style
+        object, or an object with a single "error" key if it cannot be parsed.
+
+        OverloadedError is raised instead, so the caller can choose whether
+        the whole request fails with 503.
+        '''
+        if not is_valid_query(query, is_tokenized):
+            return dict(error='Invalid sentence')
+        try:
+            tokenized = yield self._tokenize(language, query, expect, is_tokenized)
+            result = yield self._run_query(language, tokenized, limit, expect, store, thingtalk_version,
+                                           deadline=deadline)
+        except OverloadedError:
+            raise
+        except Exception as e:
+            return dict(error=str(e))
+        return dict(candidates=result, tokens=tokenized.tokens, entities=tokenized.values)
+
+    @tornado.gen.coroutine
+    def get(self, model_tag=None, **kw):
+        self.set_header('Access-Control-Allow-Origin', '*')
+
+        query = self.get_query_argument("q")
+        self._parse_priority(INTERACTIVE)
+        language, store, thingtalk_version, limit, expect, is_tokenized = yield self._parse_arguments(model_tag, kw)
+        # loading the model on demand does not count against the deadline
+        deadline = self._query_deadline()
+        #print('GET /%s/query' % locale, query)
+
+        tokenized = yield self._tokenize(language, query, expect, is_tokenized)
+        #print("Tokenized", tokenized.tokens, tokenized.values)
+        
+        choices = None
+        if expect == 'MultipleChoice':
             choices = dict()
             for arg in self.request.query_arguments:
                 if arg == 'choices[]':
@@ -226,30 +390,191 @@ class QueryHandler(tornado.web.RequestHandler):
                         choices[len(choices)] = yield language.tokenizer.tokenize(choice, expect)
                 elif arg.startswith('choices['):
                     choices[arg[len('choices['):-1]] = yield language.tokenizer.tokenize(self.get_query_argument(arg), expect)
-            
-            result = yield self._run_retrieval_query(language, tokens, choices, limit)
-        elif result is None and language.exact:
-            exact = language.exact.get(' '.join(tokens))
-                
-        if result is None:
-            result = yield self._do_run_query(language, tokenized, limit)
-        
-        if self.application.database and store != 'no' and expect != 'MultipleChoice' and len(tokens) > 0:
-            self.application.database.execute("insert into utterance_log (language, preprocessed, target_code) " +
-                                              "values (%(language)s, %(preprocessed)s, %(target_code)s)",
-                                              language=language.tag,
-                                              preprocessed=' '.join(tokens),
-                                              target_code=' '.join(result[0]['code'] if len(result) > 0 else []))
 
-        if exact is not None:
-            result = [dict(code=x, score='Infinity') for x in exact] + result
-        
-        self._apply_compatibility(result, thingtalk_version)
+        result = yield self._run_query(language, tokenized, limit, expect, store, thingtalk_version, choices,
+                                       deadline=deadline)
         
         sys.stdout.flush()
         #cache_time = 3600
         #self.set_header("Expires", datetime.datetime.utcnow() + datetime.timedelta(seconds=cache_time))
         #self.set_header("Cache-Control", "public,max-age=" + str(cache_time))
         self.set_header("Cache-Control", "no-store,must-revalidate")
-        self.write(dict(candidates=result, tokens=tokens, entities=tokenized.values))
+        self.write(dict(candidates=result, tokens=tokenized.tokens, entities=tokenized.values))
+        self.finish()
+        language.metrics.observe('query', self.request.request_time())
+        language.metrics.observe_lane(self._priority, 'query', self.request.request_time())
+
+
+class BatchQueryHandler(QueryHandler):
+    '''
+    Handle POST /query/batch
+
+    The body is a JSON list of sentences, either strings or (if tokenized
+    is set) lists of tokens. The query arguments are the same as /query,
+    and apply to all sentences. The response contains one entry for each
+    sentence, in the same order, with the same format as /query. Sentences
+    that cannot be parsed produce an object with a single "error" key
+    instead; if the model is overloaded, the whole request fails with 503.
+
+    All the sentences are tokenized concurrently, and go through the same
+    batcher as individual queries, so they are predicted in large batches.
+    They are in the bulk lane, unless priority=interactive is given.
+    '''
+
+    @tornado.gen.coroutine
+    def post(self, model_tag=None, **kw):
+        self.set_header('Access-Control-Allow-Origin', '*')
+
+        self._parse_priority(BULK)
+        language, store, thingtalk_version, limit, expect, is_tokenized = yield self._parse_arguments(model_tag, kw)
+        deadline = self._query_deadline()
+        if expect == 'MultipleChoice':
+            raise tornado.web.HTTPError(400, reason='MultipleChoice is not supported in batch queries')
+        try:
+            queries = json.loads(str(self.request.body, encoding='utf-8'))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='Invalid JSON body')
+        if not isinstance(queries, list):
+            raise tornado.web.HTTPError(400, reason='Body must be a list of sentences')
+        if len(queries) > self.application.config.max_queries_per_request:
+            raise tornado.web.HTTPError(413, reason='Too many sentences in one request')
+
+        # if the model is overloaded, the whole request fails with the first error
+        results = yield tornado.gen.multi([self._run_sentence(language, query, limit, expect, store,
+                                                              thingtalk_version, is_tokenized, deadline)
+                                           for query in queries],
+                                          quiet_exceptions=OverloadedError)
+
+        self.set_header("Cache-Control", "no-store,must-revalidate")
+        self.write(dict(results=results))
+        self.finish()
+        language.metrics.observe('batch_query', self.request.request_time())
+        language.metrics.observe_lane(self._priority, 'batch_query', self.request.request_time())
+
+
+@tornado.web.stream_request_body
+class StreamingQueryHandler(QueryHandler):
+    '''
+    Handle POST /query/stream
+
+    The body is newline-delimited JSON, with one sentence per line (a string,
+    or a list of tokens if tokenized is set). The response is also
+    newline-delimited JSON, with one /query-style object per sentence, in the
+    same order. Sentences that cannot be parsed produce an object with a
+    single "error" key instead.
+
+    Results are sent as soon as they are ready, and the server stops reading
+    the body while max_inflight_per_stream sentences are being parsed, so
+    neither side needs to hold the whole corpus in memory.
+
+    Like /query/batch, sentences are in the bulk lane by default.
+    '''
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        # flow control bounds memory usage, so the body can be arbitrarily large
+        self.request.connection.set_max_body_size(sys.maxsize)
+        self.set_header('Access-Control-Allow-Origin', '*')
+
+        self._buffer = b''
+        self._pending = deque()
+        self._pending_changed = tornado.locks.Condition()
+        self._inflight = tornado.locks.Semaphore(self.application.config.max_inflight_per_stream)
+        self._body_done = False
+        self._closed = False
+        self._writer = None
+
+        self._parse_priority(BULK)
+        kw = self.path_kwargs
+        self._language, self._store, self._thingtalk_version, self._limit, self._expect, self._is_tokenized = \
+            yield self._parse_arguments(kw.get('model_tag', None), kw)
+        if self._expect == 'MultipleChoice':
+            raise tornado.web.HTTPError(400, reason='MultipleChoice is not supported in batch queries')
+        if self._closed:
+            # the client went away while the model was loading
+            self._release_language()
+            return
+
+        self.set_header('Content-Type', 'application/x-ndjson')
+        self.set_header("Cache-Control", "no-store,must-revalidate")
+        self._writer = self._write_results()
+
+    @tornado.gen.coroutine
+    def data_received(self, chunk):
+        lines = (self._buffer + chunk).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            yield self._submit(line)
+
+    @tornado.gen.coroutine
+    def _submit(self, line):
+        line = line.strip()
+        if not line:
+            return
+        # tornado does not read more of the body until this returns
+        yield self._inflight.acquire()
+        self._pending.append(self._run_line(line))
+        self._pending_changed.notify()
+
+    @tornado.gen.coroutine
+    def _run_line(self, line):
+        # each sentence has its own deadline, counted from when it was read
+        deadline = self._query_deadline()
+        try:
+            query = json.loads(str(line, encoding='utf-8'))
+        except ValueError:
+            return dict(error='Invalid JSON')
+
+        try:
+            result = yield self._run_sentence(self._language, query, self._limit, self._expect, self._store,
+                                              self._thingtalk_version, self._is_tokenized, deadline)
+        except OverloadedError as e:
+            # the response has started already, so it cannot fail with 503
+            return dict(error=str(e))
+        return result
+
+    @tornado.gen.coroutine
+    def _flush(self):
+        if self._closed:
+            return
+        try:
+            yield self.flush()
+        except StreamClosedError:
+            self._closed = True
+
+    @tornado.gen.coroutine
+    def _write_results(self):
+        while True:
+            while not self._pending:
+                if self._body_done:
+                    return
+                yield self._pending_changed.wait()
+
+            future = self._pending[0]
+            if not future.done():
+                # send what we have so far while we wait for the next result
+                yield self._flush()
+                yield future
+            self._pending.popleft()
+            self._inflight.release()
+            if not self._closed:
+                self.write(json.dumps(future.result()) + '\n')
+
+    def on_connection_close(self):
+        self._closed = True
+        if self._writer is not None and not self._body_done:
+            # post() will not be called, so finish() will not be called either:
+            # release the model once the sentences we already read are done
+            self._body_done = True
+            self._pending_changed.notify()
+            self._writer.add_done_callback(lambda _: self._release_language())
+
+    @tornado.gen.coroutine
+    def post(self, model_tag=None, **kw):
+        yield self._submit(self._buffer)
+        self._buffer = b''
+        self._body_done = True
+        self._pending_changed.notify()
+
+        yield self._writer
         self.finish()
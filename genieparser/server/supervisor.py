@@ -0,0 +1,349 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 16, 2018
+
+@author: gcampagn
+'''
+
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import selectors
+import traceback
+
+import tornado.gen
+import tornado.ioloop
+from tornado.concurrent import Future
+from tornado.iostream import IOStream, StreamClosedError
+
+import tensorflow as tf
+
+# a worker that dies sooner than this after starting is restarted
+# with exponential backoff
+MIN_WORKER_UPTIME = 10
+MAX_RESTART_DELAY = 30
+
+# the same default as tornado.netutil.bind_sockets
+LISTEN_BACKLOG = 128
+
+
+def bind_port(port, reuse_port=False):
+    '''
+    Bind a socket to port on every address, like tornado.netutil.bind_sockets,
+    but do not listen on it yet.
+
+    Until listen_sockets() is called, no connection is accepted, and with
+    SO_REUSEPORT the kernel does not send any connection to this process,
+    so a worker can bind a privileged port before dropping privileges,
+    and only join the other workers once it is ready to serve.
+    '''
+    sockets = []
+    for family, socktype, proto, _, sockaddr in set(socket.getaddrinfo(None, port, socket.AF_UNSPEC,
+                                                                       socket.SOCK_STREAM, 0, socket.AI_PASSIVE)):
+        try:
+            sock = socket.socket(family, socktype, proto)
+        except OSError as e:
+            if e.errno == errno.EAFNOSUPPORT:
+                continue
+            raise
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:
+            # the IPv4 address has its own socket
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(False)
+        sock.bind(sockaddr)
+        sockets.append(sock)
+    return sockets
+
+
+def listen_sockets(server, sockets):
+    '''
+    Start accepting connections on the sockets from bind_port()
+    with the given tornado TCPServer (or HTTPServer)
+    '''
+    for sock in sockets:
+        sock.listen(LISTEN_BACKLOG)
+    server.add_sockets(sockets)
+
+
+class _WorkerProcess(object):
+    def __init__(self, index, pid, sock):
+        self.index = index
+        self.pid = pid
+        self.sock = sock
+        self.started = time.monotonic()
+        self.buffer = b''
+
+
+class Supervisor(object):
+    '''
+    Run the server in multiple worker processes.
+
+    Each worker is forked from the supervisor before any model or IOLoop is
+    created, and is connected to the supervisor by a socket pair that carries
+    newline-delimited JSON messages. Workers send a "ready" message once they
+    are listening, which they only do after loading the models (see
+    bind_port); every other message is forwarded to all other workers,
+    which is how reloads are propagated, except for messages with a "to"
+    field, which only go to the worker with that index (see
+    SupervisorConnection.request).
+
+    The supervisor itself does not serve any request, it only restarts
+    workers that exit, and stops all of them on SIGTERM or SIGINT.
+    '''
+
+    def __init__(self, num_workers, worker_main, on_ready=None):
+        # worker_main(index, sock) runs in the child process
+        self._num_workers = num_workers
+        self._worker_main = worker_main
+        self._on_ready = on_ready
+
+        self._selector = selectors.DefaultSelector()
+        self._workers = dict()
+        self._restart_delays = dict()
+        self._pending_restarts = dict()
+        self._ready = set()
+        self._notified_ready = False
+        self._stopping = False
+
+    def _spawn(self, index):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            # in the child
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                parent_sock.close()
+                for worker in self._workers.values():
+                    worker.sock.close()
+                self._selector.close()
+
+                self._worker_main(index, child_sock)
+            except:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+
+        child_sock.close()
+        worker = _WorkerProcess(index, pid, parent_sock)
+        self._workers[pid] = worker
+        self._selector.register(parent_sock, selectors.EVENT_READ, worker)
+        tf.logging.info('Started worker %d (pid %d)', index, pid)
+
+    def _send(self, worker, line):
+        try:
+            worker.sock.sendall(line)
+        except OSError as e:
+            # the worker is dying, it will be reaped soon
+            tf.logging.warning('Failed to send message to worker %d: %s', worker.index, e)
+
+    def _handle_message(self, worker, line):
+        try:
+            message = json.loads(str(line, encoding='utf-8'))
+        except ValueError:
+            tf.logging.warning('Invalid message from worker %d', worker.index)
+            return
+
+        if message.get('op') == 'ready':
+            self._ready.add(worker.index)
+            if not self._notified_ready and len(self._ready) == self._num_workers:
+                self._notified_ready = True
+                tf.logging.info('All %d workers are ready', self._num_workers)
+                if self._on_ready:
+                    self._on_ready()
+            return
+
+        to = message.get('to', None)
+        for other in list(self._workers.values()):
+            if other is not worker and (to is None or other.index == to):
+                self._send(other, line + b'\n')
+
+    def _read(self, worker):
+        try:
+            data = worker.sock.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self._selector.unregister(worker.sock)
+            return
+
+        lines = (worker.buffer + data).split(b'\n')
+        worker.buffer = lines.pop()
+        for line in lines:
+            if line:
+                self._handle_message(worker, line)
+
+    def _reap(self):
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self._workers.pop(pid, None)
+            if worker is None:
+                continue
+
+            try:
+                self._selector.unregister(worker.sock)
+            except (KeyError, ValueError):
+                pass
+            worker.sock.close()
+            if self._stopping:
+                continue
+
+            if os.WIFSIGNALED(status):
+                tf.logging.error('Worker %d (pid %d) killed by signal %d', worker.index, pid, os.WTERMSIG(status))
+            else:
+                tf.logging.error('Worker %d (pid %d) exited with status %d', worker.index, pid, os.WEXITSTATUS(status))
+
+            if time.monotonic() - worker.started >= MIN_WORKER_UPTIME:
+                delay = 0
+            else:
+                delay = min(max(2 * self._restart_delays.get(worker.index, 0), 1), MAX_RESTART_DELAY)
+            self._restart_delays[worker.index] = delay
+            self._pending_restarts[worker.index] = time.monotonic() + delay
+
+    def _restart(self):
+        now = time.monotonic()
+        for index, when in list(self._pending_restarts.items()):
+            if when <= now:
+                del self._pending_restarts[index]
+                self._spawn(index)
+
+    def _on_signal(self, signum, frame):
+        self._stopping = True
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+        for index in range(self._num_workers):
+            self._spawn(index)
+
+        while self._workers or not self._stopping:
+            for key, _ in self._selector.select(timeout=1):
+                self._read(key.data)
+            self._reap()
+            if not self._stopping:
+                self._restart()
+        tf.logging.info('All workers stopped')
+
+
+class SupervisorConnection(object):
+    '''
+    The worker side of the connection to the supervisor.
+
+    The worker exits if the supervisor goes away.
+    '''
+
+    def __init__(self, sock, index=None):
+        self._stream = IOStream(sock)
+        # the index of this worker, which other workers use to reply to it
+        self.index = index
+        self._next_request_id = 0
+        # request id -> (future, replies)
+        self._requests = dict()
+
+    def start(self, on_message):
+        tornado.ioloop.IOLoop.current().spawn_callback(self._read_messages, on_message)
+
+    @tornado.gen.coroutine
+    def _read_messages(self, on_message):
+        while True:
+            try:
+                line = yield self._stream.read_until(b'\n')
+            except StreamClosedError:
+                tf.logging.error('Lost connection to the supervisor, exiting')
+                tornado.ioloop.IOLoop.current().stop()
+                return
+
+            try:
+                message = json.loads(str(line, encoding='utf-8'))
+                if 'reply_to' in message:
+                    self._handle_reply(message)
+                else:
+                    on_message(message)
+            except Exception as e:
+                tf.logging.error('Failed to handle message from the supervisor: %s', e)
+
+    def send(self, message):
+        self._stream.write(json.dumps(message).encode('utf-8') + b'\n')
+
+    def request(self, message, num_replies, timeout):
+        '''
+        Send a message to all other workers, and collect their replies.
+
+        Returns a Future that resolves to the list of replies, once
+        num_replies replies have arrived or after timeout seconds,
+        whichever comes first.
+        '''
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        future = Future()
+        replies = []
+        if num_replies <= 0:
+            future.set_result(replies)
+            return future
+        self._requests[request_id] = (future, replies, num_replies)
+
+        io_loop = tornado.ioloop.IOLoop.current()
+        def on_timeout():
+            # some worker is restarting, or too busy to reply
+            if self._requests.pop(request_id, None) is not None:
+                future.set_result(replies)
+        handle = io_loop.call_later(timeout, on_timeout)
+        future.add_done_callback(lambda _: io_loop.remove_timeout(handle))
+
+        self.send(dict(message, origin=self.index, request_id=request_id))
+        return future
+
+    def reply(self, request, message):
+        '''
+        Reply to a message sent with request() by another worker
+        '''
+        self.send(dict(message, to=request['origin'], reply_to=request['request_id']))
+
+    def _handle_reply(self, message):
+        pending = self._requests.get(message['reply_to'], None)
+        if pending is None:
+            # the request timed out already
+            return
+        future, replies, num_replies = pending
+        replies.append(message)
+        if len(replies) >= num_replies:
+            del self._requests[message['reply_to']]
+            future.set_result(replies)
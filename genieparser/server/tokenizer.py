@@ -9,14 +9,22 @@ import os
 import sys
 
 import json
+import time
 import tornado.gen
 import tornado.ioloop
+import tornado.locks
+import tensorflow as tf
 from tornado.iostream import IOStream, StreamClosedError
 from tornado.concurrent import Future
 from collections import namedtuple
 
+from .cache import LRUCache, SingleFlight
+
 PORT = 8888
 
+INITIAL_RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 30
+
 TokenizerResult = namedtuple('TokenizerResult', ('tokens', 'values', 'constituency_parse', 'raw_tokens', 'sentiment', 'pos_tags'))
 
 def clean_tokens(tokens):
@@ -26,64 +34,233 @@ def clean_tokens(tokens):
         else:
             yield t
 
+class TokenizerError(Exception):
+    pass
+
+
+class TokenizerConnection(object):
+    '''
+    One connection to the Java TokenizerService.
+
+    The connection is reestablished automatically, with exponential backoff,
+    if it cannot be opened or if it is closed by the other side.
+
+    on_state_change is called whenever the connection is opened or closed,
+    and whenever it starts waiting before the next attempt.
+    '''
+
+    def __init__(self, host, port, on_state_change=None):
+        self._host = host
+        self._port = port
+        self._stream = None
+        self._requests = dict()
+        self._closed = False
+        self._on_state_change = on_state_change
+        # the IOLoop time of the next connection attempt, while in backoff
+        self.next_attempt = None
+
+    @property
+    def connected(self):
+        return self._stream is not None
+
+    def _state_changed(self):
+        if self._on_state_change is not None:
+            self._on_state_change()
+
+    @property
+    def outstanding(self):
+        return len(self._requests)
+
+    def close(self):
+        self._closed = True
+        if self._stream is not None:
+            self._stream.close()
+
+    @tornado.gen.coroutine
+    def run(self):
+        retry_delay = 0
+        while not self._closed:
+            stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+            try:
+                yield stream.connect((self._host, self._port))
+            except (StreamClosedError, OSError) as e:
+                retry_delay = min(max(2 * retry_delay, INITIAL_RETRY_DELAY), MAX_RETRY_DELAY)
+                tf.logging.warning('Failed to connect to the tokenizer at %s:%d, retrying in %g seconds: %s',
+                                   self._host, self._port, retry_delay, e)
+                self.next_attempt = tornado.ioloop.IOLoop.current().time() + retry_delay
+                self._state_changed()
+                yield tornado.gen.sleep(retry_delay)
+                self.next_attempt = None
+                continue
+
+            retry_delay = 0
+            self._stream = stream
+            self._state_changed()
+            try:
+                while True:
+                    response = yield stream.read_until(b'\n')
+                    self._handle_response(response)
+            except StreamClosedError:
+                pass
+            finally:
+                self._stream = None
+                self._state_changed()
+
+            tf.logging.warning('Lost connection to the tokenizer at %s:%d', self._host, self._port)
+            requests = self._requests
+            self._requests = dict()
+            for future in requests.values():
+                if not future.done():
+                    future.set_exception(TokenizerError('Lost connection to the tokenizer'))
+
+    def _handle_response(self, response):
+        response = json.loads(str(response, encoding='utf-8'))
+
+        id = int(response['req'])
+        future = self._requests.pop(id, None)
+        if future is None or future.done():
+            # the request timed out already
+            return
+        result = TokenizerResult(tokens=list(clean_tokens(response['tokens'])),
+                                 values=response['values'],
+                                 constituency_parse=response['constituencyParse'],
+                                 pos_tags=response['pos'],
+                                 raw_tokens=response['rawTokens'],
+                                 sentiment=response['sentiment'])
+        future.set_result(result)
+
+    def send(self, id, req):
+        future = Future()
+        self._requests[id] = future
+
+        def then(write_future):
+            if write_future.exception() and not future.done():
+                future.set_exception(write_future.exception())
+                self._requests.pop(id, None)
+
+        self._stream.write(json.dumps(req).encode()).add_done_callback(then)
+        return future
+
+    def cancel(self, id, exception):
+        future = self._requests.pop(id, None)
+        if future is not None and not future.done():
+            future.set_exception(exception)
+
+
 class TokenizerService(object):
     '''
     Wraps the IPC to the Java TokenizerService (which runs tokenization and named
     entity extraction through CoreNLP)
+
+    Requests are spread over a pool of connections, choosing the connection
+    with the fewest outstanding requests, so that one slow sentence does not
+    block all the others.
+
+    While no connection is open (at startup, or while the tokenizer is
+    restarting), requests wait for one, up to their timeout. They fail
+    immediately only if no connection will be attempted again before
+    the timeout expires.
     '''
 
-    def __init__(self):
-        self._socket = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
-        self._requests = dict()
+    def __init__(self, host='127.0.0.1', port=PORT, num_connections=4, timeout=10, metrics=None):
+        self._connection_changed = tornado.locks.Condition()
+        self._connections = [TokenizerConnection(host, port, self._connection_changed.notify_all)
+                             for _ in range(max(1, num_connections))]
+        self._timeout = timeout
         self._next_id = 0
-        
-    @tornado.gen.coroutine
+        self._metrics = metrics
+        self._stages = dict()
+
+    @property
+    def available(self):
+        return any(connection.connected for connection in self._connections)
+
     def run(self):
-        yield self._socket.connect(('127.0.0.1', PORT))
-        
+        io_loop = tornado.ioloop.IOLoop.current()
+        for connection in self._connections:
+            io_loop.spawn_callback(connection.run)
+
+    def close(self):
+        for connection in self._connections:
+            connection.close()
+
+    def _pick_connection(self):
+        connected = [connection for connection in self._connections if connection.connected]
+        if not connected:
+            return None
+        return min(connected, key=lambda connection: connection.outstanding)
+
+    def _will_connect_before(self, deadline):
+        return deadline is None or \
+            any(connection.next_attempt is None or connection.next_attempt < deadline
+                for connection in self._connections)
+
+    @tornado.gen.coroutine
+    def _wait_for_connection(self, deadline):
         while True:
-            try:
-                response = yield self._socket.read_until(b'\n')
-            except StreamClosedError:
-                response = None
-            if not response:
-                return
-            response = json.loads(str(response, encoding='utf-8'))
-            
-            id = int(response['req'])
-            result = TokenizerResult(tokens=list(clean_tokens(response['tokens'])),
-                                     values=response['values'],
-                                     constituency_parse=response['constituencyParse'],
-                                     pos_tags=response['pos'],
-                                     raw_tokens=response['rawTokens'],
-                                     sentiment=response['sentiment'])
-            self._requests[id].set_result(result)
-            del self._requests[id]
-        
+            connection = self._pick_connection()
+            if connection is not None:
+                return connection
+            if not self._will_connect_before(deadline):
+                raise TokenizerError('Tokenizer is not available')
+            if not (yield self._connection_changed.wait(deadline)):
+                raise TokenizerError('Tokenizer is not available')
+
+    @tornado.gen.coroutine
     def tokenize(self, language_tag, query, expect=None):
         id = self._next_id
         self._next_id += 1
-        
+
+        io_loop = tornado.ioloop.IOLoop.current()
+        deadline = io_loop.time() + self._timeout if self._timeout > 0 else None
+        connection = self._pick_connection()
+        if connection is None:
+            # the time spent waiting for a connection counts against the timeout
+            connection = yield self._wait_for_connection(deadline)
+
         req = dict(req=id, utterance=query, languageTag=language_tag)
         if expect is not None:
             req['expect'] = expect
-        outer = Future()
-        self._requests[id] = outer
-        
-        def then(future):
-            if future.exception():
-                outer.set_exception(future.exception())
-                del self._requests[id]
-        
-        future = self._socket.write(json.dumps(req).encode())
-        future.add_done_callback(then)
-        return outer
+        future = connection.send(id, req)
+
+        if self._metrics is not None:
+            stages = self._stages.get(language_tag, None)
+            if stages is None:
+                stages = self._stages[language_tag] = self._metrics.stages(language_tag)
+            start = time.monotonic()
+            future.add_done_callback(lambda _: stages.observe_since('tokenizer_ipc', start))
+
+        if deadline is not None:
+            timeout = io_loop.call_at(deadline, connection.cancel, id,
+                                      TokenizerError('Tokenizer request timed out'))
+            future.add_done_callback(lambda _: io_loop.remove_timeout(timeout))
+        result = yield future
+        return result
         
     
 class Tokenizer(object):
-    def __init__(self, service, language_tag):
+    def __init__(self, service, language_tag, cache=None):
         self._service = service
         self._lang = language_tag
+        self._inflight = SingleFlight()
+        # the cache is shared by all languages, so the key includes the language
+        self._cache = cache if cache is not None else LRUCache(0)
         
     def tokenize(self, query, expect=None):
-        return self._service.tokenize(self._lang, query, expect)
+        # note: the result can be shared with other requests, callers must not modify it
+        key = (self._lang, query, expect)
+        cached = self._cache.get(key)
+        if cached is not None:
+            future = Future()
+            future.set_result(cached)
+            return future
+        
+        # identical sentences that are being tokenized concurrently share
+        # a single request to the tokenizer service
+        return self._inflight.run(key, self._do_tokenize, key, query, expect)
+    
+    @tornado.gen.coroutine
+    def _do_tokenize(self, key, query, expect):
+        result = yield self._service.tokenize(self._lang, query, expect)
+        self._cache.put(key, result)
+        return result
@@ -40,6 +40,7 @@ from tensor2tensor.utils import data_reader
 from tensor2tensor.layers import common_layers
 
 from ..layers.modalities import PretrainedEmbeddingModality, PointerModality
+from ..layers import common
 from ..grammar.abstract import AbstractGrammar
 from ..tasks import base_problem
 
@@ -261,6 +262,9 @@ class SemanticParsingProblem(text_problems.Text2TextProblem,
     
     def _encode_string_input(self, features, tf_dictionary):
         string_input = features["inputs/string"]
+        # remove the empty strings that the server uses to pad sentences
+        # of different length into the same batch
+        string_input = tf.boolean_mask(string_input, tf.not_equal(string_input, ''))
         int64_input = tf_dictionary.lookup(string_input)
         
         return {
@@ -295,6 +299,13 @@ class SemanticParsingProblem(text_problems.Text2TextProblem,
         features = tf.contrib.data.get_single_element(dataset)
         if self.has_inputs:
             features.pop("targets", None)
+        
+        if hparams.decode_length_slope > 0:
+            # the longest program we expect for each sentence, so that the
+            # decoder can stop early on short sentences
+            features["max_decode_length"] = common.max_decode_length_from_input(features["inputs/string"],
+                                                                                hparams.decode_length_slope,
+                                                                                hparams.decode_length_intercept)
     
         return tf.estimator.export.ServingInputReceiver(
             features=features, receiver_tensors=placeholders)
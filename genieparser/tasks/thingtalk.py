@@ -122,6 +122,11 @@ class AbstractThingTalkProblem(SemanticParsingProblem):
     def export_assets(self):
         assets = super().export_assets
         assets['thingpedia.json'] = os.path.join(self._data_dir, 'thingpedia.json')
+        # ship the parse tables with the model, so the server does not need to
+        # build them again
+        if self._grammar is not None and self._grammar.cache_filename is not None and \
+            tf.gfile.Exists(self._grammar.cache_filename):
+            assets[os.path.basename(self._grammar.cache_filename)] = self._grammar.cache_filename
         return assets
 
 
@@ -133,7 +138,8 @@ class ThingTalkProblem(AbstractThingTalkProblem):
 
     def grammar_factory(self, out_dir, **kw):
         return ThingTalkGrammar(os.path.join(out_dir, 'thingpedia.json'),
-                                flatten=True)            
+                                flatten=True,
+                                cache_dir=out_dir)
 
 
 @registry.register_problem("semparse_thingtalk_noquote")
@@ -145,7 +151,8 @@ class QuoteFreeThingTalkProblem(AbstractThingTalkProblem):
         
     def grammar_factory(self, out_dir, **kw):
         return ThingTalkGrammar(os.path.join(out_dir, 'thingpedia.json'),
-                                flatten=False)
+                                flatten=False,
+                                cache_dir=out_dir)
 
 @registry.register_problem("semparse_thingtalk_noquote_notype")
 class TypelessQuoteFreeThingTalkProblem(AbstractThingTalkProblem):
@@ -157,7 +164,8 @@ class TypelessQuoteFreeThingTalkProblem(AbstractThingTalkProblem):
     def grammar_factory(self, out_dir, **kw):
         return ThingTalkGrammar(os.path.join(out_dir, 'thingpedia.json'),
                                 grammar_include_types=False,
-                                flatten=False)
+                                flatten=False,
+                                cache_dir=out_dir)
         
 @registry.register_problem("semparse_thingtalk_noquote_nospan")
 class WordpointerQuoteFreeThingTalkProblem(AbstractThingTalkProblem):
@@ -169,7 +177,8 @@ class WordpointerQuoteFreeThingTalkProblem(AbstractThingTalkProblem):
     def grammar_factory(self, out_dir, **kw):
         return ThingTalkGrammar(os.path.join(out_dir, 'thingpedia.json'),
                                 use_span=False,
-                                flatten=False)
+                                flatten=False,
+                                cache_dir=out_dir)
 
 @registry.register_problem("semparse_thingtalk_noquote_nospan_notype")
 class TypelessWordpointerQuoteFreeThingTalkProblem(AbstractThingTalkProblem):
@@ -182,7 +191,8 @@ class TypelessWordpointerQuoteFreeThingTalkProblem(AbstractThingTalkProblem):
         return ThingTalkGrammar(os.path.join(out_dir, 'thingpedia.json'),
                                 use_span=False,
                                 grammar_include_types=False,
-                                flatten=False)
+                                flatten=False,
+                                cache_dir=out_dir)
 
 @registry.register_problem("semparse_posthingtalk_noquote")
 class QuoteFreePositionalThingTalkProblem(AbstractThingTalkProblem):
@@ -193,7 +203,8 @@ class QuoteFreePositionalThingTalkProblem(AbstractThingTalkProblem):
         
     def grammar_factory(self, out_dir, **kw):
         return PosThingTalkGrammar(os.path.join(out_dir, 'thingpedia.json'),
-                                   flatten=False)
+                                   flatten=False,
+                                   cache_dir=out_dir)
 
 @registry.register_problem("semparse_posthingtalk_noquote_nospan_notype")
 class QuoteFreePositionalThingTalkProblem(AbstractThingTalkProblem):
@@ -206,4 +217,5 @@ class QuoteFreePositionalThingTalkProblem(AbstractThingTalkProblem):
         return PosThingTalkGrammar(os.path.join(out_dir, 'thingpedia.json'),
                                    use_span=False,
                                    grammar_include_types=False,
-                                   flatten=False)
+                                   flatten=False,
+                                   cache_dir=out_dir)
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+#
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Measure the time to construct a ThingTalk grammar with a cold cache
+of parse tables (which runs the SLR generator and saves the tables),
+and with a warm cache (which loads the tables saved by the cold run).
+
+Usage:
+    python3 scripts/benchmark_grammar_cache.py --thingpedia ./dataset/thingpedia.json
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+# workaround to import modules from parent directory
+sys.path.append(os.path.abspath(os.path.join(__file__, "../..")))
+
+import numpy as np
+import tensorflow as tf
+
+from genieparser.grammar.thingtalk import ThingTalkGrammar
+
+
+def time_construct(thingpedia, flatten, cache_dir):
+    start = time.perf_counter()
+    grammar = ThingTalkGrammar(thingpedia, flatten=flatten, quiet=True, cache_dir=cache_dir)
+    # the parser is constructed lazily, with the input dictionary
+    grammar.set_input_dictionary(None)
+    return time.perf_counter() - start, grammar
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cache of SLR parse tables')
+    parser.add_argument('--thingpedia', required=True,
+                        help='Thingpedia snapshot (thingpedia.json)')
+    parser.add_argument('--flatten', action='store_true',
+                        help='Use the flattened grammar (semparse_thingtalk)')
+    parser.add_argument('--iterations', type=int, default=3)
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.WARN)
+    cold_times = []
+    warm_times = []
+    for _ in range(args.iterations):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cold_time, grammar = time_construct(args.thingpedia, args.flatten, cache_dir)
+            cold_times.append(cold_time)
+            warm_time, _ = time_construct(args.thingpedia, args.flatten, cache_dir)
+            warm_times.append(warm_time)
+            cache_size = os.path.getsize(grammar.cache_filename)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    print('num rules', grammar._parser.num_rules, sep='\t')
+    print('num states', grammar._parser.num_states, sep='\t')
+    print('cache size', '%.1f KB' % (cache_size / 1024), sep='\t')
+    print('cold (ms)', '%.1f' % (1000 * np.mean(cold_times)), sep='\t')
+    print('warm (ms)', '%.1f' % (1000 * np.mean(warm_times)), sep='\t')
+    print('speedup', '%.1fx' % (np.mean(cold_times) / np.mean(warm_times)), sep='\t')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+#
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Measure the memory used by the parse tables of a ThingTalk grammar
+when several worker processes load it, with the tables mapped from a
+shared cache directory, and with the tables built privately in each
+process.
+
+The numbers come from /proc/self/smaps, so this only works on Linux.
+Pss counts the pages shared by N processes as 1/N in each of them.
+
+Usage:
+    python3 scripts/benchmark_grammar_sharing.py --thingpedia ./dataset/thingpedia.json --workers 4
+'''
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+# workaround to import modules from parent directory
+sys.path.append(os.path.abspath(os.path.join(__file__, "../..")))
+
+import tensorflow as tf
+
+from genieparser.grammar.thingtalk import ThingTalkGrammar
+from genieparser.grammar.slr import cache as slr_cache
+from genieparser.server.memory import process_memory_report
+
+MB = 1024 * 1024
+
+
+def worker(thingpedia, flatten, shared_cache_dir, barrier, results):
+    slr_cache.set_shared_cache_dir(shared_cache_dir)
+    grammar = ThingTalkGrammar(thingpedia, flatten=flatten, quiet=True)
+    grammar.set_input_dictionary(None)
+    # touch every page of the tables, like a long running server would
+    grammar._parser.action_table.to_dense()
+    grammar._parser.goto_table.to_dense()
+    for table in grammar.decoding_tables:
+        table.sum()
+
+    # wait for all workers to map the tables before measuring
+    barrier.wait()
+    mapped, private = grammar.parse_table_memory()
+    results.put((mapped, private, process_memory_report()))
+    barrier.wait()
+
+
+def run(thingpedia, flatten, shared_cache_dir, num_workers):
+    barrier = multiprocessing.Barrier(num_workers)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker,
+                                         args=(thingpedia, flatten, shared_cache_dir, barrier, results))
+                 for _ in range(num_workers)]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in range(num_workers)]
+    for process in processes:
+        process.join()
+    return reports
+
+
+def print_reports(name, reports):
+    mapped = sum(report[0] for report in reports)
+    private = sum(report[1] for report in reports)
+    print(name, 'mapped tables (MB)', '%.2f' % (mapped / MB), sep='\t')
+    print(name, 'private tables (MB)', '%.2f' % (private / MB), sep='\t')
+    if reports[0][2] is None:
+        return
+    for key in ('grammar_tables', 'total'):
+        for field in ('rss', 'pss', 'shared', 'private'):
+            value = sum(report[2][key][field] for report in reports)
+            print(name, '%s %s (MB)' % (key, field), '%.2f' % (value / MB), sep='\t')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sharing the SLR parse tables across processes')
+    parser.add_argument('--thingpedia', required=True,
+                        help='Thingpedia snapshot (thingpedia.json)')
+    parser.add_argument('--flatten', action='store_true',
+                        help='Use the flattened grammar (semparse_thingtalk)')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.WARN)
+    shared_cache_dir = tempfile.mkdtemp()
+    try:
+        # build the tables once, so that the workers only load them
+        run(args.thingpedia, args.flatten, shared_cache_dir, 1)
+        print_reports('shared', run(args.thingpedia, args.flatten, shared_cache_dir, args.workers))
+    finally:
+        shutil.rmtree(shared_cache_dir)
+    print_reports('private', run(args.thingpedia, args.flatten, None, args.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+#
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Measure the overhead of the per-stage latency metrics.
+
+Reports the cost of one observation, from one thread and from several
+threads at once (the batcher and the Predictor observe from the thread
+pool), the cost for all the stages of one /query request, and the time
+to render /metrics.
+
+Usage:
+    python3 scripts/benchmark_metrics.py --iterations 1000000
+'''
+
+import time
+import argparse
+import threading
+
+from genieparser.server.metrics import MetricsRegistry
+
+# the stages observed for one /query request that misses all caches
+QUERY_STAGES = ('tokenizer_ipc', 'tokenize', 'exact_match', 'queue', 'session_run', 'decode', 'query')
+
+
+def time_observe(stages, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        stages.observe_since('decode', start)
+    return (time.perf_counter() - start) / iterations
+
+
+def time_observe_threads(registry, num_threads, iterations):
+    stages = registry.stages('en')
+    barrier = threading.Barrier(num_threads + 1)
+
+    def run():
+        barrier.wait()
+        time_observe(stages, iterations)
+
+    threads = [threading.Thread(target=run) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return (time.perf_counter() - start) / (num_threads * iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the metrics registry')
+    parser.add_argument('--iterations', type=int, default=1000000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--tags', type=int, default=20,
+                        help='Number of language/model tags to render')
+    args = parser.parse_args()
+
+    registry = MetricsRegistry()
+    stages = registry.stages('en')
+    per_observation = time_observe(stages, args.iterations)
+    print('observe, 1 thread: %.0f ns' % (per_observation * 1e9))
+    per_observation_threaded = time_observe_threads(registry, args.threads, args.iterations // args.threads)
+    print('observe, %d threads: %.0f ns (wall time per observation)' %
+          (args.threads, per_observation_threaded * 1e9))
+    print('overhead per /query (%d stages): %.1f us' %
+          (len(QUERY_STAGES), len(QUERY_STAGES) * per_observation * 1e6))
+
+    for i in range(args.tags):
+        tag_stages = registry.stages('lang%d' % i)
+        for stage in QUERY_STAGES:
+            tag_stages.observe(stage, 0.01)
+    start = time.perf_counter()
+    text = registry.render()
+    print('render, %d tags: %.2f ms (%d bytes)' %
+          (args.tags, (time.perf_counter() - start) * 1000, len(text)))
+
+
+if __name__ == '__main__':
+    main()
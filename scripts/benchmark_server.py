@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+#
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Load generator for genie-server.
+
+Sends /query requests to a running server at several concurrency levels,
+and reports throughput and latency percentiles for each level.
+
+Usage:
+    python3 scripts/benchmark_server.py --sentences test.tsv --concurrency 1,4,16,64
+
+To compare batching configurations, run the benchmark twice against
+a server with max_batch_size=1 and with batching enabled.
+'''
+
+import sys
+import time
+import argparse
+import urllib.parse
+
+import numpy as np
+import tornado.gen
+import tornado.ioloop
+from tornado.httpclient import AsyncHTTPClient, HTTPError
+
+
+def load_sentences(filename):
+    sentences = []
+    with open(filename) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            parts = line.split('\t')
+            # TSV files from the dataset are id, sentence, program
+            sentences.append(parts[1] if len(parts) >= 2 else parts[0])
+    return sentences
+
+
+@tornado.gen.coroutine
+def run_level(args, sentences, concurrency):
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    if args.model_tag:
+        base_url = '%s/@%s/%s/query' % (args.url, args.model_tag, args.locale)
+    else:
+        base_url = '%s/%s/query' % (args.url, args.locale)
+
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    @tornado.gen.coroutine
+    def worker():
+        nonlocal next_request, errors
+        while next_request < args.requests:
+            sentence = sentences[next_request % len(sentences)]
+            next_request += 1
+
+            query = dict(q=sentence, limit=args.limit, store='no')
+            if args.tokenized:
+                query['tokenized'] = '1'
+            url = base_url + '?' + urllib.parse.urlencode(query)
+
+            start = time.perf_counter()
+            try:
+                yield client.fetch(url, request_timeout=args.timeout)
+            except (HTTPError, OSError):
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    yield [worker() for _ in range(concurrency)]
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    latencies = np.array(latencies) * 1000
+    if len(latencies) == 0:
+        latencies = np.zeros((1,))
+    return dict(concurrency=concurrency,
+                requests=args.requests,
+                errors=errors,
+                throughput=(args.requests - errors) / elapsed,
+                mean=np.mean(latencies),
+                p50=np.percentile(latencies, 50),
+                p99=np.percentile(latencies, 99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark a running genie-server')
+    parser.add_argument('--url', default='http://127.0.0.1:8400',
+                        help='Base URL of the server')
+    parser.add_argument('--locale', default='en-US')
+    parser.add_argument('--model_tag', default=None,
+                        help='Benchmark the model with this tag instead of the default')
+    parser.add_argument('--sentences', required=True,
+                        help='File with one sentence per line, or a dataset TSV file')
+    parser.add_argument('--tokenized', action='store_true',
+                        help='The sentences are already tokenized (bypass the tokenizer)')
+    parser.add_argument('--concurrency', default='1,4,16,64',
+                        help='Comma-separated list of concurrency levels')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='Number of requests to send at each concurrency level')
+    parser.add_argument('--limit', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    sentences = load_sentences(args.sentences)
+    if not sentences:
+        print('No sentences found in ' + args.sentences, file=sys.stderr)
+        sys.exit(1)
+
+    print('concurrency', 'requests', 'errors', 'throughput (q/s)',
+          'mean (ms)', 'p50 (ms)', 'p99 (ms)', sep='\t')
+    io_loop = tornado.ioloop.IOLoop.current()
+    for level in args.concurrency.split(','):
+        result = io_loop.run_sync(lambda: run_level(args, sentences, int(level)))
+        print(result['concurrency'], result['requests'], result['errors'],
+              '%.1f' % result['throughput'], '%.1f' % result['mean'],
+              '%.1f' % result['p50'], '%.1f' % result['p99'], sep='\t')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+#
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Measure the time to generate the SLR parse tables of the ThingTalk
+grammar, on a synthetic Thingpedia built by copying every device of a
+real snapshot several times under different names, and the memory used
+by the parse tables, packed and as dense arrays.
+
+With --unique_params, the parameters of each copy also get different
+names, which makes the grammar grow faster.
+
+Usage:
+    python3 scripts/benchmark_slr_generator.py --thingpedia ./tests/data/thingpedia.json \
+        --copies 1,5,10,20
+'''
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import tempfile
+
+# workaround to import modules from parent directory
+sys.path.append(os.path.abspath(os.path.join(__file__, "../..")))
+
+import tensorflow as tf
+
+from genieparser.grammar.thingtalk import ThingTalkGrammar
+
+MB = 1024 * 1024
+
+
+def make_synthetic_thingpedia(thingpedia, copies, unique_params):
+    devices = []
+    for i in range(copies):
+        for device in thingpedia['devices']:
+            device = copy.deepcopy(device)
+            if i > 0:
+                device['kind'] = device['kind'] + '.copy' + str(i)
+                if unique_params:
+                    for function_type in ('triggers', 'queries', 'actions'):
+                        for function in device[function_type].values():
+                            function['args'] = [arg + '_' + str(i) for arg in function['args']]
+            devices.append(device)
+    return dict(devices=devices, entities=thingpedia['entities'])
+
+
+def count_functions(thingpedia):
+    return sum(len(device[function_type]) for device in thingpedia['devices']
+               for function_type in ('triggers', 'queries', 'actions'))
+
+
+def table_nbytes(parser, attribute):
+    return getattr(parser.action_table, attribute) + getattr(parser.goto_table, attribute)
+
+
+def time_generator(filename, flatten):
+    grammar = ThingTalkGrammar(filename, flatten=flatten, quiet=True)
+    start = time.perf_counter()
+    # this constructs the parser, and runs the SLR generator
+    grammar.set_input_dictionary(None)
+    return time.perf_counter() - start, grammar
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the SLR generator on a synthetic Thingpedia')
+    parser.add_argument('--thingpedia', required=True,
+                        help='Thingpedia snapshot to copy (thingpedia.json)')
+    parser.add_argument('--copies', default='1,5,10',
+                        help='Comma-separated list of the number of copies of each device')
+    parser.add_argument('--unique_params', action='store_true',
+                        help='Rename the parameters in each copy')
+    parser.add_argument('--flatten', action='store_true',
+                        help='Use the flattened grammar (semparse_thingtalk)')
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.WARN)
+    with open(args.thingpedia) as fp:
+        thingpedia = json.load(fp)
+
+    print('copies', 'functions', 'rules', 'states', 'time (s)', 'dense tables (MB)', 'packed tables (MB)', sep='\t')
+    for copies in args.copies.split(','):
+        copies = int(copies)
+        synthetic = make_synthetic_thingpedia(thingpedia, copies, args.unique_params)
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as fp:
+            json.dump(synthetic, fp)
+            fp.flush()
+            elapsed, grammar = time_generator(fp.name, args.flatten)
+        print(copies, count_functions(synthetic), grammar._parser.num_rules,
+              grammar._parser.num_states, '%.2f' % elapsed,
+              '%.2f' % (table_nbytes(grammar._parser, 'dense_nbytes') / MB),
+              '%.2f' % (table_nbytes(grammar._parser, 'nbytes') / MB), sep='\t')
+
+
+if __name__ == '__main__':
+    main()
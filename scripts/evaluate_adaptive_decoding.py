@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+#
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Measure the latency and accuracy of adaptive decoding ([decoding] adaptive
+in server.conf) on a held-out dataset.
+
+Every sentence is decoded one at a time with both greedy and beam search,
+and the script reports, for greedy only, beam only, and adaptive decoding
+at each greedy_min_score threshold: the exact match accuracy of the best
+result, the fraction of sentences that fall back to beam search, and the
+latency of the model.
+
+Usage:
+    python3 scripts/evaluate_adaptive_decoding.py --model_dir /var/lib/genie-parser/en \
+        --dataset eval.tsv --thresholds=-0.1,-0.5,-1,-2
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+
+# workaround to import modules from parent directory
+sys.path.append(os.path.abspath(os.path.join(__file__, "../..")))
+
+import numpy as np
+import tensorflow as tf
+
+from genieparser.server.predictor import Predictor, GREEDY_SIGNATURE, pad_to_batch, decode_candidates
+
+
+def load_dataset(filename):
+    examples = []
+    with open(filename) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            # TSV files from the dataset are id, sentence, program
+            _, sentence, program = line.split('\t')[:3]
+            examples.append((sentence.split(' '), program.split(' ')))
+    return examples
+
+
+def run_signature(predictor, signature_key, tokens):
+    start = time.perf_counter()
+    predicted = predictor.predict({
+        "inputs/string": pad_to_batch([tokens])
+    }, signature_key=signature_key)
+    elapsed = time.perf_counter() - start
+    candidates = decode_candidates({key: value[0] for key, value in predicted.items()}, 1)
+    if len(candidates) == 0:
+        return None, float('-inf'), elapsed
+    return candidates[0]['code'], candidates[0]['score'], elapsed
+
+
+def summarize(name, correct, fallback, latencies):
+    latencies = np.array(latencies) * 1000
+    print(name, '%.2f' % (100 * np.mean(correct)), '%.2f' % (100 * np.mean(fallback)),
+          '%.1f' % np.mean(latencies), '%.1f' % np.percentile(latencies, 50),
+          '%.1f' % np.percentile(latencies, 99), sep='\t')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate adaptive greedy/beam decoding')
+    parser.add_argument('--model_dir', required=True,
+                        help='Directory of the model, as in the [models] section of server.conf')
+    parser.add_argument('--dataset', required=True,
+                        help='Held-out dataset TSV file (id, sentence, program)')
+    parser.add_argument('--thresholds', default='-0.1,-0.25,-0.5,-1,-2',
+                        help='Comma-separated list of greedy_min_score values to evaluate')
+    parser.add_argument('--limit', type=int, default=0,
+                        help='Only evaluate the first N sentences')
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.WARN)
+    with tf.gfile.Open(os.path.join(args.model_dir, "model.json")) as fp:
+        config = json.load(fp)
+    predictor = Predictor(args.model_dir, config, greedy=True)
+    if GREEDY_SIGNATURE not in predictor.signatures:
+        print('The model already uses greedy decoding', file=sys.stderr)
+        sys.exit(1)
+
+    examples = load_dataset(args.dataset)
+    if args.limit > 0:
+        examples = examples[:args.limit]
+    if not examples:
+        print('No examples found in ' + args.dataset, file=sys.stderr)
+        sys.exit(1)
+
+    # run each signature once before measuring
+    predictor.warm_up([examples[0][0]], [1])
+
+    greedy = []
+    beam = []
+    for tokens, program in examples:
+        code, score, elapsed = run_signature(predictor, GREEDY_SIGNATURE, tokens)
+        greedy.append((code == program, code is not None, score, elapsed))
+        code, _, elapsed = run_signature(predictor, None, tokens)
+        beam.append((code == program, elapsed))
+    predictor.close()
+
+    print('decoding', 'accuracy (%)', 'beam fallback (%)', 'mean (ms)', 'p50 (ms)', 'p99 (ms)', sep='\t')
+    summarize('greedy', [x[0] for x in greedy], [False] * len(greedy), [x[3] for x in greedy])
+    summarize('beam', [x[0] for x in beam], [True] * len(beam), [x[1] for x in beam])
+    for threshold in args.thresholds.split(','):
+        threshold = float(threshold)
+        correct = []
+        fallback = []
+        latencies = []
+        for (greedy_correct, valid, score, greedy_time), (beam_correct, beam_time) in zip(greedy, beam):
+            if valid and score >= threshold:
+                correct.append(greedy_correct)
+                fallback.append(False)
+                latencies.append(greedy_time)
+            else:
+                correct.append(beam_correct)
+                fallback.append(True)
+                latencies.append(greedy_time + beam_time)
+        summarize('adaptive %g' % threshold, correct, fallback, latencies)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+#
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+A stand-in for the Java tokenizer service (almond-tokenizer), for testing
+and load testing genie-server without CoreNLP.
+
+It speaks the same protocol (JSON requests, newline-terminated JSON responses),
+splits sentences on whitespace, and replaces quoted strings and numbers with
+QUOTED_STRING_i and NUMBER_i entities. It can simulate a slow tokenizer
+with --delay and --slow_fraction.
+
+Usage:
+    python3 scripts/fake_tokenizer.py --port 8888 --delay 5 --slow_fraction 0.01
+'''
+
+import re
+import json
+import random
+import argparse
+
+import tornado.gen
+import tornado.ioloop
+from tornado.tcpserver import TCPServer
+from tornado.iostream import StreamClosedError
+
+QUOTED_STRING_RE = re.compile('"([^"]*)"')
+
+
+def tokenize(utterance):
+    values = dict()
+    counters = dict()
+
+    def add_entity(entity_type, value):
+        index = counters.get(entity_type, 0)
+        counters[entity_type] = index + 1
+        name = entity_type + '_' + str(index)
+        values[name] = value
+        return name
+
+    utterance = QUOTED_STRING_RE.sub(lambda m: ' ' + add_entity('QUOTED_STRING', m.group(1)) + ' ',
+                                     utterance)
+    raw_tokens = utterance.split()
+    tokens = []
+    for token in raw_tokens:
+        if re.match('^[0-9]+(\\.[0-9]+)?$', token):
+            token = add_entity('NUMBER', float(token))
+        elif not re.match('^[A-Z_]+_[0-9]+$', token):
+            token = token.lower()
+        tokens.append(token)
+    return tokens, raw_tokens, values
+
+
+class FakeTokenizerServer(TCPServer):
+    def __init__(self, args):
+        super().__init__()
+        self._args = args
+        self._decoder = json.JSONDecoder()
+
+    @tornado.gen.coroutine
+    def _respond(self, stream, request):
+        args = self._args
+        delay = args.delay
+        if random.random() < args.slow_fraction:
+            delay *= args.slow_factor
+        if delay > 0:
+            yield tornado.gen.sleep(delay / 1000)
+
+        tokens, raw_tokens, values = tokenize(request['utterance'])
+        response = dict(req=request['req'],
+                        tokens=tokens,
+                        rawTokens=raw_tokens,
+                        values=values,
+                        pos=['NN'] * len(tokens),
+                        constituencyParse=None,
+                        sentiment='neutral')
+        try:
+            yield stream.write((json.dumps(response) + '\n').encode())
+        except StreamClosedError:
+            pass
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        # the client does not separate requests with newlines, so we need
+        # to find where each JSON object ends
+        buffer = ''
+        while True:
+            try:
+                data = yield stream.read_bytes(65536, partial=True)
+            except StreamClosedError:
+                return
+            buffer += str(data, encoding='utf-8')
+
+            while True:
+                buffer = buffer.lstrip()
+                if not buffer:
+                    break
+                try:
+                    request, end = self._decoder.raw_decode(buffer)
+                except ValueError:
+                    # incomplete request, wait for more data
+                    break
+                buffer = buffer[end:]
+                tornado.ioloop.IOLoop.current().spawn_callback(self._respond, stream, request)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake tokenizer service for genie-server')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--delay', type=float, default=0,
+                        help='Time to tokenize each sentence, in milliseconds')
+    parser.add_argument('--slow_fraction', type=float, default=0,
+                        help='Fraction of sentences that are slow to tokenize')
+    parser.add_argument('--slow_factor', type=float, default=100,
+                        help='How much slower the slow sentences are')
+    args = parser.parse_args()
+
+    server = FakeTokenizerServer(args)
+    server.listen(args.port, address='127.0.0.1')
+    print('Fake tokenizer listening on port %d' % args.port)
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
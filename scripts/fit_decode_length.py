@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+#
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Fit the maximum number of decoding steps as a function of the sentence
+length, from the programs in the training set.
+
+The limit is slope * sentence length + intercept, where the slope is fit
+with least squares, and the intercept is chosen so that the given quantile
+of training programs fits, plus a safety margin. The script prints the
+hparams overrides to add to hparams_overrides in model.json.
+
+Usage:
+    python3 scripts/fit_decode_length.py --problem semparse_thingtalk_noquote \
+        --data_dir ./dataset --dataset ./dataset/train.tsv
+'''
+
+import os
+import sys
+import argparse
+
+# workaround to import modules from parent directory
+sys.path.append(os.path.abspath(os.path.join(__file__, "../..")))
+
+import numpy as np
+from tensor2tensor.utils import registry
+
+import genieparser
+from genieparser.tasks.semantic_parsing import START_TOKEN
+
+
+def load_lengths(problem, data_dir, filename, direction):
+    grammar = problem.get_grammar(data_dir)
+
+    sentence_lengths = []
+    program_lengths = []
+    with open(filename) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            _, sentence, program = line.split('\t')[:3]
+            sentence = sentence.split(' ')
+            sentence_lengths.append(len(sentence))
+
+            # this is the same processing as training, see generate_encoded_samples
+            # and _parse_program in SemanticParsingProblem
+            sentence.insert(0, START_TOKEN)
+            vectorized = grammar.tokenize_to_vector(sentence, program)
+            _, length = grammar.vectorize_program(None, vectorized, direction=direction, max_length=None)
+            program_lengths.append(length)
+    return np.array(sentence_lengths), np.array(program_lengths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit decode_length_slope and decode_length_intercept')
+    parser.add_argument('--problem', required=True)
+    parser.add_argument('--data_dir', required=True,
+                        help='Data directory of the problem (with the grammar and vocabulary)')
+    parser.add_argument('--dataset', required=True,
+                        help='Training set TSV file (id, sentence, program)')
+    parser.add_argument('--grammar_direction', default='bottomup')
+    parser.add_argument('--quantile', type=float, default=0.999,
+                        help='Fraction of training programs that must fit in the limit')
+    parser.add_argument('--margin', type=float, default=5,
+                        help='Extra decoding steps to add to the limit')
+    parser.add_argument('--extra_length', type=int, default=100,
+                        help='extra_length in the decode_hparams of the model, to compare against')
+    args = parser.parse_args()
+
+    problem = registry.problem(args.problem)
+    sentence_lengths, program_lengths = load_lengths(problem, args.data_dir, args.dataset,
+                                                     args.grammar_direction)
+    if len(sentence_lengths) == 0:
+        print('No examples found in ' + args.dataset, file=sys.stderr)
+        sys.exit(1)
+
+    slope, _ = np.polyfit(sentence_lengths, program_lengths, 1)
+    slope = max(slope, 0.0)
+    residuals = program_lengths - slope * sentence_lengths
+    intercept = np.quantile(residuals, args.quantile) + args.margin
+
+    limits = np.ceil(slope * sentence_lengths + intercept)
+    # programs longer than their limit would be cut short
+    coverage = np.mean(program_lengths <= limits)
+    # without a limit, the model decodes up to the input length (including
+    # the start and end tokens) + extra_length
+    default_limits = sentence_lengths + 2 + args.extra_length
+
+    print('examples', len(sentence_lengths), sep='\t')
+    print('program length', 'mean %.1f' % np.mean(program_lengths), 'max %d' % np.max(program_lengths), sep='\t')
+    print('coverage', '%.3f%%' % (100 * coverage), sep='\t')
+    print('max decoding steps', 'mean %.1f (was %.1f)' % (np.mean(limits), np.mean(default_limits)), sep='\t')
+    print()
+    print('decode_length_slope=%.4f,decode_length_intercept=%.1f' % (slope, intercept))
+
+
+if __name__ == '__main__':
+    main()
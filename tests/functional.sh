@@ -37,6 +37,17 @@ for problem in semparse_thingtalk semparse_thingtalk_noquote  ; do
                 # beam search decode
                 pipenv run $SRCDIR/../genie-decoder --problem $problem --data_dir $workdir --output_dir $workdir/model.$i --model $model --hparams_set ${model_hparams[$model]} --hparams "grammar_direction=$grammar,$options" --semparse_unk_threshold 1 --decode_hparams 'beam_size=4,alpha=0.6'
 
+                # check that the server can add a greedy decoder without new variables
+                modeldir=$workdir/server-model.$i
+                mkdir -p $modeldir/variables
+                ln -s $workdir $modeldir/assets.extra
+                checkpoint=`pipenv run python3 -c "import tensorflow as tf; print(tf.train.latest_checkpoint('$workdir/model.$i'))"`
+                for f in $checkpoint.* ; do
+                    ln -s $f $modeldir/variables/variables${f#$checkpoint}
+                done
+                echo "{\"problem\": \"$problem\", \"model\": \"$model\", \"hparams_set\": \"${model_hparams[$model]}\", \"hparams_overrides\": \"grammar_direction=$grammar,$options\"}" > $modeldir/model.json
+                GENIE_TEST_MODEL_DIR=$modeldir pipenv run pytest $SRCDIR/server/test_predictor.py
+
                 # test reading the metrics from tfevent files
                 pipenv run $SRCDIR/../genie-print-metrics --output_dir $workdir/model.$i --eval_early_stopping_metric "metrics-$problem/accuracy" --noeval_early_stopping_minimize
 
@@ -21,10 +21,13 @@ Created on Nov 30, 2017
 @author: gcampagn
 '''
 
+import numpy as np
 import pytest
 
 from genieparser.grammar.slr.generator import SLRParserGenerator
-from genieparser.grammar.slr import SHIFT_CODE, REDUCE_CODE
+from genieparser.grammar.slr.decoding import pack_bits, unpack_bits, build_decoding_tables
+from genieparser.grammar.slr.packed import PackedTable, PackedActionTable
+from genieparser.grammar.slr import SHIFT_CODE, REDUCE_CODE, INVALID_CODE, EOF_ID
 
 
 TEST_GRAMMAR = {
@@ -245,3 +248,94 @@ def test_invalid_parenthesis():
         ['(', '[', '(', 'b', ']', ')']
     ]
     do_test_invalid(PARENTHESIS_GRAMMAR, '$S', TEST_VECTORS, terminals=None)
+
+
+def test_pack_bits():
+    mask = np.random.RandomState(42).rand(5, 70) > 0.5
+    packed = pack_bits(mask)
+    assert packed.shape == (5, 3)
+    assert packed.dtype == np.int32
+    assert np.all(unpack_bits(packed, 70) == mask)
+
+
+def test_parenthesis_decoding_tables():
+    parser = SLRParserGenerator(PARENTHESIS_GRAMMAR, '$S').build()
+    tables = build_decoding_tables(parser.rules, parser.dictionary, '$S', [])
+    # 3 control tokens, 6 reduces and no shifts
+    legal = unpack_bits(tables.legal_bits, 9)
+    # goto only has the columns of the non-terminals $S and $V
+    assert tables.goto.shape[1] == 2
+
+    def legal_actions(stack):
+        return set(np.nonzero(legal[stack[-1]])[0])
+    def step(stack, action):
+        stack = stack[:len(stack) - tables.pop[action]]
+        return stack + [tables.goto[stack[-1], tables.push[action]]]
+
+    # first $V -> a or $V -> b, then $S -> ( $V ) or $S -> [ $V ],
+    # then any number of $S -> ( $S ) or $S -> [ $S ]
+    stack = [0]
+    assert legal_actions(stack) == {7, 8}
+    stack = step(stack, 7)
+    assert legal_actions(stack) == {3, 4}
+    stack = step(stack, 3)
+    assert legal_actions(stack) == {EOF_ID, 5, 6}
+    stack = step(stack, 6)
+    assert legal_actions(stack) == {EOF_ID, 5, 6}
+
+
+def test_conflicts():
+    # after 'a', both $A -> a and $B -> a can be reduced on 'x'
+    REDUCE_REDUCE_GRAMMAR = {
+        '$S': [('$A', 'x'), ('$B', 'x')],
+        '$A': [('a',)],
+        '$B': [('a',)]
+    }
+    with pytest.raises(ValueError) as excinfo:
+        SLRParserGenerator(REDUCE_REDUCE_GRAMMAR, '$S')
+    message = excinfo.value.args
+    assert message[0] == 'Conflict for state'
+    assert message[2:6] == ('terminal', 'x', 'want', ('reduce', 3))
+    assert list(message[7]) == [REDUCE_CODE, 2]
+
+    # after 'n + n', we can either reduce or shift '+'
+    SHIFT_REDUCE_GRAMMAR = {
+        '$S': [('$E',)],
+        '$E': [('$E', '+', '$E'), ('n',)]
+    }
+    with pytest.raises(ValueError) as excinfo:
+        SLRParserGenerator(SHIFT_REDUCE_GRAMMAR, '$S')
+    message = excinfo.value.args
+    assert message[2:6] == ('terminal', '+', 'want', ('reduce', 1))
+    assert message[7][0] == SHIFT_CODE
+
+
+def test_packed_table():
+    rng = np.random.RandomState(42)
+    dense = rng.randint(1, 100, size=(50, 30, 2)).astype(np.int32)
+    valid = rng.rand(50, 30) < 0.2
+    # some identical rows, and an empty one
+    valid[10:20] = valid[5]
+    dense[10:20] = dense[5]
+    valid[3] = False
+    dense[~valid] = INVALID_CODE
+
+    packed = PackedTable.from_dense(dense, valid)
+    assert len(packed.base) == 40
+    assert np.array_equal(packed.to_dense(), dense)
+    for row in range(50):
+        assert np.array_equal(packed.valid_columns(row), np.nonzero(valid[row])[0])
+        for column in range(30):
+            assert np.array_equal(packed.get(row, column), dense[row, column])
+
+
+def test_packed_action_table():
+    generator = SLRParserGenerator(TEST_GRAMMAR, '$prog')
+    dense = generator.action_table
+    packed = PackedActionTable.from_dense(dense)
+    assert packed.nbytes < packed.dense_nbytes
+    assert np.array_equal(packed.to_dense(), dense)
+    for state in range(len(dense)):
+        assert np.array_equal(packed.valid_columns(state), np.nonzero(dense[state, :, 0])[0])
+        for term_id in range(dense.shape[1]):
+            assert np.array_equal(packed.get(state, term_id), dense[state, term_id])
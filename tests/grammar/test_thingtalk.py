@@ -26,6 +26,8 @@ import numpy as np
 import pytest
 
 from genieparser.grammar.thingtalk import ThingTalkGrammar
+from genieparser.grammar.slr import cache as slr_cache
+from genieparser.grammar.slr.decoding import unpack_bits
 
 class IdentityTextEncoder():
     def decode_list(self, x):
@@ -121,4 +123,174 @@ def test_noquotes_tokenized_and_parse(noquotes_thingtalk_grammar):
                 if direction == 'linear':
                     assert np.all(np.equal(tokenized[::3], parsed['actions'][:-1]))
                 reconstructed = noquotes_thingtalk_grammar.reconstruct_to_vector(parsed, direction=direction, ignore_errors=False)
-                assert np.all(np.equal(tokenized, reconstructed))
\ No newline at end of file
+                assert np.all(np.equal(tokenized, reconstructed))
+
+def _decoding_step(tables, stack, action):
+    if tables.push[action] < 0:
+        return stack
+    stack = stack[:len(stack) - tables.pop[action]]
+    return stack + [tables.goto[stack[-1], tables.push[action]]]
+
+
+def _check_decoding_tables(grammar, examples):
+    tables = grammar.decoding_tables
+    legal = unpack_bits(tables.legal_bits, grammar.output_size['actions'])
+    # goto has a column for each symbol that is pushed, and no other
+    assert set(tables.push[tables.push >= 0]) == set(range(tables.goto.shape[1]))
+    for sentence, program in examples:
+        tokenized = grammar.tokenize_to_vector(sentence, program)
+        parsed, length = grammar.vectorize_program(None, tokenized, direction='bottomup', max_length=None)
+        stack = [0]
+        for action in parsed['actions'][:length]:
+            assert legal[stack[-1], action]
+            stack = _decoding_step(tables, stack, action)
+        assert legal[stack[-1], grammar.end]
+
+    # every legal sequence is a valid program
+    rng = np.random.RandomState(1234)
+    num_complete = 0
+    for _ in range(200):
+        stack = [0]
+        actions = []
+        while len(actions) < 100:
+            candidates, = np.nonzero(legal[stack[-1]])
+            assert len(candidates) > 0
+            if grammar.end in candidates and (len(candidates) == 1 or rng.rand() < 0.5):
+                actions.append(grammar.end)
+                break
+            action = rng.choice(candidates[candidates != grammar.end])
+            actions.append(action)
+            stack = _decoding_step(tables, stack, action)
+        if actions[-1] != grammar.end:
+            continue
+        num_complete += 1
+        sequences = dict((key, np.zeros((len(actions),), dtype=np.int32)) for key in grammar.output_size)
+        sequences['actions'] = np.array(actions, dtype=np.int32)
+        grammar.reconstruct_to_vector(sequences, direction='bottomup', ignore_errors=False)
+    assert num_complete > 0
+
+
+def test_decoding_tables(thingtalk_grammar):
+    test_vector_file = os.path.join(os.path.dirname(__file__), '../data/programs-withquotes.txt')
+    with open(test_vector_file, 'r') as fp:
+        examples = [([], line.strip()) for line in fp]
+    _check_decoding_tables(thingtalk_grammar, examples)
+
+
+def test_noquotes_decoding_tables(noquotes_thingtalk_grammar):
+    test_vector_file = os.path.join(os.path.dirname(__file__), '../dataset/semparse_thingtalk_noquote/train.tsv')
+    with open(test_vector_file, 'r') as fp:
+        examples = [tuple(x.split(' ') for x in line.strip().split('\t')[1:3]) for line in fp]
+    _check_decoding_tables(noquotes_thingtalk_grammar, examples)
+
+
+def test_parser_cache(tmpdir):
+    filename = os.path.join(os.path.dirname(__file__), '../data/thingpedia.json')
+    cold = ThingTalkGrammar(filename, flatten=False, quiet=True, cache_dir=str(tmpdir))
+    cold.set_input_dictionary(IdentityTextEncoder())
+    assert os.path.exists(cold.cache_filename)
+
+    warm = ThingTalkGrammar(filename, flatten=False, quiet=True, cache_dir=str(tmpdir))
+    warm.set_input_dictionary(IdentityTextEncoder())
+    assert warm.cache_filename == cold.cache_filename
+    assert warm.tables_filename == cold.cache_filename
+    assert warm._parser is not cold._parser
+    # the tables are mapped from the file, not copied
+    mapped, private = warm.parse_table_memory()
+    assert mapped > 0
+    assert private == 0
+    assert warm.tokens == cold.tokens
+    assert warm.dictionary == cold.dictionary
+    assert warm.output_size == cold.output_size
+    assert warm._parser.rules == cold._parser.rules
+    assert warm._parser.dictionary == cold._parser.dictionary
+    assert np.array_equal(warm._parser.action_table.to_dense(), cold._parser.action_table.to_dense())
+    assert np.array_equal(warm._parser.goto_table.to_dense(), cold._parser.goto_table.to_dense())
+    assert np.array_equal(warm._parser.rule_table, cold._parser.rule_table)
+    # the decoding tables are not cached, and only built when used
+    assert warm._decoding_tables is None
+    for warm_table, cold_table in zip(warm.decoding_tables, cold.decoding_tables):
+        assert np.array_equal(warm_table, cold_table)
+
+    test_vector_file = os.path.join(os.path.dirname(__file__), '../dataset/semparse_thingtalk_noquote/train.tsv')
+    with open(test_vector_file, 'r') as fp:
+        for line in fp:
+            sentence, program = line.strip().split('\t')[1:3]
+            sentence = sentence.split(' ')
+            parsed, _ = warm.vectorize_program(sentence, program, direction='bottomup', max_length=None)
+            assert program == ' '.join(warm.reconstruct_program(sentence, parsed, direction='bottomup', ignore_errors=False))
+
+    # a different grammar does not use the same file
+    flat = ThingTalkGrammar(filename, flatten=True, quiet=True, cache_dir=str(tmpdir))
+    flat.set_input_dictionary(IdentityTextEncoder())
+    assert flat.cache_filename != cold.cache_filename
+
+    # a corrupted file is ignored and rebuilt
+    with open(cold.cache_filename, 'wb') as fp:
+        fp.write(b'garbage')
+    rebuilt = ThingTalkGrammar(filename, flatten=False, quiet=True, cache_dir=str(tmpdir))
+    rebuilt.set_input_dictionary(IdentityTextEncoder())
+    assert rebuilt.tokens == cold.tokens
+    assert np.array_equal(rebuilt._parser.action_table.to_dense(), cold._parser.action_table.to_dense())
+
+
+def test_shared_parser_cache(tmpdir):
+    filename = os.path.join(os.path.dirname(__file__), '../data/thingpedia.json')
+    shared_dir = str(tmpdir.mkdir('shared'))
+    slr_cache.set_shared_cache_dir(shared_dir)
+    try:
+        # without a cache dir of its own, the grammar uses the shared dir
+        first = ThingTalkGrammar(filename, flatten=False, quiet=True)
+        first.set_input_dictionary(IdentityTextEncoder())
+        assert first.cache_filename is None
+        assert os.path.dirname(first.tables_filename) == shared_dir
+        assert first.parse_table_memory()[1] == 0
+
+        # the model cache is also written, and the shared copy is preferred
+        second = ThingTalkGrammar(filename, flatten=False, quiet=True, cache_dir=str(tmpdir))
+        second.set_input_dictionary(IdentityTextEncoder())
+        assert os.path.exists(second.cache_filename)
+        assert second.tables_filename == first.tables_filename
+        assert np.array_equal(second._parser.action_table.to_dense(), first._parser.action_table.to_dense())
+    finally:
+        slr_cache.set_shared_cache_dir(None)
+
+    private = ThingTalkGrammar(filename, flatten=False, quiet=True)
+    private.set_input_dictionary(IdentityTextEncoder())
+    assert private.tables_filename is None
+    assert private.parse_table_memory()[0] == 0
+
+
+def test_read_only_model_cache(tmpdir):
+    filename = os.path.join(os.path.dirname(__file__), '../data/thingpedia.json')
+    model_dir = tmpdir.mkdir('model')
+    shared_dir = str(tmpdir.mkdir('shared'))
+    slr_cache.set_model_cache_writable(False)
+    try:
+        # without a shared dir, the tables are built in memory
+        private = ThingTalkGrammar(filename, flatten=False, quiet=True, cache_dir=str(model_dir))
+        private.set_input_dictionary(IdentityTextEncoder())
+        assert private.tables_filename is None
+        assert model_dir.listdir() == []
+
+        # with a shared dir, they are only saved there
+        slr_cache.set_shared_cache_dir(shared_dir)
+        shared = ThingTalkGrammar(filename, flatten=False, quiet=True, cache_dir=str(model_dir))
+        shared.set_input_dictionary(IdentityTextEncoder())
+        assert os.path.dirname(shared.tables_filename) == shared_dir
+        assert model_dir.listdir() == []
+    finally:
+        slr_cache.set_shared_cache_dir(None)
+        slr_cache.set_model_cache_writable(True)
+
+    # tables shipped with the model are still loaded
+    trained = ThingTalkGrammar(filename, flatten=False, quiet=True, cache_dir=str(model_dir))
+    trained.set_input_dictionary(IdentityTextEncoder())
+    assert os.path.exists(trained.cache_filename)
+    slr_cache.set_model_cache_writable(False)
+    try:
+        served = ThingTalkGrammar(filename, flatten=False, quiet=True, cache_dir=str(model_dir))
+        served.set_input_dictionary(IdentityTextEncoder())
+        assert served.tables_filename == trained.cache_filename
+    finally:
+        slr_cache.set_model_cache_writable(True)
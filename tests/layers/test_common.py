@@ -0,0 +1,110 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 21, 2018
+
+@author: gcampagn
+'''
+
+import numpy as np
+import tensorflow as tf
+from tensor2tensor.utils import beam_search
+
+from genieparser.layers import common
+
+VOCAB_SIZE = 8
+EOS_ID = beam_search.EOS_ID
+
+
+def greedy_decode(programs, decode_length, max_decode_lengths=None):
+    '''
+    Decode greedily with a fake model that predicts the given programs,
+    one row per sentence, with a different confidence at every step.
+    '''
+    hparams = tf.contrib.training.HParams(sampling_method="argmax", sampling_temp=0.0)
+    programs = np.array(programs, dtype=np.int64)
+    batch_size, program_length = programs.shape
+    confidence = np.arange(1, program_length + 1, dtype=np.float32)
+
+    with tf.Graph().as_default():
+        cache = {
+            "programs": tf.constant(programs),
+        }
+
+        def symbols_to_logits_fn(ids, i, cache):
+            step = tf.minimum(i, program_length - 1)
+            logits = tf.one_hot(cache["programs"][:, step], VOCAB_SIZE) * tf.constant(confidence)[step]
+            return logits, cache
+
+        if max_decode_lengths is not None:
+            max_decode_lengths = tf.constant(max_decode_lengths, dtype=tf.int32)
+        result = common.fast_decode(symbols_to_logits_fn, hparams, decode_length, VOCAB_SIZE,
+                                    batch_size=batch_size, cache=cache,
+                                    max_decode_lengths=max_decode_lengths)
+        with tf.Session() as session:
+            return session.run((result["outputs"], result["scores"]))
+
+
+def test_greedy_score_does_not_depend_on_batch():
+    short = [3, EOS_ID, 4, 4, 4]
+    long = [5, 6, 7, 6, EOS_ID]
+
+    _, alone = greedy_decode([short], 10)
+    outputs, batched = greedy_decode([short, long], 10)
+
+    # the longer sentence keeps the batch going after the short one is done
+    assert outputs.shape[1] == 5
+    np.testing.assert_allclose(batched[0], alone[0], rtol=1e-6)
+
+
+def test_greedy_per_sentence_limit():
+    # neither sentence ever predicts EOS
+    programs = [[3, 4, 5, 6, 7, 3], [3, 4, 5, 6, 7, 3]]
+
+    outputs, scores = greedy_decode(programs, 10, max_decode_lengths=[2, 4])
+    # the batch stops at the longest limit, and the short sentence is padded
+    assert outputs.tolist() == [[3, 4, 0, 0], [3, 4, 5, 6]]
+
+    _, short = greedy_decode(programs[:1], 10, max_decode_lengths=[2])
+    np.testing.assert_allclose(scores[0], short[0], rtol=1e-6)
+    assert scores[0] > scores[1]
+
+
+def test_adaptive_decode_length():
+    assert common.adaptive_decode_length({}, 10) == (10, None)
+
+    with tf.Graph().as_default():
+        max_decode_length = tf.constant([3, 7], dtype=tf.int32)
+        short, short_limits = common.adaptive_decode_length({"max_decode_length": max_decode_length}, 10)
+        long, _ = common.adaptive_decode_length({"max_decode_length": max_decode_length}, 5)
+
+        with tf.Session() as session:
+            assert session.run(short) == 7
+            assert session.run(long) == 5
+            assert session.run(short_limits).tolist() == [3, 7]
+
+
+def test_max_decode_length_from_input():
+    with tf.Graph().as_default():
+        string_input = tf.constant([['get', 'my', 'email', ''],
+                                    ['hi', '', '', ''],
+                                    ['', '', '', '']])
+        max_decode_length = common.max_decode_length_from_input(string_input, 2.5, 4.0)
+
+        with tf.Session() as session:
+            # ceil(2.5 * words + 4)
+            assert session.run(max_decode_length).tolist() == [12, 7, 4]
@@ -0,0 +1,173 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+An Application that serves fake models, for testing the server without
+Tensorflow models or the tokenizer service.
+
+Created on Nov 22, 2018
+
+@author: gcampagn
+'''
+
+import os
+import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tornado.gen
+
+from genieparser.grammar.slr import cache as slr_cache
+from genieparser.server.application import Application
+from genieparser.server.config import ServerConfig
+from genieparser.server.tokenizer import TokenizerResult, TokenizerError
+from scripts.fake_tokenizer import tokenize
+
+
+class FakePredictor(object):
+    '''
+    A stand-in for Predictor, which parses each sentence into its own tokens,
+    preceded by the name of the model
+    '''
+
+    def __init__(self, name, delay=0):
+        self.name = name
+        self.delay = delay
+        self.closed = False
+        self.batch_sizes = []
+        # clear to hold all predictions until it is set again
+        self.running = threading.Event()
+        self.running.set()
+
+    @property
+    def signatures(self):
+        return ('serving_default',)
+
+    def warm_up(self, sentences, batch_sizes):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def predict(self, inputs, signature_key=None, deadline=None):
+        assert not self.closed
+        self.running.wait()
+        batch = inputs["inputs/string"]
+        self.batch_sizes.append(len(batch))
+        time.sleep(self.delay)
+
+        programs = [[self.name] + [token for token in row if token] for row in batch]
+        length = max(len(program) for program in programs)
+        # one beam for each sentence
+        outputs = np.array([[[token.encode('utf-8') for token in program] + [b''] * (length - len(program))]
+                            for program in programs])
+        return {"outputs": outputs, "scores": np.zeros((len(batch), 1), dtype=np.float32)}
+
+
+class FakeTokenizerService(object):
+    '''
+    A stand-in for TokenizerService, which tokenizes like scripts/fake_tokenizer.py
+    and fails on the sentences in failures
+    '''
+
+    available = True
+
+    def __init__(self, failures=()):
+        self.failures = set(failures)
+        # all the sentences that were tokenized
+        self.queries = []
+
+    @tornado.gen.coroutine
+    def tokenize(self, language_tag, query, expect=None):
+        self.queries.append(query)
+        if query in self.failures:
+            raise TokenizerError('Tokenizer failed')
+        tokens, raw_tokens, values = tokenize(query)
+        return TokenizerResult(tokens=tokens, values=values, constituency_parse=None,
+                               raw_tokens=raw_tokens, sentiment='neutral', pos_tags=[])
+
+
+def make_config(tmpdir, models=('en',), model_size=0, **sections):
+    '''
+    Create a ServerConfig for the given model tags, with a model directory
+    in tmpdir for each, and override the options in sections (a dict of
+    options for each section of server.conf).
+
+    The checkpoint of each model is model_size bytes, which is also
+    the memory the server will account for it.
+    '''
+    config = ServerConfig()
+    config._config['db']['url'] = ''
+    config._config['warmup']['batch_sizes'] = ''
+    config._config['batching']['max_wait_ms'] = '0'
+    for section, options in sections.items():
+        for key, value in options.items():
+            config._config[section][key] = str(value)
+
+    config._config['models'].clear()
+    for tag in models:
+        model_dir = os.path.join(tmpdir, tag.replace('/', '_'))
+        variables_dir = os.path.join(model_dir, 'variables')
+        os.makedirs(variables_dir)
+        with open(os.path.join(variables_dir, 'variables.data-00000-of-00001'), 'wb') as fp:
+            fp.truncate(model_size)
+        config._config['models'][tag] = model_dir
+    return config
+
+
+class FakeApplication(Application):
+    '''
+    An Application that creates a FakePredictor for each model; each
+    predictor is named after the model and the number of times it
+    was loaded
+    '''
+
+    def __init__(self, config, tokenizer_service=None):
+        super().__init__(config, ThreadPoolExecutor(8), tokenizer_service or FakeTokenizerService())
+        # all the predictors that were created, in order
+        self.predictors = []
+        # how many times each model directory was loaded
+        self.load_counts = Counter()
+        # set to make the next load fail
+        self.load_error = None
+        # clear to hold all loads until it is set again
+        self.loading = threading.Event()
+        self.loading.set()
+
+    def _create_predictor(self, model_dir, metrics):
+        self.loading.wait()
+        if self.load_error is not None:
+            error = self.load_error
+            self.load_error = None
+            raise error
+        name = os.path.basename(model_dir)
+        predictor = FakePredictor('%s-%d' % (name, self.load_counts[name]))
+        self.load_counts[name] += 1
+        self.predictors.append(predictor)
+        return predictor
+
+    def close(self):
+        # do not leave threads stuck on a held predictor
+        self.loading.set()
+        for predictor in self.predictors:
+            predictor.running.set()
+        super().close()
+        self.thread_pool.shutdown(wait=False)
+        # the grammar cache settings are global to the process
+        slr_cache.set_shared_cache_dir(None)
+        slr_cache.set_model_cache_writable(True)
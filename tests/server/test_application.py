@@ -0,0 +1,194 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 22, 2018
+
+@author: gcampagn
+'''
+
+import time
+import shutil
+import tempfile
+from unittest import mock
+
+import pytest
+import tornado.gen
+import tornado.testing
+
+from genieparser.server import application
+from .fake_application import FakeApplication, make_config
+
+
+class ApplicationTestCase(tornado.testing.AsyncTestCase):
+    models = ('en',)
+    model_size = 0
+    options = dict()
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = self.make_application()
+        self.io_loop.run_sync(self.app.load_all_languages)
+
+    def make_application(self):
+        return FakeApplication(make_config(self.tmpdir, self.models, self.model_size, **self.options))
+
+    def tearDown(self):
+        self.app.close()
+        shutil.rmtree(self.tmpdir)
+        super().tearDown()
+
+    @tornado.gen.coroutine
+    def predict(self, language, sentence):
+        '''
+        Predict one sentence like a request would, and return the name
+        of the model that predicted it
+        '''
+        language.acquire()
+        try:
+            predicted = yield language.batcher.predict(sentence)
+        finally:
+            language.release()
+        return predicted["outputs"][0][0].decode('utf-8')
+
+    @tornado.gen.coroutine
+    def wait_closed(self, predictor, timeout=1):
+        deadline = self.io_loop.time() + timeout
+        while not predictor.closed:
+            assert self.io_loop.time() < deadline, 'the old model was not closed'
+            yield tornado.gen.sleep(0.01)
+
+
+class ReloadTest(ApplicationTestCase):
+    @tornado.testing.gen_test
+    def test_request_in_flight(self):
+        old = yield self.app.get_language('en')
+        old.predictor.running.clear()
+        in_flight = self.predict(old, ['hello'])
+
+        stats = yield self.app.reload_language('en')
+        assert stats['duration'] >= 0 and stats['max_rss'] > 0
+
+        # new requests go to the new model right away
+        new = yield self.app.get_language('en')
+        assert new is not old
+        assert old.retired and not new.retired
+        assert (yield self.predict(new, ['hello'])) == 'en-1'
+
+        # the old model stays open until its last request is done
+        yield tornado.gen.sleep(0.1)
+        assert not old.predictor.closed
+        old.predictor.running.set()
+        assert (yield in_flight) == 'en-0'
+        yield self.wait_closed(old.predictor)
+        assert not new.predictor.closed
+
+    @tornado.testing.gen_test
+    def test_drain_timeout(self):
+        old = yield self.app.get_language('en')
+        # a request that never finishes
+        old.acquire()
+
+        with mock.patch.object(application, 'DRAIN_TIMEOUT', 0.1):
+            yield self.app.reload_language('en')
+            yield self.wait_closed(old.predictor)
+        old.release()
+
+    @tornado.testing.gen_test
+    def test_reload_during_reload(self):
+        # the second reload waits for the first one, and replaces its model
+        yield [self.app.reload_language('en'), self.app.reload_language('en')]
+        assert self.app.load_counts['en'] == 3
+
+        language = yield self.app.get_language('en')
+        assert [predictor.name for predictor in self.app.predictors] == ['en-0', 'en-1', 'en-2']
+        assert language.predictor is self.app.predictors[2]
+        yield self.wait_closed(self.app.predictors[0])
+        yield self.wait_closed(self.app.predictors[1])
+        assert (yield self.predict(language, ['hello'])) == 'en-2'
+
+    @tornado.testing.gen_test
+    def test_failed_reload(self):
+        old = yield self.app.get_language('en')
+
+        self.app.load_error = IOError('Corrupted checkpoint')
+        with pytest.raises(IOError):
+            yield self.app.reload_language('en')
+
+        # the old model keeps serving
+        language = yield self.app.get_language('en')
+        assert language is old
+        assert not old.retired and not old.predictor.closed
+        assert (yield self.predict(language, ['hello'])) == 'en-0'
+
+
+class LazyLoadingTest(ApplicationTestCase):
+    models = ('en', '@a/en', '@b/en', '@c/en')
+    # two models fit in the memory budget
+    model_size = 400 * 1024
+    options = dict(server=dict(lazy_loading='yes', model_memory_budget=1))
+
+    def loaded(self):
+        return sorted(self.app._languages.keys())
+
+    @tornado.testing.gen_test
+    def test_concurrent_first_use(self):
+        assert self.loaded() == ['en']
+
+        first, second = yield [self.app.get_language('en-US', 'a'), self.app.get_language('en-US', 'a')]
+        assert first is second
+        assert self.app.load_counts['@a_en'] == 1
+        assert self.loaded() == ['@a/en', 'en']
+
+    @tornado.testing.gen_test
+    def test_idle_eviction(self):
+        a = yield self.app.get_language('en-US', 'a')
+        b = yield self.app.get_language('en-US', 'b')
+        for language in self.app._languages.values():
+            language.last_used = time.monotonic() - 2 * self.app.config.model_idle_timeout
+
+        # a is serving a request, so it is not idle
+        a.acquire()
+        self.app._evict_idle_languages()
+        assert self.loaded() == ['@a/en', 'en']
+        assert b.retired
+        yield self.wait_closed(b.predictor)
+
+        a.release()
+        self.app._evict_idle_languages()
+        assert self.loaded() == ['en']
+        yield self.wait_closed(a.predictor)
+
+    @tornado.testing.gen_test
+    def test_memory_budget(self):
+        a = yield self.app.get_language('en-US', 'a')
+        b = yield self.app.get_language('en-US', 'b')
+        a.last_used = b.last_used + 1
+
+        # b is the least recently used model
+        c = yield self.app.get_language('en-US', 'c')
+        assert self.loaded() == ['@a/en', '@c/en', 'en']
+        yield self.wait_closed(b.predictor)
+
+        # the model that was just loaded stays, even if it is the least
+        # recently used, and so does the model that is serving a request
+        a.last_used = c.last_used = time.monotonic() + 60
+        a.acquire()
+        b = yield self.app.get_language('en-US', 'b')
+        assert self.loaded() == ['@a/en', '@b/en', 'en']
+        assert not b.retired and c.retired
+        a.release()
@@ -0,0 +1,198 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 21, 2018
+
+@author: gcampagn
+'''
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import tensorflow as tf
+import tornado.gen
+import tornado.ioloop
+
+from genieparser.server.batcher import PredictionBatcher, OverloadedError, ModelTimeoutError, BULK
+from genieparser.server.metrics import MetricsRegistry
+
+
+class SlowPredictor(object):
+    def __init__(self, delay):
+        self.delay = delay
+        self.batch_sizes = []
+
+    def predict(self, inputs, signature_key=None, deadline=None):
+        batch = inputs["inputs/string"]
+        self.batch_sizes.append(len(batch))
+        if deadline is not None and time.monotonic() + self.delay > deadline:
+            time.sleep(max(0, deadline - time.monotonic()))
+            raise tf.errors.DeadlineExceededError(None, None, 'Timed out')
+        time.sleep(self.delay)
+        return {"outputs": np.array([row[:1] for row in batch])}
+
+
+def test_batching():
+    predictor = SlowPredictor(0.01)
+    batcher = PredictionBatcher(predictor, ThreadPoolExecutor(4), max_batch_size=8, max_wait_ms=5)
+
+    @tornado.gen.coroutine
+    def run():
+        results = yield [batcher.predict(['sentence', str(i)]) for i in range(20)]
+        assert [result["outputs"][0] for result in results] == ['sentence'] * 20
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+    assert predictor.batch_sizes == [8, 8, 4]
+
+
+def test_max_wait():
+    predictor = SlowPredictor(0.01)
+    batcher = PredictionBatcher(predictor, ThreadPoolExecutor(4), max_batch_size=8, max_wait_ms=100)
+
+    @tornado.gen.coroutine
+    def run():
+        # a partial batch waits for more sentences, then goes anyway
+        start = time.monotonic()
+        yield [batcher.predict(['sentence']) for _ in range(3)]
+        assert time.monotonic() - start >= 0.1
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+    assert predictor.batch_sizes == [3]
+
+
+def test_scatter():
+    class EchoPredictor(SlowPredictor):
+        def predict(self, inputs, signature_key=None, deadline=None):
+            batch = inputs["inputs/string"]
+            self.batch_sizes.append(len(batch))
+            return {"outputs": batch, "lengths": np.array([sum(1 for token in row if token) for row in batch])}
+
+    predictor = EchoPredictor(0)
+    batcher = PredictionBatcher(predictor, ThreadPoolExecutor(4), max_batch_size=4, max_wait_ms=5)
+
+    @tornado.gen.coroutine
+    def run():
+        sentences = [['a'], ['b', 'c', 'd'], ['e', 'f']]
+        results = yield [batcher.predict(sentence) for sentence in sentences]
+        # each sentence gets its own row of every output, padded to the batch
+        for sentence, result in zip(sentences, results):
+            assert list(result["outputs"]) == sentence + [''] * (3 - len(sentence))
+            assert result["lengths"] == len(sentence)
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+    assert predictor.batch_sizes == [3]
+
+
+def test_load_shedding():
+    registry = MetricsRegistry()
+    metrics = registry.stages('en')
+    predictor = SlowPredictor(0.2)
+    batcher = PredictionBatcher(predictor, ThreadPoolExecutor(4), max_batch_size=2, max_wait_ms=0,
+                                max_queue_depth=4, max_concurrent_batches=1, metrics=metrics)
+
+    @tornado.gen.coroutine
+    def run():
+        # the first sentence goes to the model right away, the next four wait
+        futures = [batcher.predict(['sentence']) for _ in range(5)]
+        assert len(batcher) == 4
+
+        # the queue is full
+        with pytest.raises(OverloadedError):
+            batcher.predict(['sentence'])
+
+        # this sentence cannot wait for the current batch to finish
+        start = time.monotonic()
+        yield futures[1:3]
+        with pytest.raises(OverloadedError):
+            yield batcher.predict(['sentence'], deadline=time.monotonic() + 0.05)
+        assert time.monotonic() - start < 1
+
+        yield futures
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+    assert predictor.batch_sizes == [1, 2, 2]
+    rendered = registry.render()
+    assert 'genie_shed_requests_total{tag="en",lane="interactive",reason="queue_full"} 1' in rendered
+    assert 'genie_shed_requests_total{tag="en",lane="interactive",reason="deadline"} 1' in rendered
+    assert 'genie_queue_depth{tag="en",lane="interactive"} 0' in rendered
+
+
+def test_predict_many():
+    predictor = SlowPredictor(0.1)
+    batcher = PredictionBatcher(predictor, ThreadPoolExecutor(4), max_batch_size=8, max_wait_ms=0,
+                                max_queue_depth=4, max_concurrent_batches=1)
+
+    @tornado.gen.coroutine
+    def run():
+        first = batcher.predict(['sentence'])
+        futures = batcher.predict_many([['sentence', str(i)] for i in range(3)])
+        assert len(batcher) == 3
+
+        # the queue has room for one more sentence, but not for two
+        with pytest.raises(OverloadedError):
+            batcher.predict_many([['sentence'], ['sentence']])
+        assert len(batcher) == 3
+
+        results = yield [first] + futures
+        assert [result["outputs"][0] for result in results] == ['sentence'] * 4
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+    assert predictor.batch_sizes == [1, 3]
+
+
+def test_priority():
+    predictor = SlowPredictor(0.05)
+    batcher = PredictionBatcher(predictor, ThreadPoolExecutor(4), max_batch_size=4, max_wait_ms=0,
+                                max_concurrent_batches=2)
+
+    @tornado.gen.coroutine
+    def run():
+        # bulk sentences leave one batch free for interactive sentences
+        bulk = [batcher.predict(['bulk', str(i)], lane=BULK) for i in range(12)]
+        assert len(batcher) == 11
+
+        start = time.monotonic()
+        interactive = batcher.predict(['interactive'])
+        assert len(batcher) == 8
+        yield interactive
+        assert time.monotonic() - start < 0.09
+
+        yield bulk
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+    # the interactive sentence was topped up with bulk sentences
+    assert sorted(predictor.batch_sizes) == [1, 4, 4, 4]
+
+
+def test_timeout():
+    predictor = SlowPredictor(0.5)
+    batcher = PredictionBatcher(predictor, ThreadPoolExecutor(4), max_batch_size=4, max_wait_ms=5)
+
+    @tornado.gen.coroutine
+    def run():
+        # the batch runs until the latest deadline
+        start = time.monotonic()
+        futures = [batcher.predict(['sentence'], deadline=start + 0.1),
+                   batcher.predict(['sentence'], deadline=start + 0.2)]
+        for future in futures:
+            with pytest.raises(ModelTimeoutError):
+                yield future
+        assert 0.2 <= time.monotonic() - start < 0.4
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
@@ -0,0 +1,107 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>. 
+'''
+Created on Nov 13, 2018
+
+@author: gcampagn
+'''
+
+import time
+
+import tornado.gen
+import tornado.ioloop
+from tornado.concurrent import Future
+
+from genieparser.server.cache import LRUCache, SingleFlight
+
+
+def test_lru_eviction():
+    cache = LRUCache(2)
+    
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    
+    # 'b' was the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    
+    assert cache.stats == dict(size=2, max_size=2, hits=3, misses=1, hit_rate=0.75, evictions=1, expirations=0)
+
+
+def test_ttl():
+    cache = LRUCache(10, ttl=0.05)
+    
+    cache.put('a', 1)
+    assert cache.get('a') == 1
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert cache.expirations == 1
+    assert len(cache) == 0
+
+
+def test_invalidate():
+    cache = LRUCache(10)
+    
+    cache.put(('en', None, 'foo'), 1)
+    cache.put(('en', 'test', 'foo'), 2)
+    cache.put(('zh', None, 'foo'), 3)
+    
+    cache.invalidate(lambda key: key[0] == 'en' and key[1] is None)
+    assert cache.get(('en', None, 'foo')) is None
+    assert cache.get(('en', 'test', 'foo')) == 2
+    assert cache.get(('zh', None, 'foo')) == 3
+    
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_disabled():
+    cache = LRUCache(0)
+    
+    cache.put('a', 1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_single_flight():
+    inflight = SingleFlight()
+    calls = []
+    
+    def compute(key):
+        calls.append(key)
+        future = Future()
+        tornado.ioloop.IOLoop.current().call_later(0.01, future.set_result, key.upper())
+        return future
+    
+    @tornado.gen.coroutine
+    def run():
+        results = yield [inflight.run(key, compute, key) for key in ('a', 'a', 'b', 'a')]
+        assert results == ['A', 'A', 'B', 'A']
+        assert calls == ['a', 'b']
+        assert inflight.coalesced == 2
+        assert len(inflight) == 0
+        
+        # once the first computation is done, a new one starts
+        result = yield inflight.run('a', compute, 'a')
+        assert result == 'A'
+        assert calls == ['a', 'b', 'a']
+    
+    tornado.ioloop.IOLoop.current().run_sync(run)
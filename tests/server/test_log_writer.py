@@ -0,0 +1,121 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 14, 2018
+
+@author: gcampagn
+'''
+
+import os
+import time
+
+import sqlalchemy
+import tornado.gen
+import tornado.ioloop
+
+from genieparser.server.log_writer import UtteranceLogWriter, metadata
+
+
+def make_database(tmpdir, delay=0):
+    database = sqlalchemy.create_engine('sqlite:///' + os.path.join(str(tmpdir), 'log.db'))
+    metadata.create_all(database)
+
+    statements = []
+    @sqlalchemy.event.listens_for(database, 'before_cursor_execute')
+    def slow_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('INSERT'):
+            statements.append(statement)
+            time.sleep(delay)
+    return database, statements
+
+
+def count_rows(database):
+    return database.execute('select count(*) from utterance_log').scalar()
+
+
+def test_multi_row_insert(tmpdir):
+    database, statements = make_database(tmpdir)
+    writer = UtteranceLogWriter(database, batch_size=10, flush_interval=0.05)
+    writer.start()
+
+    for i in range(25):
+        writer.log('en', 'sentence ' + str(i), 'now => @com.xkcd.get => notify')
+    writer.close()
+
+    assert count_rows(database) == 25
+    assert len(statements) == 3
+    assert writer.stats == dict(queued=0, written=25, dropped=0, failed_flushes=0)
+
+
+def test_ioloop_latency_with_slow_database(tmpdir):
+    # every insert takes 300ms, much longer than the time between log calls
+    database, _ = make_database(tmpdir, delay=0.3)
+    writer = UtteranceLogWriter(database, batch_size=20, flush_interval=0.01)
+    writer.start()
+
+    @tornado.gen.coroutine
+    def simulate_queries():
+        max_lag = 0
+        for i in range(100):
+            writer.log('en', 'sentence ' + str(i), 'now => @com.xkcd.get => notify')
+            start = time.monotonic()
+            yield tornado.gen.sleep(0.005)
+            max_lag = max(max_lag, time.monotonic() - start - 0.005)
+        return max_lag
+
+    max_lag = tornado.ioloop.IOLoop.current().run_sync(simulate_queries)
+    # a synchronous insert would stall the IOLoop for at least 300ms
+    assert max_lag < 0.1
+
+    writer.close()
+    assert count_rows(database) == 100
+
+
+def test_drop_when_database_down(tmpdir):
+    # no utterance_log table, every insert fails
+    database = sqlalchemy.create_engine('sqlite:///' + os.path.join(str(tmpdir), 'empty.db'))
+    writer = UtteranceLogWriter(database, max_queue_size=10, batch_size=5,
+                                flush_interval=0.01, overflow='drop_new')
+    writer.start()
+
+    start = time.monotonic()
+    for i in range(50):
+        writer.log('en', 'sentence ' + str(i), 'now => @com.xkcd.get => notify')
+    assert time.monotonic() - start < 0.1
+
+    time.sleep(0.1)
+    stats = writer.stats
+    assert stats['written'] == 0
+    assert stats['failed_flushes'] >= 1
+    assert stats['queued'] + stats['dropped'] == 50
+    assert stats['queued'] <= 10
+    writer.close(timeout=1)
+
+
+def test_close_flushes_buffered_rows(tmpdir):
+    database, statements = make_database(tmpdir)
+    # neither the batch size nor the flush interval is reached before close
+    writer = UtteranceLogWriter(database, batch_size=100, flush_interval=60)
+    writer.start()
+
+    for i in range(5):
+        writer.log('en', 'sentence ' + str(i), 'now => @com.xkcd.get => notify')
+    writer.close(timeout=5)
+
+    assert count_rows(database) == 5
+    assert len(statements) == 1
+    assert writer.stats == dict(queued=0, written=5, dropped=0, failed_flushes=0)
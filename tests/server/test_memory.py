@@ -0,0 +1,66 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 29, 2018
+
+@author: gcampagn
+'''
+
+from genieparser.server.memory import parse_smaps, summarize_mappings, is_parse_table_file
+
+SMAPS = '''\
+55d0c0a00000-55d0c0b00000 r-xp 00000000 08:01 1234                       /usr/bin/python3.6
+Size:               1024 kB
+Rss:                 800 kB
+Pss:                 200 kB
+Shared_Clean:        800 kB
+Shared_Dirty:          0 kB
+Private_Clean:         0 kB
+Private_Dirty:         0 kB
+VmFlags: rd ex mr mw me dw
+7f0000000000-7f0000300000 r--s 00000000 08:01 5678                       /var/cache/genie/slr-tables-v3-0123456789abcdef.bin
+Size:               3072 kB
+Rss:                3000 kB
+Pss:                1000 kB
+Shared_Clean:       3000 kB
+Shared_Dirty:          0 kB
+Private_Clean:         0 kB
+Private_Dirty:         0 kB
+7f0000400000-7f0000500000 rw-p 00000000 00:00 0 
+Size:               1024 kB
+Rss:                 512 kB
+Pss:                 512 kB
+Shared_Clean:          0 kB
+Shared_Dirty:          0 kB
+Private_Clean:         0 kB
+Private_Dirty:       512 kB
+'''
+
+
+def test_parse_smaps():
+    mappings = parse_smaps(SMAPS.splitlines())
+    assert [path for path, _ in mappings] == ['/usr/bin/python3.6',
+                                              '/var/cache/genie/slr-tables-v3-0123456789abcdef.bin', '']
+    assert mappings[1][1]['Rss'] == 3000 * 1024
+    assert mappings[2][1]['Private_Dirty'] == 512 * 1024
+    assert 'VmFlags' not in mappings[0][1]
+
+
+def test_summarize_mappings():
+    report = summarize_mappings(parse_smaps(SMAPS.splitlines()), is_parse_table_file)
+    assert report['total'] == dict(rss=4312 * 1024, pss=1712 * 1024, shared=3800 * 1024, private=512 * 1024)
+    assert report['grammar_tables'] == dict(rss=3000 * 1024, pss=1000 * 1024, shared=3000 * 1024, private=0)
@@ -0,0 +1,78 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 19, 2018
+
+@author: gcampagn
+'''
+
+from genieparser.server.metrics import Histogram, MetricsRegistry
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2, 3):
+        histogram.observe(value)
+
+    cumulative, total = histogram.snapshot()
+    # buckets are inclusive of their upper bound
+    assert cumulative == [2, 3, 5]
+    assert total == 5.65
+
+
+def test_render():
+    registry = MetricsRegistry()
+    registry.stages('en').observe('session_run', 0.2)
+    registry.stages('@org.thingpedia.foo/en').observe('session_run', 20)
+    registry.histogram('genie_utterance_log_insert_seconds', 'Insert time', buckets=(1,)).observe(0.5)
+
+    assert registry.render().split('\n') == [
+        '# HELP genie_stage_duration_seconds Time spent in each stage of handling a request',
+        '# TYPE genie_stage_duration_seconds histogram',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="0.0005"} 0',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="0.001"} 0',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="0.0025"} 0',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="0.005"} 0',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="0.01"} 0',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="0.025"} 0',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="0.05"} 0',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="0.1"} 0',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="0.25"} 1',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="0.5"} 1',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="1.0"} 1',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="2.5"} 1',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="5.0"} 1',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="10.0"} 1',
+        'genie_stage_duration_seconds_bucket{tag="en",stage="session_run",le="+Inf"} 1',
+        'genie_stage_duration_seconds_sum{tag="en",stage="session_run"} 0.2',
+        'genie_stage_duration_seconds_count{tag="en",stage="session_run"} 1',
+    ] + [
+        'genie_stage_duration_seconds_bucket{tag="@org.thingpedia.foo/en",stage="session_run",le="%s"} %d'
+        % (bound, 1 if bound == '+Inf' else 0)
+        for bound in ('0.0005', '0.001', '0.0025', '0.005', '0.01', '0.025', '0.05',
+                      '0.1', '0.25', '0.5', '1.0', '2.5', '5.0', '10.0', '+Inf')
+    ] + [
+        'genie_stage_duration_seconds_sum{tag="@org.thingpedia.foo/en",stage="session_run"} 20.0',
+        'genie_stage_duration_seconds_count{tag="@org.thingpedia.foo/en",stage="session_run"} 1',
+        '# HELP genie_utterance_log_insert_seconds Insert time',
+        '# TYPE genie_utterance_log_insert_seconds histogram',
+        'genie_utterance_log_insert_seconds_bucket{le="1"} 1',
+        'genie_utterance_log_insert_seconds_bucket{le="+Inf"} 1',
+        'genie_utterance_log_insert_seconds_sum 0.5',
+        'genie_utterance_log_insert_seconds_count 1',
+        '',
+    ]
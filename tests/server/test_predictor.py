@@ -0,0 +1,70 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 21, 2018
+
+@author: gcampagn
+'''
+
+import os
+import json
+
+import pytest
+import tensorflow as tf
+
+from genieparser.server.predictor import Predictor, GREEDY_SIGNATURE
+
+# a model directory in the layout used by the server (model.json and
+# assets.extra, optionally variables), such as the ones created by
+# tests/functional.sh
+MODEL_DIR = os.environ.get('GENIE_TEST_MODEL_DIR', '')
+
+
+class GraphOnlyPredictor(Predictor):
+    '''
+    A Predictor that records the variables of its graph instead of
+    restoring them from the checkpoint
+    '''
+
+    def _create_session(self, model_dir, run_config):
+        self.variables = sorted((variable.op.name, tuple(variable.shape.as_list()))
+                                for variable in tf.global_variables())
+        return None
+
+
+@pytest.mark.skipif(not MODEL_DIR, reason='GENIE_TEST_MODEL_DIR is not set')
+def test_greedy_signature_shares_variables():
+    with open(os.path.join(MODEL_DIR, 'model.json')) as fp:
+        config = json.load(fp)
+    config['decode_hparams'] = 'beam_size=4'
+
+    beam = GraphOnlyPredictor(MODEL_DIR, config, greedy=False)
+    greedy = GraphOnlyPredictor(MODEL_DIR, config, greedy=True)
+    assert GREEDY_SIGNATURE not in beam.signatures
+    assert GREEDY_SIGNATURE in greedy.signatures
+
+    # building the decoder a second time must reuse the same weights
+    assert greedy.variables == beam.variables
+
+    variables_dir = os.path.join(MODEL_DIR, tf.saved_model.constants.VARIABLES_DIRECTORY)
+    if tf.gfile.IsDirectory(variables_dir):
+        # and they must all be restored from the checkpoint
+        checkpoint = dict((name, tuple(shape)) for name, shape in
+                          tf.train.list_variables(os.path.join(variables_dir,
+                                                               tf.saved_model.constants.VARIABLES_FILENAME)))
+        for name, shape in greedy.variables:
+            assert checkpoint.get(name, None) == shape, name
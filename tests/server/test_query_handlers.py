@@ -0,0 +1,253 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 22, 2018
+
+@author: gcampagn
+'''
+
+import json
+import shutil
+import tempfile
+
+import tornado.gen
+import tornado.testing
+from tornado.httpclient import HTTPRequest
+
+from .fake_application import FakeApplication, make_config
+
+
+class HandlerTestCase(tornado.testing.AsyncHTTPTestCase):
+    options = dict()
+
+    def setUp(self):
+        super().setUp()
+        self.io_loop.run_sync(self.app.load_all_languages)
+
+    def get_app(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = FakeApplication(make_config(self.tmpdir, **self.options))
+        return self.app
+
+    def tearDown(self):
+        self.app.close()
+        shutil.rmtree(self.tmpdir)
+        super().tearDown()
+
+    @tornado.gen.coroutine
+    def fetch_json(self, path, **kw):
+        response = yield self.http_client.fetch(self.get_url(path), raise_error=False, **kw)
+        if response.code != 200:
+            return response.code, None
+        return response.code, json.loads(str(response.body, encoding='utf-8'))
+
+
+class ReadyTest(HandlerTestCase):
+    def setUp(self):
+        # do not load the models yet
+        tornado.testing.AsyncHTTPTestCase.setUp(self)
+
+    @tornado.testing.gen_test
+    def test_ready(self):
+        self.app.loading.clear()
+        loaded = self.app.load_all_languages()
+
+        response = yield self.http_client.fetch(self.get_url('/health/ready'), raise_error=False)
+        assert response.code == 503
+        assert json.loads(str(response.body, encoding='utf-8')) == dict(status='starting')
+
+        # a query waits for the model to be loaded
+        query = self.fetch_json('/en-US/query?q=get+a+cat')
+        yield tornado.gen.sleep(0.1)
+        assert not query.done()
+
+        self.app.loading.set()
+        yield loaded
+        code, response = yield self.fetch_json('/health/ready')
+        assert code == 200
+        assert response == dict(status='ready', tokenizer=True)
+        code, response = yield query
+        assert response['candidates'][0]['code'][0] == 'en-0'
+        assert self.app.load_counts['en'] == 1
+
+
+class QueryTest(HandlerTestCase):
+    @tornado.testing.gen_test
+    def test_query(self):
+        code, response = yield self.fetch_json('/en-US/query?q=get+a+cat&limit=1')
+        assert code == 200
+        assert response['tokens'] == ['get', 'a', 'cat']
+        assert response['candidates'] == [dict(code=['en-0', 'get', 'a', 'cat'], score=0.0)]
+
+    @tornado.testing.gen_test
+    def test_coalescing_across_reload(self):
+        old = self.app.predictors[0]
+        old.running.clear()
+        first = self.fetch_json('/en-US/query?q=get+a+cat')
+        yield tornado.gen.sleep(0.1)
+        yield self.app.reload_language('en')
+
+        # an identical query does not wait for the old model
+        code, second = yield self.fetch_json('/en-US/query?q=get+a+cat')
+        assert second['candidates'][0]['code'][0] == 'en-1'
+
+        old.running.set()
+        code, first = yield first
+        assert first['candidates'][0]['code'][0] == 'en-0'
+
+        # and the old result was not cached for the new model
+        code, third = yield self.fetch_json('/en-US/query?q=get+a+cat')
+        assert third['candidates'][0]['code'][0] == 'en-1'
+        assert self.app.query_cache.stats['hits'] == 1
+
+
+class BatchQueryTest(HandlerTestCase):
+    @tornado.gen.coroutine
+    def post_batch(self, sentences, arguments=''):
+        code, response = yield self.fetch_json('/en-US/query/batch?limit=1' + arguments, method='POST',
+                                               body=json.dumps(sentences))
+        return code, (response['results'] if response is not None else None)
+
+    @tornado.testing.gen_test
+    def test_order(self):
+        # sentences of different length, predicted in several batches
+        words = 'show me the picture of a cat on twitter'.split()
+        sentences = [' '.join(words[i % 9:] + words[:i % 4]) for i in range(50)]
+        code, results = yield self.post_batch(sentences)
+        assert code == 200
+        assert [result['tokens'] for result in results] == [sentence.split() for sentence in sentences]
+        assert [result['candidates'][0]['code'] for result in results] == \
+            [['en-0'] + sentence.split() for sentence in sentences]
+
+    @tornado.testing.gen_test
+    def test_errors(self):
+        self.app._tokenizer.failures.add('cannot tokenize this')
+        code, results = yield self.post_batch(['get a cat', 'cannot tokenize this', 42, ['get', 'a', 'dog']])
+        assert code == 200
+        assert results[0]['candidates'][0]['code'] == ['en-0', 'get', 'a', 'cat']
+        assert results[1] == dict(error='Tokenizer failed')
+        # lists of tokens are only valid with tokenized=1
+        assert results[2] == dict(error='Invalid sentence')
+        assert results[3] == dict(error='Invalid sentence')
+
+    @tornado.testing.gen_test
+    def test_invalid_body(self):
+        code, _ = yield self.fetch_json('/en-US/query/batch', method='POST', body='{"q": "get a cat"}')
+        assert code == 400
+        code, _ = yield self.fetch_json('/en-US/query/batch', method='POST', body='get a cat')
+        assert code == 400
+
+    @tornado.testing.gen_test
+    def test_too_many_sentences(self):
+        self.app.config._config['batching']['max_queries_per_request'] = '2'
+        code, _ = yield self.post_batch(['get a cat', 'get a dog', 'get a fox'])
+        assert code == 413
+        code, _ = yield self.post_batch(['get a cat', 'get a dog'])
+        assert code == 200
+
+    @tornado.testing.gen_test
+    def test_multiple_choice(self):
+        code, _ = yield self.post_batch(['yes'], '&expect=MultipleChoice')
+        assert code == 400
+
+    @tornado.testing.gen_test
+    def test_tokenized(self):
+        sentences = [['post', 'QUOTED_STRING_0', 'on', 'twitter'], 'get a cat']
+        code, results = yield self.post_batch(sentences, '&tokenized=1')
+        assert code == 200
+        assert results[0]['candidates'][0]['code'] == ['en-0', 'post', 'QUOTED_STRING_0', 'on', 'twitter']
+        assert results[1]['tokens'] == ['get', 'a', 'cat']
+        assert self.app._tokenizer.queries == []
+
+
+class StreamingQueryTest(HandlerTestCase):
+    options = dict(batching=dict(max_inflight_per_stream=4))
+
+    def post_stream(self, chunks):
+        '''
+        Send the chunks as the request body, one at a time, and return
+        the response lines
+        '''
+        @tornado.gen.coroutine
+        def body_producer(write):
+            for chunk in chunks:
+                yield write(chunk)
+                yield tornado.gen.sleep(0.001)
+
+        received = []
+        request = HTTPRequest(self.get_url('/en-US/query/stream?limit=1'), method='POST',
+                              body_producer=body_producer, streaming_callback=received.append,
+                              request_timeout=10)
+
+        @tornado.gen.coroutine
+        def run():
+            response = yield self.http_client.fetch(request)
+            assert response.code == 200
+            assert response.headers['Content-Type'] == 'application/x-ndjson'
+            body = b''.join(received)
+            assert body.endswith(b'\n')
+            return [json.loads(str(line, encoding='utf-8')) for line in body.split(b'\n')[:-1]]
+        return run()
+
+    @tornado.testing.gen_test
+    def test_framing_and_order(self):
+        self.app.predictors[0].delay = 0.01
+        self.app._tokenizer.failures.add('cannot tokenize this')
+
+        words = 'show me the picture of a cat on twitter'.split()
+        sentences = [' '.join(words[i % 9:] + words[:i % 4]) for i in range(30)]
+        lines = [json.dumps(sentence) for sentence in sentences]
+        lines[3] = '{"not json'
+        lines[5] = '42'
+        lines[7] = '"cannot tokenize this"'
+        # blank lines are skipped, and the last line does not need a newline
+        body = '\n'.join(lines[:10]) + '\n\n' + '\n'.join(lines[10:])
+        body = body.encode('utf-8')
+        # lines are split across chunks
+        chunks = [body[i:i+7] for i in range(0, len(body), 7)]
+
+        results = yield self.post_stream(chunks)
+        assert len(results) == 30
+        for i, (sentence, result) in enumerate(zip(sentences, results)):
+            if i == 3:
+                assert result == dict(error='Invalid JSON')
+            elif i == 5:
+                assert result == dict(error='Invalid sentence')
+            elif i == 7:
+                assert result == dict(error='Tokenizer failed')
+            else:
+                assert result['candidates'][0]['code'] == ['en-0'] + sentence.split()
+
+    @tornado.testing.gen_test
+    def test_backpressure(self):
+        predictor = self.app.predictors[0]
+        predictor.running.clear()
+
+        sentences = ['get a cat number %s' % chr(ord('a') + i) for i in range(20)]
+        chunks = [(json.dumps(sentence) + '\n').encode('utf-8') for sentence in sentences]
+        response = self.post_stream(chunks)
+
+        # only max_inflight_per_stream sentences are read while the model is busy
+        yield tornado.gen.sleep(0.2)
+        assert self.app._tokenizer.queries == sentences[:4]
+
+        predictor.running.set()
+        results = yield response
+        assert [result['tokens'] for result in results] == [sentence.split() for sentence in sentences]
+        assert self.app._tokenizer.queries == sentences
+        # the model never saw more than 4 sentences at once
+        assert max(predictor.batch_sizes) <= 4
@@ -0,0 +1,211 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 16, 2018
+
+@author: gcampagn
+'''
+
+import os
+import time
+import signal
+import socket
+
+import tornado.gen
+import tornado.ioloop
+import tornado.testing
+from tornado.tcpserver import TCPServer
+
+from genieparser.server.supervisor import Supervisor, SupervisorConnection, bind_port, listen_sockets
+from genieparser.server.metrics import MetricsRegistry, render_snapshots
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_supervisor(tmpdir):
+    tmpdir = str(tmpdir)
+
+    def worker_main(index, sock):
+        io_loop = tornado.ioloop.IOLoop()
+        io_loop.make_current()
+
+        def on_message(message):
+            with open(os.path.join(tmpdir, 'received-%d-%d' % (index, os.getpid())), 'a') as fp:
+                fp.write(message['op'] + '\n')
+
+        connection = SupervisorConnection(sock)
+        connection.start(on_message)
+        connection.send(dict(op='ready'))
+        if index == 0 and not os.path.exists(os.path.join(tmpdir, 'sent')):
+            open(os.path.join(tmpdir, 'sent'), 'w').close()
+            connection.send(dict(op='reload'))
+        io_loop.start()
+
+    def on_ready():
+        open(os.path.join(tmpdir, 'ready'), 'w').close()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            Supervisor(3, worker_main, on_ready=on_ready).run()
+        finally:
+            os._exit(0)
+
+    try:
+        wait_for(lambda: os.path.exists(os.path.join(tmpdir, 'ready')))
+
+        # the message sent by worker 0 reaches all the other workers
+        def received():
+            return sorted(name for name in os.listdir(tmpdir) if name.startswith('received-'))
+        wait_for(lambda: len(received()) == 2)
+        assert [name.split('-')[1] for name in received()] == ['1', '2']
+        for name in received():
+            with open(os.path.join(tmpdir, name)) as fp:
+                assert fp.read() == 'reload\n'
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status)
+
+
+def test_metrics_from_all_workers(tmpdir):
+    tmpdir = str(tmpdir)
+
+    def worker_main(index, sock):
+        io_loop = tornado.ioloop.IOLoop()
+        io_loop.make_current()
+
+        registry = MetricsRegistry()
+        registry.counter('genie_test_total', 'Test counter').labels().inc(index + 1)
+        connection = SupervisorConnection(sock, index)
+
+        def on_message(message):
+            if message['op'] == 'stats':
+                connection.reply(message, dict(op='stats', stats=dict(worker=index, metrics=registry.snapshot())))
+
+        @tornado.gen.coroutine
+        def scrape():
+            # wait until the other worker is listening too
+            yield tornado.gen.sleep(0.5)
+            replies = yield connection.request(dict(op='stats'), 1, 5)
+            stats = [dict(worker=index, metrics=registry.snapshot())] + [reply['stats'] for reply in replies]
+            with open(os.path.join(tmpdir, 'metrics.tmp'), 'w') as fp:
+                fp.write(render_snapshots([(worker['worker'], worker['metrics']) for worker in stats]))
+            os.rename(os.path.join(tmpdir, 'metrics.tmp'), os.path.join(tmpdir, 'metrics'))
+
+        connection.start(on_message)
+        connection.send(dict(op='ready'))
+        if index == 0:
+            io_loop.spawn_callback(scrape)
+        io_loop.start()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            Supervisor(2, worker_main).run()
+        finally:
+            os._exit(0)
+
+    try:
+        wait_for(lambda: os.path.exists(os.path.join(tmpdir, 'metrics')))
+        with open(os.path.join(tmpdir, 'metrics')) as fp:
+            assert fp.read().split('\n') == [
+                '# HELP genie_test_total Test counter',
+                '# TYPE genie_test_total counter',
+                'genie_test_total{worker="0"} 1',
+                'genie_test_total{worker="1"} 2',
+                '',
+            ]
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status)
+
+
+class PidServer(TCPServer):
+    '''
+    Send the pid of the worker that accepted the connection
+    '''
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        yield stream.write(str(os.getpid()).encode('ascii'))
+        stream.close()
+
+
+def test_restarted_worker_listens_after_loading(tmpdir):
+    tmpdir = str(tmpdir)
+    sock, port = tornado.testing.bind_unused_port()
+    sock.close()
+
+    def listening(index):
+        try:
+            with open(os.path.join(tmpdir, 'listening-%d' % index)) as fp:
+                return [int(pid) for pid in fp.read().split()]
+        except FileNotFoundError:
+            return []
+
+    def worker_main(index, sock):
+        io_loop = tornado.ioloop.IOLoop()
+        io_loop.make_current()
+
+        # like run_server, bind the port before loading the models
+        sockets = bind_port(port, reuse_port=True)
+        connection = SupervisorConnection(sock, index)
+        connection.start(lambda message: None)
+
+        started = os.path.join(tmpdir, 'started-%d' % index)
+        if os.path.exists(started):
+            # the replacement of a crashed worker takes a while to load
+            open(os.path.join(tmpdir, 'loading'), 'w').close()
+            time.sleep(2)
+        open(started, 'w').close()
+
+        listen_sockets(PidServer(), sockets)
+        with open(os.path.join(tmpdir, 'listening-%d' % index), 'a') as fp:
+            fp.write('%d\n' % os.getpid())
+        connection.send(dict(op='ready'))
+        io_loop.start()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            Supervisor(2, worker_main).run()
+        finally:
+            os._exit(0)
+
+    try:
+        wait_for(lambda: listening(0) and listening(1))
+        os.kill(listening(0)[0], signal.SIGKILL)
+        wait_for(lambda: os.path.exists(os.path.join(tmpdir, 'loading')))
+
+        # while the new worker is loading, all connections go to the other one
+        for _ in range(20):
+            with socket.create_connection(('127.0.0.1', port), timeout=1) as client:
+                assert int(client.recv(16)) == listening(1)[0]
+        assert len(listening(0)) == 1
+
+        wait_for(lambda: len(listening(0)) == 2)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status)
@@ -0,0 +1,168 @@
+# Copyright 2018 The Board of Trustees of the Leland Stanford Junior University
+#
+# Author: Giovanni Campagna <gcampagn@cs.stanford.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Created on Nov 15, 2018
+
+@author: gcampagn
+'''
+
+import argparse
+
+import pytest
+import tornado.gen
+import tornado.ioloop
+import tornado.testing
+
+from genieparser.server.tokenizer import TokenizerService, TokenizerError, Tokenizer
+from genieparser.server.cache import LRUCache
+from scripts.fake_tokenizer import FakeTokenizerServer
+
+
+def start_fake_tokenizer(delay=0, slow_fraction=0):
+    args = argparse.Namespace(delay=delay, slow_fraction=slow_fraction, slow_factor=100)
+    sock, port = tornado.testing.bind_unused_port()
+    server = FakeTokenizerServer(args)
+    server.add_sockets([sock])
+    return server, port
+
+
+@tornado.gen.coroutine
+def wait_connected(service):
+    for _ in range(100):
+        if all(connection.connected for connection in service._connections):
+            return
+        yield tornado.gen.sleep(0.01)
+
+
+def test_pool():
+    @tornado.gen.coroutine
+    def run():
+        server, port = start_fake_tokenizer(delay=1)
+        service = TokenizerService('127.0.0.1', port, num_connections=3)
+        service.run()
+        yield wait_connected(service)
+
+        futures = [service.tokenize('en', 'post "hello %d" on twitter' % i) for i in range(30)]
+        # requests are spread evenly over the connections
+        assert [connection.outstanding for connection in service._connections] == [10, 10, 10]
+
+        results = yield futures
+        for i, result in enumerate(results):
+            assert result.tokens == ['post', 'QUOTED_STRING_0', 'on', 'twitter']
+            assert result.values == {'QUOTED_STRING_0': 'hello %d' % i}
+
+        service.close()
+        server.stop()
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+
+
+def test_timeout():
+    @tornado.gen.coroutine
+    def run():
+        server, port = start_fake_tokenizer(delay=200)
+        service = TokenizerService('127.0.0.1', port, num_connections=1, timeout=0.05)
+        service.run()
+        yield wait_connected(service)
+
+        with pytest.raises(TokenizerError):
+            yield service.tokenize('en', 'get a cat')
+        assert service._connections[0].outstanding == 0
+
+        service.close()
+        server.stop()
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+
+
+def unused_port():
+    sock, port = tornado.testing.bind_unused_port()
+    sock.close()
+    return port
+
+
+def test_wait_for_connection():
+    @tornado.gen.coroutine
+    def run():
+        port = unused_port()
+        service = TokenizerService('127.0.0.1', port, num_connections=2)
+        service.run()
+
+        # the request is sent before the connection is open, and before
+        # the tokenizer is even listening
+        future = service.tokenize('en', 'get a cat')
+        yield tornado.gen.sleep(0.2)
+        assert not future.done()
+
+        server = FakeTokenizerServer(argparse.Namespace(delay=0, slow_fraction=0, slow_factor=100))
+        server.listen(port, '127.0.0.1')
+        result = yield future
+        assert result.tokens == ['get', 'a', 'cat']
+
+        service.close()
+        server.stop()
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+
+
+def test_not_available():
+    @tornado.gen.coroutine
+    def run():
+        service = TokenizerService('127.0.0.1', unused_port(), num_connections=1, timeout=0.5)
+        service.run()
+
+        # the request fails as soon as the connection backs off past its timeout
+        start = tornado.ioloop.IOLoop.current().time()
+        with pytest.raises(TokenizerError):
+            yield service.tokenize('en', 'get a cat')
+        assert tornado.ioloop.IOLoop.current().time() - start < 0.5
+        service.close()
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+
+
+def test_cache():
+    @tornado.gen.coroutine
+    def run():
+        server, port = start_fake_tokenizer()
+        service = TokenizerService('127.0.0.1', port, num_connections=1)
+        service.run()
+        yield wait_connected(service)
+
+        cache = LRUCache(10)
+        en_tokenizer = Tokenizer(service, 'en', cache)
+        it_tokenizer = Tokenizer(service, 'it', cache)
+
+        # concurrent identical requests are coalesced
+        first, second = yield [en_tokenizer.tokenize('get a cat'), en_tokenizer.tokenize('get a cat')]
+        assert first is second
+        assert cache.stats['misses'] == 2
+        assert len(cache) == 1
+
+        # later requests hit the cache, but only for the same language and expect
+        third = yield en_tokenizer.tokenize('get a cat')
+        assert third is first
+        assert cache.hits == 1
+        yield en_tokenizer.tokenize('get a cat', expect='MultipleChoice')
+        yield it_tokenizer.tokenize('get a cat')
+        assert cache.hits == 1
+        assert len(cache) == 3
+
+        service.close()
+        server.stop()
+
+    tornado.ioloop.IOLoop.current().run_sync(run)